@@ -46,9 +46,11 @@ import tools.muscle
 import tools.gap2seq
 
 # third-party
+import pysam
 import Bio.AlignIO
 import Bio.SeqIO
 import Bio.Data.IUPACData
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 
 log = logging.getLogger(__name__)
 
@@ -96,7 +98,8 @@ def trim_rmdup_subsamp_reads(inBam, clipDb, outBam, n_reads=100000, trim_opts=No
             **(trim_opts or {})
         )
 
-    n_trim = max(map(util.file.count_fastq_reads, trimfq))    # count is pairs
+    # Trimmomatic and Prinseq keep the two mate files in sync, so count pairs from the first
+    n_trim = util.file.count_fastq_reads(trimfq[0])    # count is pairs
     n_trim_unpaired = sum(map(util.file.count_fastq_reads, trimfq_unpaired))    # count is individual reads
 
     # --- Prinseq duplicate removal ---
@@ -119,20 +122,23 @@ def trim_rmdup_subsamp_reads(inBam, clipDb, outBam, n_reads=100000, trim_opts=No
         unpairedOutFastq2=rmdupfq_unpaired_from_paired_rmdup[1]
     )
 
-    n_rmdup_paired = max(map(util.file.count_fastq_reads, rmdupfq))    # count is pairs
+    n_rmdup_paired = util.file.count_fastq_reads(rmdupfq[0])    # count is pairs
     n_rmdup = n_rmdup_paired    # count is pairs
 
     tmp_header = util.file.mkstempfname('.header.sam')
     tools.samtools.SamtoolsTool().dumpHeader(inBam, tmp_header)
 
     # convert paired reads to bam
-    # stub out an empty file if the input fastqs are empty
+    # stub out an empty file with the input bam's header if the input fastqs are empty
     tmp_bam_paired = util.file.mkstempfname('.paired.bam')
+    dummy_header = {'RG': [read_utils.fastq_to_bam_read_group('Dummy')]}
     if all(os.path.getsize(x) > 0 for x in rmdupfq):
-        tools.picard.FastqToSamTool().execute(rmdupfq[0], rmdupfq[1], 'Dummy', tmp_bam_paired)
+        read_utils.fastq_to_ubam(rmdupfq[0], rmdupfq[1], tmp_bam_paired, dummy_header)
     else:
-        opts = ['INPUT=' + tmp_header, 'OUTPUT=' + tmp_bam_paired, 'VERBOSITY=ERROR']
-        tools.picard.PicardTools().execute('SamFormatConverter', opts, JVMmemory='50m')
+        with open(tmp_header, 'rt') as inf:
+            in_header = pysam.AlignmentHeader.from_text(inf.read())
+        with pysam.AlignmentFile(tmp_bam_paired, 'wb', header=in_header):
+            pass
 
     n_paired_subsamp = 0
     n_unpaired_subsamp = 0
@@ -167,7 +173,7 @@ def trim_rmdup_subsamp_reads(inBam, clipDb, outBam, n_reads=100000, trim_opts=No
         else:
             # take pooled unpaired reads and convert to bam
             tmp_bam_unpaired = util.file.mkstempfname('.unpaired.bam')
-            tools.picard.FastqToSamTool().execute(unpaired_concat_rmdup, None, 'Dummy', tmp_bam_unpaired)
+            read_utils.fastq_to_ubam(unpaired_concat_rmdup, None, tmp_bam_unpaired, dummy_header)
 
             tmp_bam_unpaired_subsamp = util.file.mkstempfname('.unpaired.subsamp.bam')
             reads_to_add = (n_reads - (n_rmdup_paired * 2))
@@ -178,7 +184,8 @@ def trim_rmdup_subsamp_reads(inBam, clipDb, outBam, n_reads=100000, trim_opts=No
 
             # merge the subsampled unpaired reads into the bam to be used as
             tmp_bam_merged = util.file.mkstempfname('.merged.bam')
-            tools.picard.MergeSamFilesTool().execute([tmp_bam_paired, tmp_bam_unpaired_subsamp], tmp_bam_merged)
+            # (all reads are unmapped, so queryname order is the order Picard's coordinate merge used)
+            samtools.merge_native([tmp_bam_paired, tmp_bam_unpaired_subsamp], tmp_bam_merged, sort_order='queryname')
             os.unlink(tmp_bam_unpaired_subsamp)
 
             tools.samtools.SamtoolsTool().reheader(tmp_bam_merged, tmp_header, outBam)
@@ -692,6 +699,56 @@ class PoorAssemblyError(Exception):
         )
 
 
+def _impute_segment(idx, refSeqObj, asmSeqObj, aligner, replaceLength, newName=None, threads=None):
+    ''' Align one assembled segment to its reference and modify it as
+        described in impute_from_reference. Returns the path of a temp FASTA
+        with the imputed segment.
+    '''
+    tmpOutputFile = util.file.mkstempfname(prefix='seq-out-{idx}-'.format(idx=idx), suffix=".fasta")
+    concat_file = util.file.mkstempfname('.ref_and_actual.fasta')
+    ref_file = util.file.mkstempfname('.ref.fasta')
+    actual_file = util.file.mkstempfname('.actual.fasta')
+    aligned_file = util.file.mkstempfname('.'+aligner+'.fasta')
+    refName = refSeqObj.id
+    with open(concat_file, 'wt') as outf:
+        Bio.SeqIO.write([refSeqObj, asmSeqObj], outf, "fasta")
+    with open(ref_file, 'wt') as outf:
+        Bio.SeqIO.write([refSeqObj], outf, "fasta")
+    with open(actual_file, 'wt') as outf:
+        Bio.SeqIO.write([asmSeqObj], outf, "fasta")
+
+    # align scaffolded genome to reference (choose one of three aligners)
+    if aligner == 'mafft':
+        tools.mafft.MafftTool().execute(
+            [ref_file, actual_file], aligned_file, False, True, True, False, False, None, threads=threads
+        )
+    elif aligner == 'muscle':
+        if len(refSeqObj) > 40000:
+            tools.muscle.MuscleTool().execute(
+                concat_file, aligned_file, quiet=False,
+                maxiters=2, diags=True
+            )
+        else:
+            tools.muscle.MuscleTool().execute(concat_file, aligned_file, quiet=False)
+    elif aligner == 'mummer':
+        tools.mummer.MummerTool().align_one_to_one(ref_file, actual_file, aligned_file)
+
+    # renames the segment name "sampleName-idx" where idx is the segment number
+    modify_contig(
+        aligned_file, tmpOutputFile, refName,
+        name=newName + "-" + str(idx + 1) if newName else None,
+        call_reference_ns=True, trim_ends=True, replace_5ends=True, replace_3ends=True,
+        replace_length=replaceLength, replace_end_gaps=True
+    )
+
+    # clean up
+    os.unlink(concat_file)
+    os.unlink(ref_file)
+    os.unlink(actual_file)
+    os.unlink(aligned_file)
+    return tmpOutputFile
+
+
 def impute_from_reference(
     inFasta,
     inReference,
@@ -701,7 +758,8 @@ def impute_from_reference(
     replaceLength,
     newName=None,
     aligner='muscle',
-    index=False
+    index=False,
+    threads=None
 ):
     '''
         This takes a de novo assembly, aligns against a reference genome, and
@@ -721,12 +779,13 @@ def impute_from_reference(
             positions with two steps of read-based refinement (below), and
             revert positions back to Ns where read support is lacking.
         FASTA indexing: output assembly is indexed for Picard, Samtools, Novoalign.
+        Segments are aligned and modified in parallel, up to threads at a
+        time; the output keeps the input segment order.
     '''
-    tempFastas = []
-
-    pmc = parser_modify_contig(argparse.ArgumentParser())
     assert aligner in ('muscle', 'mafft', 'mummer')
+    threads = util.misc.sanitize_thread_count(threads)
 
+    segments = []
     with open(inFasta, 'r') as asmFastaFile:
         with open(inReference, 'r') as refFastaFile:
             asmFasta = Bio.SeqIO.parse(asmFastaFile, 'fasta')
@@ -754,54 +813,17 @@ def impute_from_reference(
                 )
                 if seq_len < minLength or non_n_count < seq_len * minUnambig:
                     raise PoorAssemblyError(idx + 1, seq_len, non_n_count, minLength, len(refSeqObj))
-
-                # prepare temp input and output files
-                tmpOutputFile = util.file.mkstempfname(prefix='seq-out-{idx}-'.format(idx=idx), suffix=".fasta")
-                concat_file = util.file.mkstempfname('.ref_and_actual.fasta')
-                ref_file = util.file.mkstempfname('.ref.fasta')
-                actual_file = util.file.mkstempfname('.actual.fasta')
-                aligned_file = util.file.mkstempfname('.'+aligner+'.fasta')
-                refName = refSeqObj.id
-                with open(concat_file, 'wt') as outf:
-                    Bio.SeqIO.write([refSeqObj, asmSeqObj], outf, "fasta")
-                with open(ref_file, 'wt') as outf:
-                    Bio.SeqIO.write([refSeqObj], outf, "fasta")
-                with open(actual_file, 'wt') as outf:
-                    Bio.SeqIO.write([asmSeqObj], outf, "fasta")
-
-                # align scaffolded genome to reference (choose one of three aligners)
-                if aligner == 'mafft':
-                    tools.mafft.MafftTool().execute(
-                        [ref_file, actual_file], aligned_file, False, True, True, False, False, None
-                    )
-                elif aligner == 'muscle':
-                    if len(refSeqObj) > 40000:
-                        tools.muscle.MuscleTool().execute(
-                            concat_file, aligned_file, quiet=False,
-                            maxiters=2, diags=True
-                        )
-                    else:
-                        tools.muscle.MuscleTool().execute(concat_file, aligned_file, quiet=False)
-                elif aligner == 'mummer':
-                    tools.mummer.MummerTool().align_one_to_one(ref_file, actual_file, aligned_file)
-
-                # run modify_contig
-                args = [
-                    aligned_file, tmpOutputFile, refName, '--call-reference-ns', '--trim-ends', '--replace-5ends',
-                    '--replace-3ends', '--replace-length', str(replaceLength), '--replace-end-gaps'
-                ]
-                if newName:
-                    # renames the segment name "sampleName-idx" where idx is the segment number
-                    args.extend(['--name', newName + "-" + str(idx + 1)])
-                args = pmc.parse_args(args)
-                args.func_main(args)
-
-                # clean up
-                os.unlink(concat_file)
-                os.unlink(ref_file)
-                os.unlink(actual_file)
-                os.unlink(aligned_file)
-                tempFastas.append(tmpOutputFile)
+                segments.append((idx, refSeqObj, asmSeqObj))
+
+    # align and modify each segment, spreading threads across the segments in flight
+    workers = max(1, min(threads, len(segments)))
+    impute = functools.partial(_impute_segment, aligner=aligner, replaceLength=replaceLength,
+                               newName=newName, threads=max(1, threads // workers))
+    if workers == 1:
+        tempFastas = [impute(*segment) for segment in segments]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            tempFastas = list(executor.map(impute, *zip(*segments)))
 
     # merge outputs
     util.file.concat(tempFastas, outFasta)
@@ -810,9 +832,14 @@ def impute_from_reference(
 
     # Index final output FASTA for Picard/GATK, Samtools, and Novoalign
     if index:
-        tools.samtools.SamtoolsTool().faidx(outFasta, overwrite=True)
-        tools.picard.CreateSequenceDictionaryTool().execute(outFasta, overwrite=True)
-        tools.novoalign.NovoalignTool().index_fasta(outFasta)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [
+                executor.submit(tools.samtools.SamtoolsTool().faidx, outFasta, overwrite=True),
+                executor.submit(tools.picard.CreateSequenceDictionaryTool().execute, outFasta, overwrite=True),
+                executor.submit(tools.novoalign.NovoalignTool().index_fasta, outFasta),
+            ]
+            for future in futures:
+                future.result()
 
     return 0
 
@@ -858,7 +885,7 @@ def parser_impute_from_reference(parser=argparse.ArgumentParser()):
         action="store_true",
         dest="index"
     )
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, impute_from_reference, split_args=True)
     return parser
 
@@ -881,7 +908,9 @@ def refine_assembly(
     JVMmemory=None,
     threads=None,
     gatk_path=None,
-    novoalign_license_path=None
+    novoalign_license_path=None,
+    engine='gatk',
+    already_aligned_bam=None
 ):
     ''' This a refinement step where we take a crude assembly, align
         all reads back to it, and modify the assembly to the majority
@@ -892,6 +921,14 @@ def refine_assembly(
         with Picard (in order to debias the allele counts in the pileups),
         and realigned with GATK's IndelRealigner (in order to call indels).
         Output FASTA file is indexed for Picard, Samtools, and Novoalign.
+
+        engine='pileup' skips GATK altogether: alleles (and indels) are
+        counted in a single pysam pileup pass over the de-duplicated
+        alignment and called with the same rules (see pileup_consensus).
+
+        already_aligned_bam skips the Novoalign and Picard steps (reads are
+        still realigned by the gatk engine); already_realigned_bam skips
+        realignment as well, and only applies to the gatk engine.
     '''
     chr_names = chr_names or []
 
@@ -907,6 +944,26 @@ def refine_assembly(
     novoalign = tools.novoalign.NovoalignTool(license_path=novoalign_license_path)
     gatk = tools.gatk.GATKTool(path=gatk_path)
 
+    if engine == 'pileup':
+        if already_realigned_bam:
+            raise ValueError("engine='pileup' does not realign reads; pass the aligned BAM as already_aligned_bam")
+        if already_aligned_bam:
+            rmdupBam = already_aligned_bam
+        else:
+            rmdupBam = _refine_align_rmdup(
+                inBam, inFasta, novo_params, keep_all_reads, JVMmemory, novoalign, picard_mkdup
+            )
+            if outBam:
+                shutil.copyfile(rmdupBam, outBam)
+        pileup_consensus(
+            rmdupBam, inFasta, outFasta, outVcf=outVcf, min_coverage=min_coverage,
+            major_cutoff=major_cutoff, chr_names=chr_names
+        )
+        if already_aligned_bam is None:
+            os.unlink(rmdupBam)
+        _refine_index_output(outFasta, picard_index, samtools, novoalign)
+        return 0
+
     # Create deambiguated genome for GATK
     deambigFasta = util.file.mkstempfname('.deambig.fasta')
     deambig_fasta(inFasta, deambigFasta)
@@ -916,19 +973,16 @@ def refine_assembly(
     if already_realigned_bam:
         realignBam = already_realigned_bam
     else:
-        # Novoalign reads to self
-        novoBam = util.file.mkstempfname('.novoalign.bam')
-        min_qual = 0 if keep_all_reads else 1
-        novoalign.execute(inBam, inFasta, novoBam, options=novo_params.split(), min_qual=min_qual, JVMmemory=JVMmemory)
-        rmdupBam = util.file.mkstempfname('.rmdup.bam')
-        opts = ['CREATE_INDEX=true']
-        if not keep_all_reads:
-            opts.append('REMOVE_DUPLICATES=true')
-        picard_mkdup.execute([novoBam], rmdupBam, picardOptions=opts, JVMmemory=JVMmemory)
-        os.unlink(novoBam)
+        if already_aligned_bam:
+            rmdupBam = already_aligned_bam
+        else:
+            rmdupBam = _refine_align_rmdup(
+                inBam, inFasta, novo_params, keep_all_reads, JVMmemory, novoalign, picard_mkdup
+            )
         realignBam = util.file.mkstempfname('.realign.bam')
         gatk.local_realign(rmdupBam, deambigFasta, realignBam, JVMmemory=JVMmemory, threads=threads)
-        os.unlink(rmdupBam)
+        if already_aligned_bam is None:
+            os.unlink(rmdupBam)
         if outBam:
             shutil.copyfile(realignBam, outBam)
 
@@ -939,6 +993,12 @@ def refine_assembly(
     if already_realigned_bam is None:
         os.unlink(realignBam)
     os.unlink(deambigFasta)
+    with util.vcf.VcfReader(tmpVcf) as vcf:
+        assert len(
+            vcf.samples()
+        ) == 1, """Multiple sample columns were found in the intermediary VCF file
+            of the refine_assembly step, suggesting multiple sample names are present
+            upstream in the BAM file. Please correct this so there is only one sample in the BAM file."""
     name_opts = []
     if chr_names:
         name_opts = ['--name'] + chr_names
@@ -962,6 +1022,27 @@ def refine_assembly(
     shutil.copyfile(tmpFasta, outFasta)
     os.unlink(tmpFasta)
 
+    _refine_index_output(outFasta, picard_index, samtools, novoalign)
+    return 0
+
+
+def _refine_align_rmdup(inBam, inFasta, novo_params, keep_all_reads, JVMmemory, novoalign, picard_mkdup):
+    ''' Novoalign reads to self and remove (or mark) PCR duplicates,
+        returning a new indexed BAM file.
+    '''
+    novoBam = util.file.mkstempfname('.novoalign.bam')
+    min_qual = 0 if keep_all_reads else 1
+    novoalign.execute(inBam, inFasta, novoBam, options=novo_params.split(), min_qual=min_qual, JVMmemory=JVMmemory)
+    rmdupBam = util.file.mkstempfname('.rmdup.bam')
+    opts = ['CREATE_INDEX=true']
+    if not keep_all_reads:
+        opts.append('REMOVE_DUPLICATES=true')
+    picard_mkdup.execute([novoBam], rmdupBam, picardOptions=opts, JVMmemory=JVMmemory)
+    os.unlink(novoBam)
+    return rmdupBam
+
+
+def _refine_index_output(outFasta, picard_index, samtools, novoalign):
     # Index final output FASTA for Picard/GATK, Samtools, and Novoalign
     picard_index.execute(outFasta, overwrite=True)
     # if the input bam is empty, an empty fasta will be created, however
@@ -970,8 +1051,6 @@ def refine_assembly(
     if (os.path.getsize(outFasta) > 0):
         samtools.faidx(outFasta, overwrite=True)
         novoalign.index_fasta(outFasta)
-        
-    return 0
 
 
 def parser_refine_assembly(parser=argparse.ArgumentParser()):
@@ -990,10 +1069,17 @@ def parser_refine_assembly(parser=argparse.ArgumentParser()):
             This bypasses the alignment process by novoalign and instead uses the given
             BAM to make an assembly. When set, outBam is ignored."""
     )
+    parser.add_argument(
+        '--already_aligned_bam',
+        default=None,
+        help="""BAM with reads that are already aligned to inFasta, with duplicates removed,
+            but not realigned. This bypasses novoalign and Picard MarkDuplicates; with
+            --engine gatk, reads are still realigned. When set, outBam is ignored."""
+    )
     parser.add_argument(
         '--outBam',
         default=None,
-        help='Reads aligned to inFasta. Unaligned and duplicate reads have been removed. GATK indel realigned.'
+        help='Reads aligned to inFasta. Unaligned and duplicate reads have been removed. GATK indel realigned (except with --engine pileup).'
     )
     parser.add_argument('--outVcf', default=None, help='GATK genotype calls for genome in inFasta coordinate space.')
     parser.add_argument(
@@ -1047,6 +1133,14 @@ def parser_refine_assembly(parser=argparse.ArgumentParser()):
         dest="novoalign_license_path",
         help='A path to the novoalign.lic file. This overrides the NOVOALIGN_LICENSE_PATH environment variable. (default: %(default)s)'
     )
+    parser.add_argument(
+        '--engine',
+        default='gatk',
+        choices=('gatk', 'pileup'),
+        help="""gatk: realign indels and call alleles with GATK (IndelRealigner, UnifiedGenotyper).
+                pileup: count alleles and indels in one pileup pass over the de-duplicated
+                alignment, without GATK; outBam is then not indel realigned. (default: %(default)s)"""
+    )
     util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, refine_assembly, split_args=True)
     return parser
@@ -1055,9 +1149,13 @@ def parser_refine_assembly(parser=argparse.ArgumentParser()):
 __commands__.append(('refine_assembly', parser_refine_assembly))
 
 
+# every byte other than A, C, G and T (either case)
+_NOT_UNAMBIG_BYTES = bytes(bytearray(c for c in range(256) if chr(c) not in 'ACGTacgt'))
+
+
 def unambig_count(seq):
-    unambig = set(('A', 'T', 'C', 'G'))
-    return sum(1 for s in seq if s.upper() in unambig)
+    ''' Number of A, C, G and T bases (either case) in seq. '''
+    return len(str(seq).encode('ascii', 'replace').translate(None, _NOT_UNAMBIG_BYTES))
 
 
 def parser_filter_short_seqs(parser=argparse.ArgumentParser()):
@@ -1083,10 +1181,10 @@ def main_filter_short_seqs(args):
     with util.file.open_or_gzopen(args.inFile) as inf:
         with util.file.open_or_gzopen(args.outFile, 'w') as outf:
             Bio.SeqIO.write(
-                [
+                (
                     s for s in Bio.SeqIO.parse(inf, args.format)
                     if len(s) >= args.minLength and unambig_count(s.seq) >= len(s) * args.minUnambig
-                ], outf, args.output_format
+                ), outf, args.output_format
             )
     return 0
 
@@ -1175,165 +1273,248 @@ def parser_modify_contig(parser=argparse.ArgumentParser()):
     return parser
 
 
-def main_modify_contig(args):
+def modify_contig(
+    input,
+    output,
+    ref,
+    name=None,
+    call_reference_ns=False,
+    trim_ends=False,
+    replace_5ends=False,
+    replace_3ends=False,
+    replace_length=10,
+    format='fasta',
+    replace_end_gaps=False,
+    remove_end_ns=False,
+    call_reference_ambiguous=False
+):
     ''' Modifies an input contig. Depending on the options
         selected, can replace N calls with reference calls, replace ambiguous
         calls with reference calls, trim to the length of the reference, replace
         contig ends with reference calls, and trim leading and trailing Ns.
         Author: rsealfon.
     '''
-    aln = Bio.AlignIO.read(args.input, args.format)
+    aln = Bio.AlignIO.read(input, format)
 
     # TODO?: take list of alignments in, one per chromosome, rather than
     #       single alignment
 
     if len(aln) != 2:
         raise Exception("alignment does not contain exactly 2 sequences, %s found" % len(aln))
-    elif aln[0].name == args.ref:
+    elif aln[0].name == ref:
         ref_idx = 0
         consensus_idx = 1
-    elif aln[1].name == args.ref:
+    elif aln[1].name == ref:
         ref_idx = 1
         consensus_idx = 0
     else:
-        raise NameError("reference name '%s' not in alignment" % args.ref)
+        raise NameError("reference name '%s' not in alignment" % ref)
 
     mc = ContigModifier(str(aln[ref_idx].seq), str(aln[consensus_idx].seq))
-    if args.remove_end_ns:
+    if remove_end_ns:
         mc.remove_end_ns()
-    if args.call_reference_ns:
+    if call_reference_ns:
         mc.call_reference_ns()
-    if args.call_reference_ambiguous:
+    if call_reference_ambiguous:
         mc.call_reference_ambiguous()
-    if args.trim_ends:
+    if trim_ends:
         mc.trim_ends()
-    if args.replace_end_gaps:
+    if replace_end_gaps:
         mc.replace_end_gaps()
-    if args.replace_5ends:
-        mc.replace_5ends(args.replace_length)
-    if args.replace_3ends:
-        mc.replace_3ends(args.replace_length)
-
-    with open(args.output, "wt") as f:
-        if hasattr(args, "name"):
-            name = args.name
-        else:
+    if replace_5ends:
+        mc.replace_5ends(replace_length)
+    if replace_3ends:
+        mc.replace_3ends(replace_length)
+
+    with open(output, "wt") as f:
+        if name is None:
             name = aln[consensus_idx].name
         for line in util.file.fastaMaker([(name, mc.get_stripped_consensus())]):
             f.write(line)
     return 0
 
 
+def main_modify_contig(args):
+    ''' Modifies an input contig. Depending on the options
+        selected, can replace N calls with reference calls, replace ambiguous
+        calls with reference calls, trim to the length of the reference, replace
+        contig ends with reference calls, and trim leading and trailing Ns.
+        Author: rsealfon.
+    '''
+    return modify_contig(
+        args.input, args.output, args.ref,
+        name=args.name,
+        call_reference_ns=args.call_reference_ns,
+        trim_ends=args.trim_ends,
+        replace_5ends=args.replace_5ends,
+        replace_3ends=args.replace_3ends,
+        replace_length=args.replace_length,
+        format=args.format,
+        replace_end_gaps=args.replace_end_gaps,
+        remove_end_ns=args.remove_end_ns,
+        call_reference_ambiguous=args.call_reference_ambiguous
+    )
+
+
 __commands__.append(('modify_contig', parser_modify_contig))
 
 
+def _ascii_array(seq):
+    return numpy.frombuffer(bytearray(str(seq), 'ascii'), dtype=numpy.uint8)
+
+
+def _ambiguity_table():
+    ''' table[c, r] is True if base r (either case) is one of the bases
+        represented by IUPAC code c (either case). '''
+    table = numpy.zeros((256, 256), dtype=bool)
+    for code, bases in Bio.Data.IUPACData.ambiguous_dna_values.items():
+        for c in (code.upper(), code.lower()):
+            for base in bases:
+                table[ord(c), ord(base.upper())] = True
+                table[ord(c), ord(base.lower())] = True
+    return table
+
+
 class ContigModifier(object):
     ''' Initial modifications to Trinity+MUMmer assembly output based on
         MUSCLE alignment to known reference genome
         author: rsealfon
+
+        The aligned sequences are held as NumPy byte arrays and each
+        modification is applied as a whole-array operation.
     '''
+    GAP = ord('-')
+    _AMBIGUITY_TABLE = None
 
     def __init__(self, ref, consensus):
         if len(ref) != len(consensus):
             raise Exception("improper alignment")
-        self.ref = list(ref)
-        self.consensus = list(consensus)
+        self.ref = _ascii_array(ref)
+        self.consensus = _ascii_array(consensus)
         self.len = len(ref)
 
     def get_stripped_consensus(self):
-        return ''.join(self.consensus).replace('-', '')
+        return self.consensus.tobytes().replace(b'-', b'').decode('ascii')
+
+    def _end_run_lengths(self, mask):
+        ''' Lengths of the runs of True at the start and end of mask. '''
+        false_idx = numpy.flatnonzero(~mask)
+        if not len(false_idx):
+            return (self.len, self.len)
+        return (false_idx[0], self.len - 1 - false_idx[-1])
 
     def call_reference_ns(self):
         log.debug("populating N's from reference...")
-        for i in range(self.len):
-            if self.consensus[i].upper() == "N":
-                self.consensus[i] = self.ref[i]
+        mask = (self.consensus == ord('N')) | (self.consensus == ord('n'))
+        self.consensus[mask] = self.ref[mask]
 
     def call_reference_ambiguous(self):
         ''' This is not normally used by default in our pipeline '''
         log.debug("populating ambiguous bases from reference...")
-        for i in range(self.len):
-            if self.ref[i].upper() in Bio.Data.IUPACData.ambiguous_dna_values.get(self.consensus[i].upper(), []):
-                self.consensus[i] = self.ref[i]
+        if ContigModifier._AMBIGUITY_TABLE is None:
+            ContigModifier._AMBIGUITY_TABLE = _ambiguity_table()
+        mask = ContigModifier._AMBIGUITY_TABLE[self.consensus, self.ref]
+        self.consensus[mask] = self.ref[mask]
 
     def trim_ends(self):
         ''' This trims down the consensus so it cannot go beyond the given reference genome '''
         log.debug("trimming ends...")
-        for end_iterator in (range(self.len), reversed(range(self.len))):
-            for i in end_iterator:
-                if self.ref[i] != "-":
-                    break
-                else:
-                    self.consensus[i] = "-"
+        head, tail = self._end_run_lengths(self.ref == self.GAP)
+        self.consensus[:head] = self.GAP
+        self.consensus[self.len - tail:] = self.GAP
 
     def replace_end_gaps(self):
         ''' This fills out the ends of the consensus with reference sequence '''
         log.debug("populating leading and trailing gaps from reference...")
-        for end_iterator in (range(self.len), reversed(range(self.len))):
-            for i in end_iterator:
-                if self.consensus[i] != "-":
-                    break
-                self.consensus[i] = self.ref[i]
+        head, tail = self._end_run_lengths(self.consensus == self.GAP)
+        self.consensus[:head] = self.ref[:head]
+        self.consensus[self.len - tail:] = self.ref[self.len - tail:]
 
     def replace_5ends(self, replace_length):
         ''' This replaces everything within <replace_length> of the ends of the
             reference genome with the reference genome.
         '''
         log.debug("replacing 5' ends...")
-        ct = 0
-        for i in range(self.len):
-            if self.ref[i] != "-":
-                ct = ct + 1
-            if ct == replace_length:
-                for j in range(i + 1):
-                    self.consensus[j] = self.ref[j]
-                break
+        ct = numpy.cumsum(self.ref != self.GAP)
+        hits = numpy.flatnonzero(ct == replace_length)
+        if len(hits):
+            i = hits[0]
+            self.consensus[:i + 1] = self.ref[:i + 1]
 
     def replace_3ends(self, replace_length):
         log.debug("replacing 3' ends...")
-        ct = 0
-        for i in reversed(range(self.len)):
-            if self.ref[i] != "-":
-                ct = ct + 1
-            if ct == replace_length:
-                for j in range(i, self.len):
-                    self.consensus[j] = self.ref[j]
-                break
+        ct = numpy.cumsum((self.ref != self.GAP)[::-1])
+        hits = numpy.flatnonzero(ct == replace_length)
+        if len(hits):
+            i = self.len - 1 - hits[0]
+            self.consensus[i:] = self.ref[i:]
 
     def remove_end_ns(self):
         ''' This clips off any N's that begin or end the consensus.
             Not normally used in our pipeline
         '''
         log.debug("removing leading and trailing N's...")
-        for end_iterator in (range(self.len), reversed(range(self.len))):
-            for i in end_iterator:
-                if (self.consensus[i].upper() == "N" or self.consensus[i] == "-"):
-                    self.consensus[i] = "-"
-                else:
-                    break
+        head, tail = self._end_run_lengths(
+            (self.consensus == ord('N')) | (self.consensus == ord('n')) | (self.consensus == self.GAP))
+        self.consensus[:head] = self.GAP
+        self.consensus[self.len - tail:] = self.GAP
 
 
 class MutableSequence(object):
+    ''' A sequence with 1-based coordinates start..stop, in which each
+        position can be replaced by a base, by several bases (an insertion)
+        or by nothing (a deletion).
+
+        Positions are held in a bytearray, one byte per position, with a NUL
+        byte marking a deleted position. Positions replaced by anything other
+        than a single ASCII character are kept in a separate dict, and the
+        whole sequence is assembled once, at emit time.
+    '''
+    _DELETED = b'\x00'
 
     def __init__(self, name, start, stop, init_seq=None):
         if not (stop >= start >= 1):
             raise IndexError("coords out of bounds")
         if init_seq is None:
-            self.seq = list('N' * (stop - start + 1))
+            self.seq = bytearray(b'N') * (stop - start + 1)
         else:
-            self.seq = list(init_seq)
+            self.seq = bytearray(init_seq, 'ascii')
         if stop - start + 1 != len(self.seq):
             raise Exception("wrong length")
         self.start = start
         self.stop = stop
         self.name = name
         self.deletions = []
+        self.insertions = {}
+
+    def _set(self, i, new_seq):
+        if len(new_seq) == 1 and ord(new_seq) < 128:
+            self.seq[i] = ord(new_seq)
+            if self.insertions:
+                self.insertions.pop(i, None)
+        elif not new_seq:
+            self.seq[i] = 0
+            if self.insertions:
+                self.insertions.pop(i, None)
+        else:
+            self.insertions[i] = new_seq
 
     def modify(self, p, new_base):
         if not (self.start <= p <= self.stop):
             raise IndexError("position out of bounds")
         i = p - self.start
-        self.seq[i] = new_base
+        self._set(i, new_base)
+
+    def get(self, p):
+        ''' Return what position p currently holds: a base, an insertion, or
+            an empty string if it has been deleted.
+        '''
+        if not (self.start <= p <= self.stop):
+            raise IndexError("position out of bounds")
+        i = p - self.start
+        if i in self.insertions:
+            return self.insertions[i]
+        return self.seq[i:i + 1].replace(self._DELETED, b'').decode('ascii')
 
     def replace(self, start, stop, new_seq):
         if stop > start:
@@ -1345,26 +1526,35 @@ class MutableSequence(object):
             raise IndexError("positions out of bounds")
         start -= self.start
         stop -= self.start
-        if start == stop:
-            self.seq[start] = new_seq
-        for i in range(max(stop - start + 1, len(new_seq))):
-            if start + i <= stop:
-                if i < len(new_seq):
-                    if start + i == stop:
-                        # new allele is >= ref length, fill out the rest of the bases
-                        self.seq[start + i] = new_seq[i:]
-                    else:
-                        self.seq[start + i] = new_seq[i]
-                else:
-                    # new allele is shorter than ref, so delete extra bases
-                    self.seq[start + i] = ''
+        # all but the last position take one base each of new_seq (or are
+        # deleted, once it runs out); the last position takes what is left
+        n = min(len(new_seq), stop - start)
+        if self.insertions:
+            for i in range(start, stop):
+                self.insertions.pop(i, None)
+        try:
+            self.seq[start:start + n] = new_seq[:n].encode('ascii')
+        except UnicodeEncodeError:
+            for i in range(n):
+                self._set(start + i, new_seq[i])
+        self.seq[start + n:stop] = self._DELETED * (stop - start - n)
+        self._set(stop, new_seq[stop - start:])
 
     def replay_deletions(self):
         for start, stop, new_seq in self.deletions:
             self.__change__(start, stop, new_seq)
 
     def emit(self):
-        return (self.name, ''.join(self.seq))
+        if not self.insertions:
+            return (self.name, self.seq.replace(self._DELETED, b'').decode('ascii'))
+        parts = []
+        last = 0
+        for i in sorted(self.insertions):
+            parts.append(self.seq[last:i].replace(self._DELETED, b'').decode('ascii'))
+            parts.append(self.insertions[i])
+            last = i + 1
+        parts.append(self.seq[last:].replace(self._DELETED, b'').decode('ascii'))
+        return (self.name, ''.join(parts))
 
 
 def alleles_to_ambiguity(allelelist):
@@ -1376,9 +1566,13 @@ def alleles_to_ambiguity(allelelist):
     if len(allelelist) == 1:
         return allelelist[0]
     else:
-        convert = dict([(tuple(sorted(v)), k) for k, v in Bio.Data.IUPACData.ambiguous_dna_values.items() if k != 'X'])
         key = tuple(sorted(set(a.upper() for a in allelelist)))
-        return convert[key]
+        return _AMBIGUITY_CODES[key]
+
+
+_AMBIGUITY_CODES = dict(
+    (tuple(sorted(v)), k) for k, v in Bio.Data.IUPACData.ambiguous_dna_values.items() if k != 'X'
+)
 
 
 def vcfrow_parse_and_call_snps(vcfrow, samples, min_dp=0, major_cutoff=0.5, min_dp_ratio=0.0):
@@ -1437,50 +1631,253 @@ def vcfrow_parse_and_call_snps(vcfrow, samples, min_dp=0, major_cutoff=0.5, min_
             yield (c, start, stop, sample, geno)
 
 
-def vcf_to_seqs(vcfIter, chrlens, samples, min_dp=0, major_cutoff=0.5, min_dp_ratio=0.0):
-    ''' Take a VCF iterator and produce an iterator of chromosome x sample full sequences.'''
-    seqs = {}
+_IUPAC_BITS = dict((b, 1 << i) for i, b in enumerate('ACGT'))
+# ambiguity code for each bitmask of A, C, G, T (bit 0 is A)
+_IUPAC_BY_BITS = dict(
+    (sum(_IUPAC_BITS[b] for b in bases), code) for bases, code in _AMBIGUITY_CODES.items()
+    if all(b in _IUPAC_BITS for b in bases)
+)
+
+
+def _vcf_ints(strs, sep):
+    ''' Parse a list of strings of non-negative integers (joined by sep) in
+        one go, or return None if any of them is not one.
+    '''
+    joined = sep.join(strs)
+    if not strs or not joined.replace(sep, '').isdigit() or (sep + sep) in joined \
+            or joined.startswith(sep) or joined.endswith(sep):
+        return None
+    return numpy.fromstring(joined, dtype=numpy.int64, sep=sep)
+
+
+def _vcfrow_bulk_calls(vcfrow, n_samples, min_dp=0, major_cutoff=0.5, min_dp_ratio=0.0):
+    ''' Columnar version of vcfrow_parse_and_call_snps + allele choice for
+        one VCF row: the format fields of all samples are decoded together
+        and calls made with NumPy. Returns (chrom, start, stop, [(allele,
+        array of sample indices)]), or None if the row needs the per-sample
+        parser (unusual alleles or fields, or DP ratio filtering).
+    '''
+    if len(vcfrow) != 9 + n_samples or n_samples == 0:
+        return None
+    alleles = [vcfrow[3]] + [a for a in vcfrow[4].split(',') if a not in '.']
+    start = int(vcfrow[1])
+    stop = start + len(vcfrow[3]) - 1
+    format_col = vcfrow[8].split(':')
+    format_col = dict((format_col[i], i) for i in range(len(format_col)))
+    if format_col.get('GT') != 0:
+        return None
+    recs = [x.split(':') for x in vcfrow[9:]]
+
+    if len(alleles) == 1:
+        # simple invariant case
+        if min_dp_ratio:
+            return None
+        if 'DP' in format_col:
+            i = format_col['DP']
+            dps = _vcf_ints([rec[i] if len(rec) > i else '0' for rec in recs], ' ')
+            if dps is None:
+                return None
+        else:
+            dps = numpy.zeros(n_samples, dtype=numpy.int64)
+        return (vcfrow[0], start, stop, [(alleles[0], numpy.flatnonzero(dps >= min_dp))])
+
+    # variant: call the highest read count allele if it exceeds a threshold
+    n_alleles = len(alleles)
+    i = format_col.get('AD')
+    if i is None or any(len(rec) <= i or rec[i].count(',') != n_alleles - 1 for rec in recs):
+        return None
+    depths = _vcf_ints([rec[i] for rec in recs], ',')
+    if depths is None:
+        return None
+    depths = depths.reshape(n_samples, n_alleles)
+    depths = numpy.where((depths > 0) & (depths >= min_dp), depths, 0)
+    dp = depths.sum(axis=1)
+    # ties go to the greatest allele string, as in vcfrow_parse_and_call_snps
+    order = numpy.array(sorted(range(n_alleles), key=lambda j: alleles[j], reverse=True))
+    top = order[numpy.argmax(depths[:, order], axis=1)]
+    called = dp > 0
+    winner = depths[numpy.arange(n_samples), top] > dp * major_cutoff
+    calls = []
+    # an ambiguous SNP where there is no clear winner and all passing alleles are one base long
+    other, indel = 16, 32
+    bits = numpy.bitwise_or.reduce(numpy.where(depths > 0, numpy.array([
+        indel if len(a) != 1 else _IUPAC_BITS.get(a.upper(), other) for a in alleles
+    ]), 0), axis=1)
+    ambiguous = called & ~winner & (bits < indel)
+    if ambiguous.any():
+        if (bits[ambiguous] & other).any():
+            return None
+        for b in numpy.unique(bits[ambiguous]):
+            calls.append((_IUPAC_BY_BITS[b], numpy.flatnonzero(ambiguous & (bits == b))))
+        called = called & ~ambiguous
+    # a clear winner, or a mix of indels with no clear winner (force the most popular one)
+    for j in numpy.unique(top[called]):
+        calls.append((alleles[j], numpy.flatnonzero(called & (top == j))))
+    return (vcfrow[0], start, stop, calls)
+
+
+class _ConsensusBuilder(object):
+    ''' Sequences of one chromosome for many samples, built from VCF calls.
+
+        Single-base calls are written straight into a samples x positions
+        byte matrix; longer calls are kept per sample and applied, as with
+        MutableSequence, when each sequence is emitted. Calls spanning
+        several positions are applied after all single-position calls, which
+        is where MutableSequence.replay_deletions would leave them.
+    '''
+
+    def __init__(self, n_samples, length):
+        self.length = length
+        self.bases = numpy.full((n_samples, length), ord('N'), dtype=numpy.uint8)
+        self.long_calls = [{} for _ in range(n_samples)]
+        self.long_call_positions = set()
+        self.span_calls = [[] for _ in range(n_samples)]
+
+    def call(self, start, stop, allele, samples):
+        if not (1 <= start <= stop <= self.length):
+            raise IndexError("positions out of bounds")
+        if start < stop:
+            for s in samples:
+                self.span_calls[s].append((start, stop, allele))
+        elif len(allele) == 1 and ord(allele) < 128:
+            self.bases[samples, start - 1] = ord(allele)
+            if start in self.long_call_positions:
+                for s in samples:
+                    self.long_calls[s].pop(start, None)
+        else:
+            self.long_call_positions.add(start)
+            for s in samples:
+                self.long_calls[s][start] = allele
+
+    def emit(self, s):
+        seq = MutableSequence(None, 1, self.length, self.bases[s].tobytes().decode('ascii'))
+        for p, allele in self.long_calls[s].items():
+            seq.modify(p, allele)
+        for start, stop, allele in self.span_calls[s]:
+            seq.replace(start, stop, allele)
+        return seq.emit()[1]
+
+
+def _vcf_chrom_seqs(vcfIter, chrlens, samples, min_dp=0, major_cutoff=0.5, min_dp_ratio=0.0):
+    ''' Take a VCF iterator and produce an iterator of (chromosome, [one
+        full sequence per sample]), for each chromosome with any calls.
+    '''
+    builder = None
+    sample_idx = dict((s, i) for i, s in enumerate(samples))
     cur_c = None
     for vcfrow in vcfIter:
         try:
-            for c, start, stop, s, alleles in vcfrow_parse_and_call_snps(
-                vcfrow, samples, min_dp=min_dp,
-                major_cutoff=major_cutoff,
-                min_dp_ratio=min_dp_ratio
-            ):
+            row_calls = _vcfrow_bulk_calls(vcfrow, len(samples), min_dp, major_cutoff, min_dp_ratio)
+            if row_calls is None:
+                row_calls = []
+                for c, start, stop, s, alleles in vcfrow_parse_and_call_snps(
+                    vcfrow, samples, min_dp=min_dp,
+                    major_cutoff=major_cutoff,
+                    min_dp_ratio=min_dp_ratio
+                ):
+                    if len(alleles) == 1 or not all(len(a) == 1 for a in alleles):
+                        # call a single allele, or force the most popular of a mix of indels
+                        allele = alleles[0]
+                    else:
+                        # call an ambiguous SNP
+                        allele = alleles_to_ambiguity(alleles)
+                    row_calls.append((c, start, stop, [(allele, [sample_idx[s]])]))
+            else:
+                row_calls = [row_calls]
+
+            for c, start, stop, calls in row_calls:
+                if not any(len(s) for _, s in calls):
+                    continue
                 # changing chromosome?
                 if c != cur_c:
                     if cur_c is not None:
                         # dump the previous chromosome before starting a new one
-                        for s in samples:
-                            seqs[s].replay_deletions()    # because of the order of VCF rows with indels
-                            yield seqs[s].emit()
-
+                        yield (cur_c, [builder.emit(i) for i in range(len(samples))])
                     # prepare base sequences for this chromosome
                     cur_c = c
-                    for s in samples:
-                        name = len(samples) > 1 and ("%s-%s" % (c, s)) or c
-                        seqs[s] = MutableSequence(name, 1, chrlens[c])
-
-                # modify sequence for this chromosome/sample/position
-                if len(alleles) == 1:
-                    # call a single allele
-                    seqs[s].replace(start, stop, alleles[0])
-                elif all(len(a) == 1 for a in alleles):
-                    # call an ambiguous SNP
-                    seqs[s].replace(start, stop, alleles_to_ambiguity(alleles))
-                else:
-                    # mix of indels with no clear winner... force the most popular one
-                    seqs[s].replace(start, stop, alleles[0])
+                    builder = _ConsensusBuilder(len(samples), chrlens[c])
+                for allele, s in calls:
+                    builder.call(start, stop, allele, s)
         except:
             log.exception("Exception occurred while parsing VCF file.  Row: '%s'", vcfrow)
             raise
 
     # at the end, dump the last chromosome
     if cur_c is not None:
-        for s in samples:
-            seqs[s].replay_deletions()    # because of the order of VCF rows with indels
-            yield seqs[s].emit()
+        yield (cur_c, [builder.emit(i) for i in range(len(samples))])
+
+
+def _vcf_seq_name(c, s, samples):
+    return len(samples) > 1 and ("%s-%s" % (c, s)) or c
+
+
+def vcf_to_seqs(vcfIter, chrlens, samples, min_dp=0, major_cutoff=0.5, min_dp_ratio=0.0):
+    ''' Take a VCF iterator and produce an iterator of chromosome x sample full sequences.'''
+    for c, seqs in _vcf_chrom_seqs(vcfIter, chrlens, samples, min_dp, major_cutoff, min_dp_ratio):
+        for s, seq in zip(samples, seqs):
+            yield (_vcf_seq_name(c, s, samples), seq)
+
+
+def _vcf_sample_columns(inVcf, lo, hi):
+    ''' Read the rows of a VCF file, keeping only the nine fixed columns and
+        the sample columns lo..hi-1. Columns past those are never split apart.
+    '''
+    with util.file.open_or_gzopen(inVcf, 'rt') as inf:
+        for line in inf:
+            if not line.startswith('#'):
+                row = line.rstrip('\r\n').split('\t', 9 + hi)
+                yield [item.strip() for item in row[:9] + row[9 + lo:9 + hi]]
+
+
+def _vcf_chrom_seqs_for_samples(inVcf, chrlens, samples, lo, hi, min_dp=0, major_cutoff=0.5, min_dp_ratio=0.0):
+    ''' _vcf_chrom_seqs for the samples lo..hi-1 of inVcf, as a list of
+        (index of the chromosome's first row, chromosome, sequences).
+    '''
+    first_row = {}
+
+    def rows():
+        for i, row in enumerate(_vcf_sample_columns(inVcf, lo, hi)):
+            first_row.setdefault(row[0], i)
+            yield row
+
+    return [
+        (first_row[c], c, seqs)
+        for c, seqs in _vcf_chrom_seqs(rows(), chrlens, samples[lo:hi], min_dp, major_cutoff, min_dp_ratio)
+    ]
+
+
+def vcf_file_to_seqs(inVcf, chrlens, samples, min_dp=0, major_cutoff=0.5, min_dp_ratio=0.0, threads=None):
+    ''' Like vcf_to_seqs, but reading the VCF file inVcf directly. For
+        multi-sample VCFs, the sample columns are split into contiguous groups
+        that are called in separate processes (up to threads at a time),
+        each reading only its own columns; output order is the same as
+        vcf_to_seqs.
+    '''
+    workers = min(util.misc.sanitize_thread_count(threads), len(samples))
+    if workers <= 1:
+        for name, seq in vcf_to_seqs(util.file.read_tabfile(inVcf), chrlens, samples, min_dp, major_cutoff, min_dp_ratio):
+            yield (name, seq)
+        return
+
+    bounds = [(len(samples) * i // workers, len(samples) * (i + 1) // workers) for i in range(workers)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            functools.partial(_vcf_chrom_seqs_for_samples, inVcf, chrlens, samples,
+                              min_dp=min_dp, major_cutoff=major_cutoff, min_dp_ratio=min_dp_ratio),
+            *zip(*bounds)))
+
+    # a chromosome with no calls in one group of samples is all N's for them
+    chroms = {}
+    for group, result in enumerate(results):
+        for first_row, c, seqs in result:
+            chroms.setdefault(c, [first_row, {}])[1][group] = seqs
+            chroms[c][0] = min(chroms[c][0], first_row)
+    for c in sorted(chroms, key=lambda c: chroms[c][0]):
+        group_seqs = chroms[c][1]
+        for group, (lo, hi) in enumerate(bounds):
+            seqs = group_seqs.get(group) or ['N' * chrlens[c]] * (hi - lo)
+            for s, seq in zip(samples[lo:hi], seqs):
+                yield (_vcf_seq_name(c, s, samples), seq)
 
 
 def parser_vcf_to_fasta(parser=argparse.ArgumentParser()):
@@ -1531,7 +1928,7 @@ def parser_vcf_to_fasta(parser=argparse.ArgumentParser()):
         help="output sequence names (default: reference names in VCF file)",
         default=[]
     )
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None)))
     util.cmd.attach_main(parser, main_vcf_to_fasta)
     return parser
 
@@ -1551,22 +1948,19 @@ def main_vcf_to_fasta(args):
         chrlens = dict(vcf.chrlens())
         samples = vcf.samples()
 
-    assert len(
-        samples
-    ) == 1, """Multiple sample columns were found in the intermediary VCF file
-        of the refine_assembly step, suggesting multiple sample names are present
-        upstream in the BAM file. Please correct this so there is only one sample in the BAM file."""
+    assert len(samples) == 1 or not args.name, "--name cannot be used with multi-sample VCF files"
 
     with open(args.outFasta, 'wt') as outf:
         chr_idx = 0
         for chr_idx, (header, seq) in enumerate(
-            vcf_to_seqs(
-                util.file.read_tabfile(args.inVcf),
+            vcf_file_to_seqs(
+                args.inVcf,
                 chrlens,
                 samples,
                 min_dp=args.min_dp,
                 major_cutoff=args.major_cutoff,
-                min_dp_ratio=args.min_dp_ratio
+                min_dp_ratio=args.min_dp_ratio,
+                threads=args.threads
             )
         ):
             if args.trim_ends:
@@ -1584,6 +1978,160 @@ def main_vcf_to_fasta(args):
 __commands__.append(('vcf_to_fasta', parser_vcf_to_fasta))
 
 
+def _pileup_allele_counts(inBam, min_base_quality=15):
+    ''' One pass over the pileup of an aligned BAM file. Yields (chrom,
+        1-based position, base counts, indel counts) for each covered
+        position, where indel counts are keyed by ('+', inserted bases) or
+        ('-', number of deleted bases) for indels following the position,
+        and base counts include one entry per read with a base here
+        (key None for those that also carry an indel).
+        Unmapped, secondary, QC-failed and duplicate reads are ignored,
+        as are bases below min_base_quality.
+    '''
+    with pysam.AlignmentFile(inBam, 'rb') as bam:
+        for column in bam.pileup(
+            stepper='all', ignore_overlaps=False, ignore_orphans=False,
+            max_depth=2**31 - 1, min_base_quality=0
+        ):
+            column.set_min_base_quality(min_base_quality)
+            bases = {}
+            indels = {}
+            for allele in column.get_query_sequences(add_indels=True):
+                base = allele[:1].upper()
+                if base not in 'ACGT' or not base:
+                    # N's, deletions ('*') and reference skips ('<', '>')
+                    continue
+                bases[base] = bases.get(base, 0) + 1
+                if len(allele) > 1:
+                    n = allele[2:].lstrip('0123456789')
+                    key = ('+', n.upper()) if allele[1] == '+' else ('-', len(n))
+                    indels[key] = indels.get(key, 0) + 1
+            if bases:
+                yield (column.reference_name, column.reference_pos + 1, bases, indels)
+
+
+def _pileup_vcf_rows(chrom, pos, ref, bases, indels):
+    ''' VCF rows (GT:AD:DP for one sample) describing the allele counts of
+        one position: one row for bases and, if any read has an indel
+        following this position, one row for the indels.
+    '''
+    dp = sum(bases.values())
+    ref_base = ref[pos - 1].upper()
+    alts = sorted(b for b in bases if b != ref_base)
+    depths = [bases.get(ref_base, 0)] + [bases[b] for b in alts]
+    rows = [[
+        chrom, str(pos), '.', ref_base, ','.join(alts) or '.', '.', '.', 'DP=%d' % dp, 'GT:AD:DP',
+        '%d:%s:%d' % (depths.index(max(depths)), ','.join(map(str, depths)), dp)
+    ]]
+    if indels:
+        max_del = max([n for op, n in indels if op == '-'] or [0])
+        ref_allele = ref[pos - 1:pos + max_del]
+        alts = []
+        for op, n in sorted(indels):
+            if op == '+':
+                alts.append(ref_allele[0] + n + ref_allele[1:])
+            else:
+                alts.append(ref_allele[0] + ref_allele[1 + n:])
+        depths = [dp - sum(indels.values())] + [indels[k] for k in sorted(indels)]
+        rows.append([
+            chrom, str(pos), '.', ref_allele, ','.join(alts), '.', '.', 'DP=%d' % dp, 'GT:AD:DP',
+            '%d:%s:%d' % (depths.index(max(depths)), ','.join(map(str, depths)), dp)
+        ])
+    return rows
+
+
+def pileup_consensus(
+    inBam,
+    refFasta,
+    outFasta,
+    outVcf=None,
+    min_coverage=3,
+    major_cutoff=0.5,
+    chr_names=None,
+    min_base_quality=15,
+    sample_name=None
+):
+    ''' Call a consensus sequence for each chromosome of refFasta from one
+        pileup pass over inBam (reads aligned to refFasta), counting bases
+        and indels at each position and applying the same min_coverage and
+        major_cutoff rules as vcf_to_fasta. Indels are applied to the
+        consensus only where the indel allele itself is called. Runs of N's
+        at the ends are trimmed and chromosomes without any calls are left
+        out, as refine_assembly does with GATK calls. If outVcf is given,
+        the allele counts of all covered positions are also written there
+        (bgzipped and indexed if it ends with .gz), under sample_name or
+        else the one sample named in the read groups of inBam.
+    '''
+    assert min_coverage >= 0
+    assert 0.0 <= major_cutoff < 1.0
+    chr_names = chr_names or []
+    with open(refFasta, 'rt') as inf:
+        refs = [(_fasta_id(title), seq) for title, seq in SimpleFastaParser(inf)]
+    ref_seqs = dict(refs)
+    if not sample_name:
+        with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as bam:
+            sample_names = set(rg.get('SM') for rg in bam.header.to_dict().get('RG', []))
+        sample_name = sample_names.pop() if len(sample_names) == 1 and None not in sample_names else 'sample'
+
+    vcf_rows = util.file.mkstempfname('.vcf') if outVcf else None
+    calls = {}
+    with open(vcf_rows or os.devnull, 'wt') as vcf_outf:
+        for c, pos, bases, indels in _pileup_allele_counts(inBam, min_base_quality=min_base_quality):
+            if c not in calls:
+                calls[c] = MutableSequence(c, 1, len(ref_seqs[c])), []
+            seq, indel_calls = calls[c]
+            for i, row in enumerate(_pileup_vcf_rows(c, pos, ref_seqs[c], bases, indels)):
+                vcf_outf.write('\t'.join(row) + '\n')
+                for _, _, _, _, alleles in vcfrow_parse_and_call_snps(
+                    row, [sample_name], min_dp=min_coverage, major_cutoff=major_cutoff
+                ):
+                    if i == 0:
+                        seq.modify(pos, alleles_to_ambiguity(alleles))
+                    elif alleles[0] != row[3]:
+                        # an indel called over the reads without one
+                        indel_calls.append((pos, len(alleles[0]) - len(row[3]), alleles[0]))
+
+    with open(outFasta, 'wt') as outf:
+        chr_idx = 0
+        for c, _ in refs:
+            if c not in calls:
+                continue
+            seq, indel_calls = calls[c]
+            # insertions go after the base called at their position, not the reference base
+            for pos, delta, allele in indel_calls:
+                if delta > 0:
+                    seq.modify(pos, seq.get(pos) + allele[1:1 + delta])
+            for pos, delta, allele in indel_calls:
+                if delta < 0:
+                    seq.replace(pos + 1, pos - delta, '')
+            header = chr_names[chr_idx % len(chr_names)] if chr_names else c
+            for line in util.file.fastaMaker([(header, seq.emit()[1].strip('Nn'))]):
+                outf.write(line)
+            chr_idx += 1
+
+    if outVcf:
+        tmpVcf = outVcf[:-3] if outVcf.endswith('.gz') else outVcf
+        with open(tmpVcf, 'wt') as outf:
+            outf.write('##fileformat=VCFv4.1\n')
+            outf.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Read Depth">\n')
+            outf.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+            outf.write('##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">\n')
+            outf.write('##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">\n')
+            for c, seq in refs:
+                outf.write('##contig=<ID=%s,length=%d>\n' % (c, len(seq)))
+            outf.write('##reference=file://%s\n' % refFasta)
+            header = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT', sample_name]
+            outf.write('#' + '\t'.join(header) + '\n')
+            with open(vcf_rows, 'rt') as inf:
+                shutil.copyfileobj(inf, outf)
+        os.unlink(vcf_rows)
+        if outVcf.endswith('.gz'):
+            pysam.tabix_compress(tmpVcf, outVcf, force=True)
+            pysam.tabix_index(outVcf, force=True, preset='vcf')
+            os.unlink(tmpVcf)
+    return 0
+
+
 def parser_trim_fasta(parser=argparse.ArgumentParser()):
     parser.add_argument("inFasta", help="Input fasta file")
     parser.add_argument("outFasta", help="Output (trimmed) fasta file")
@@ -1598,8 +2146,8 @@ def trim_fasta(inFasta, outFasta):
     '''
     with open(outFasta, 'wt') as outf:
         with open(inFasta, 'rt') as inf:
-            for record in Bio.SeqIO.parse(inf, 'fasta'):
-                for line in util.file.fastaMaker([(record.id, str(record.seq).strip('Nn'))]):
+            for title, seq in SimpleFastaParser(inf):
+                for line in util.file.fastaMaker([(_fasta_id(title), seq.strip('Nn'))]):
                     outf.write(line)
     log.info("done")
     return 0
@@ -1608,21 +2156,45 @@ def trim_fasta(inFasta, outFasta):
 __commands__.append(('trim_fasta', parser_trim_fasta))
 
 
+def _fasta_id(title):
+    ''' The record id Bio.SeqIO would give a FASTA title line. '''
+    return title.split(None, 1)[0] if title.strip() else ''
+
+
 def deambig_base(base):
     ''' Take a single base (possibly a IUPAC ambiguity code) and return a random
         non-ambiguous base from among the possibilities '''
     return random.choice(Bio.Data.IUPACData.ambiguous_dna_values[base.upper()])
 
 
-def deambig_fasta(inFasta, outFasta):
+def deambig_seq(seq, rng=None):
+    ''' Like deambig_base, for a whole sequence at once: returns seq in upper
+        case with every ambiguity code replaced by a random base from among its
+        possibilities, drawn from rng (a numpy.random.RandomState).
+        Raises KeyError for any character that is not an IUPAC DNA code.
+    '''
+    rng = rng or numpy.random
+    seq = numpy.frombuffer(bytearray(str(seq).upper(), 'ascii'), dtype=numpy.uint8)
+    counts = numpy.bincount(seq, minlength=256)
+    for c in numpy.flatnonzero(counts):
+        bases = Bio.Data.IUPACData.ambiguous_dna_values[chr(c)]
+        if len(bases) > 1:
+            mask = seq == c
+            choices = numpy.frombuffer(bytearray(bases, 'ascii'), dtype=numpy.uint8)
+            seq[mask] = choices[rng.randint(len(choices), size=counts[c])]
+    return seq.tobytes().decode('ascii')
+
+
+def deambig_fasta(inFasta, outFasta, random_seed=None):
     ''' Take input sequences (fasta) and replace any ambiguity bases with a
         random unambiguous base from among the possibilities described by the ambiguity
         code.  Write output to fasta file.
     '''
+    rng = numpy.random.RandomState(random_seed)
     with util.file.open_or_gzopen(outFasta, 'wt') as outf:
         with util.file.open_or_gzopen(inFasta, 'rt') as inf:
-            for record in Bio.SeqIO.parse(inf, 'fasta'):
-                for line in util.file.fastaMaker([(record.id, ''.join(map(deambig_base, str(record.seq))))]):
+            for title, seq in SimpleFastaParser(inf):
+                for line in util.file.fastaMaker([(_fasta_id(title), deambig_seq(seq, rng))]):
                     outf.write(line)
     return 0
 
@@ -1630,6 +2202,13 @@ def deambig_fasta(inFasta, outFasta):
 def parser_deambig_fasta(parser=argparse.ArgumentParser()):
     parser.add_argument("inFasta", help="Input fasta file")
     parser.add_argument("outFasta", help="Output fasta file")
+    parser.add_argument(
+        "--randomSeed",
+        dest="random_seed",
+        type=int,
+        default=None,
+        help="Seed for choosing bases, for reproducible output (default: unseeded)"
+    )
     util.cmd.common_args(parser, (('loglevel', None), ('version', None)))
     util.cmd.attach_main(parser, deambig_fasta, split_args=True)
     return parser
@@ -25,6 +25,7 @@ import arrow
 import util.cmd
 import util.file
 import util.misc
+import read_utils
 import tools.picard
 from util.illumina_indices import IlluminaIndexReference, IlluminaBarcodeHelper
 
@@ -922,7 +923,8 @@ class SampleSheet(object):
 
 def miseq_fastq_to_bam(outBam, sampleSheet, inFastq1, inFastq2=None, runInfo=None,
                        sequencing_center=None,
-                       JVMmemory=tools.picard.FastqToSamTool.jvmMemDefault):
+                       JVMmemory=tools.picard.FastqToSamTool.jvmMemDefault,
+                       threads=None):
     ''' Convert fastq read files to a single bam file. Fastq file names must conform
         to patterns emitted by Miseq machines. Sample metadata must be provided
         in a SampleSheet.csv that corresponds to the fastq filename. Specifically,
@@ -977,14 +979,9 @@ def miseq_fastq_to_bam(outBam, sampleSheet, inFastq1, inFastq2=None, runInfo=Non
         flowcell = flowcell[:5]
     picardOpts['READ_GROUP_NAME'] = flowcell
 
-    # run Picard
-    picard = tools.picard.FastqToSamTool()
-    picard.execute(inFastq1,
-                   inFastq2,
-                   sampleName,
-                   outBam,
-                   picardOptions=picard.dict_to_picard_opts(picardOpts),
-                   JVMmemory=JVMmemory)
+    # convert to unaligned bam, with the same read group Picard FastqToSam would write
+    rg = read_utils.fastq_to_bam_read_group(sampleName, tools.picard.PicardTools.dict_to_picard_opts(picardOpts))
+    read_utils.fastq_to_ubam(inFastq1, inFastq2, outBam, {'RG': [rg]}, threads=threads)
     return 0
 
 
@@ -1000,8 +997,8 @@ def parser_miseq_fastq_to_bam(parser=argparse.ArgumentParser()):
         help='Name of your sequencing center (default is the sequencing machine ID from the RunInfo.xml)')
     parser.add_argument('--JVMmemory',
                         default=tools.picard.FastqToSamTool.jvmMemDefault,
-                        help='JVM virtual memory size (default: %(default)s)')
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+                        help='JVM virtual memory size (unused; retained for compatibility)')
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, miseq_fastq_to_bam, split_args=True)
     return parser
 
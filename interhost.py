@@ -12,6 +12,7 @@ import logging
 import os
 import array
 import bisect
+import concurrent.futures
 import json
 from itertools import permutations
 from collections import OrderedDict, Sequence
@@ -26,7 +27,9 @@ except ImportError:  # for Py3
 
 # third-party libraries
 import Bio.AlignIO
+import Bio.Seq
 from Bio import SeqIO
+import numpy as np
 
 # module-specific
 import tools.muscle
@@ -34,6 +37,7 @@ import tools.snpeff
 import tools.mafft
 import util.cmd
 import util.file
+import util.misc
 import util.vcf
 
 log = logging.getLogger(__name__)
@@ -64,9 +68,12 @@ class CoordMapper(DictMixin):
             a pair of real bases in between.
     """
 
-    def __init__(self, alignerTool=tools.muscle.MuscleTool):
+    def __init__(self, alignerTool=tools.muscle.MuscleTool, lazy=False):
         """ The two genomes are described by fasta files with the same number of
             chromosomes, and corresponding chromosomes must be in same order.
+            If lazy, the mapper between two aligned sequences is only built the
+            first time it is used, so that loading N sequences costs O(N)
+            rather than O(N^2) when only a few of the pairs are ever mapped.
         """
 
         # {
@@ -77,6 +84,7 @@ class CoordMapper(DictMixin):
         self.chrMaps = OrderedDict()
         self.chrMapsUngapped = OrderedDict()
         self.alignerTool = alignerTool()
+        self.lazy = lazy
 
     def __getitem__(self, key):
         return self.chrMaps[key]
@@ -154,6 +162,21 @@ class CoordMapper(DictMixin):
             toPos = toPos[0] if side < 0 else toPos[1]
         return (toChrom, toPos)
 
+    def mapChrMany(self, fromChrom, toChrom, fromPositions, side=0):
+        """ Like mapChr, but mapping a list of positions on seq "fromChrom" at once.
+            Returns (toChrom, [toPos, ...]).
+        """
+        if fromChrom not in self.chrMaps:
+            raise KeyError("chr '%s' not found in CoordMapper relation map" % fromChrom)
+        if toChrom not in self.chrMaps[fromChrom].keys():
+            raise KeyError("chr '%s' not found in CoordMapper relation map" % toChrom)
+
+        toPositions = self.chrMaps[fromChrom][toChrom].map_many(fromPositions, 0)
+        if side != 0:
+            toPositions = [(toPos[0] if side < 0 else toPos[1]) if isinstance(toPos, Sequence) else toPos
+                           for toPos in toPositions]
+        return (toChrom, toPositions)
+
     def load_alignments(self, aligned_files, a_idx=None, b_idx=None):
         """ Loads aligned sequences into a CoordMapper instance.
             Any number of sequences >1 may be read in.
@@ -168,57 +191,86 @@ class CoordMapper(DictMixin):
         """
         for alignOutFileName in aligned_files:
             with open(alignOutFileName, 'rt') as alignOutFile:
-                seqs = list(SeqIO.parse(alignOutFile, 'fasta'))
-
-                # if len(list(seqs)) <2:
-                #    raise Exception("Each aligned input file must contain >1 sequence.")
-
-                # if mapping between specific sequences is specified
-                if a_idx is not None and b_idx is not None:
-                    assert a_idx >= 0 and b_idx >= 0
-                    assert a_idx < len(seqs) and b_idx < len(seqs)
-
-                    mapper = CoordMapper2Seqs(seqs[a_idx].seq, seqs[b_idx].seq)
-                    self.chrMaps.setdefault(seqs[a_idx].id, OrderedDict())
-                    mapDict = OrderedDict()
-                    mapDict[seqs[b_idx].id] = mapper
-                    self.chrMaps[seqs[a_idx].id] = mapDict
-
-                    mapper = CoordMapper2Seqs(seqs[b_idx].seq, seqs[a_idx].seq)
-                    self.chrMaps.setdefault(seqs[b_idx].id, OrderedDict())
-                    mapDict = OrderedDict()
-                    mapDict[seqs[a_idx].id] = mapper
-                    self.chrMaps[seqs[b_idx].id] = mapDict
-                # otherwise, map all possible pairwise permutations
-                else:
-                    for (seq1, seq2) in permutations(seqs, 2):
-                        if (seq1.id == seq2.id):
-                            raise KeyError("duplicate sequence names '%s', '%s'" % (seq1.id, seq2.id))
-
-                        self.chrMaps.setdefault(seq1.id, OrderedDict())
-                        self.chrMapsUngapped.setdefault(seq1.id, OrderedDict())
-                        # if the sequence we are mapping onto is already in the map
-                        # raise an error
-                        # (could occur if same sequence is read in from multiple files)
-                        if (seq2.id in self.chrMaps[seq1.id]):
+                self.load_aligned_seqs(list(SeqIO.parse(alignOutFile, 'fasta')), a_idx, b_idx)
+
+    def load_aligned_seqs(self, seqs, a_idx=None, b_idx=None):
+        """ Like load_alignments, but for a list of aligned SeqRecords that
+            have already been read in (all of them from one alignment).
+        """
+        # if len(list(seqs)) <2:
+        #    raise Exception("Each aligned input file must contain >1 sequence.")
+
+        # if mapping between specific sequences is specified
+        if a_idx is not None and b_idx is not None:
+            assert a_idx >= 0 and b_idx >= 0
+            assert a_idx < len(seqs) and b_idx < len(seqs)
+
+            mapper = CoordMapper2Seqs(seqs[a_idx].seq, seqs[b_idx].seq)
+            self.chrMaps.setdefault(seqs[a_idx].id, OrderedDict())
+            mapDict = OrderedDict()
+            mapDict[seqs[b_idx].id] = mapper
+            self.chrMaps[seqs[a_idx].id] = mapDict
+
+            mapper = CoordMapper2Seqs(seqs[b_idx].seq, seqs[a_idx].seq)
+            self.chrMaps.setdefault(seqs[b_idx].id, OrderedDict())
+            mapDict = OrderedDict()
+            mapDict[seqs[a_idx].id] = mapper
+            self.chrMaps[seqs[b_idx].id] = mapDict
+        # map all possible pairwise permutations, building each mapper when first used
+        elif self.lazy:
+            seqs_by_id = OrderedDict()
+            for seq in seqs:
+                if seq.id in seqs_by_id:
+                    raise KeyError("duplicate sequence names '%s', '%s'" % (seq.id, seq.id))
+                if len(seq) != len(seqs[0]):
+                    raise Exception('CoordMapper2Seqs: sequences must be same length.')
+                seqs_by_id[seq.id] = seq
+            if len(seqs) < 2:
+                return
+            for seq in seqs:
+                if seq.id in self.chrMaps:
+                    # (could occur if same sequence is read in from multiple files)
+                    for otherId in seqs_by_id:
+                        if otherId != seq.id and otherId in self.chrMaps[seq.id]:
                             raise KeyError(
-                                "duplicate sequence name '%s' already in chrMap for %s" % (seq2.id, seq1.id))
-
-                        mapper = CoordMapper2Seqs(seq1.seq, seq2.seq)
-                        mapDict = self.chrMaps[seq1.id]
-                        mapDict[seq2.id] = mapper
-                        self.chrMaps[seq1.id] = mapDict
-
-                        # ungapped strings
-                        #longerSeqLen = max( len(seq1.seq.ungap("-")), len(seq2.seq.ungap("-")) )
-                        #seq1UngappedPadded = str(seq1.seq.ungap("-")).ljust(longerSeqLen, "N")
-                        #seq2UngappedPadded = str(seq2.seq.ungap("-")).ljust(longerSeqLen, "N")
-                        #mapper = CoordMapper2Seqs(seq1UngappedPadded, seq2UngappedPadded)
-                        #mapDict = self.chrMapsUngapped[seq1.id]
-                        #mapDict[seq2.id] = mapper
-                        #self.chrMapsUngapped[seq1.id] = mapDict
-
-    def align_and_load_sequences(self, unaligned_fasta_files, aligner=None):
+                                "duplicate sequence name '%s' already in chrMap for %s" % (otherId, seq.id))
+                self.chrMaps.setdefault(seq.id, LazyMapperDict()).add_alignment(seq, seqs_by_id)
+                self.chrMapsUngapped.setdefault(seq.id, OrderedDict())
+        # otherwise, map all possible pairwise permutations
+        else:
+            for (seq1, seq2) in permutations(seqs, 2):
+                if (seq1.id == seq2.id):
+                    raise KeyError("duplicate sequence names '%s', '%s'" % (seq1.id, seq2.id))
+
+                self.chrMaps.setdefault(seq1.id, OrderedDict())
+                self.chrMapsUngapped.setdefault(seq1.id, OrderedDict())
+                # if the sequence we are mapping onto is already in the map
+                # raise an error
+                # (could occur if same sequence is read in from multiple files)
+                if (seq2.id in self.chrMaps[seq1.id]):
+                    raise KeyError(
+                        "duplicate sequence name '%s' already in chrMap for %s" % (seq2.id, seq1.id))
+
+                mapper = CoordMapper2Seqs(seq1.seq, seq2.seq)
+                mapDict = self.chrMaps[seq1.id]
+                mapDict[seq2.id] = mapper
+                self.chrMaps[seq1.id] = mapDict
+
+                # ungapped strings
+                #longerSeqLen = max( len(seq1.seq.ungap("-")), len(seq2.seq.ungap("-")) )
+                #seq1UngappedPadded = str(seq1.seq.ungap("-")).ljust(longerSeqLen, "N")
+                #seq2UngappedPadded = str(seq2.seq.ungap("-")).ljust(longerSeqLen, "N")
+                #mapper = CoordMapper2Seqs(seq1UngappedPadded, seq2UngappedPadded)
+                #mapDict = self.chrMapsUngapped[seq1.id]
+                #mapDict[seq2.id] = mapper
+                #self.chrMapsUngapped[seq1.id] = mapDict
+
+    def align_and_load_sequences(self, unaligned_fasta_files, aligner=None, threads=1):
+        """ Align each chromosome across the unaligned_fasta_files and load the
+            alignments. The chromosomes are aligned one at a time unless threads
+            is more than 1 (or None, for all CPUs), in which case up to that many
+            run at once in threads, so the aligner must be safe to run that way.
+        """
         aligner = self.alignerTool if aligner is None else aligner
 
         # transpose
@@ -226,11 +278,20 @@ class CoordMapper(DictMixin):
         if not per_chr_fastas:
             raise Exception('no input sequences')
         # align
-        alignOutFileNames = []
+        alignOutFileNames = [util.file.mkstempfname('.fasta') for alignInFileName in per_chr_fastas]
+        work = [alignment_work(alignInFileName) for alignInFileName in per_chr_fastas]
+        workers, _ = split_thread_budget(work, threads)
+        if workers <= 1:
+            for alignInFileName, alignOutFileName in zip(per_chr_fastas, alignOutFileNames):
+                aligner.execute(alignInFileName, alignOutFileName)
+        else:
+            # up to threads chromosomes at a time, largest first
+            order = sorted(range(len(work)), key=lambda i: work[i], reverse=True)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(aligner.execute,
+                                  [per_chr_fastas[i] for i in order],
+                                  [alignOutFileNames[i] for i in order]))
         for alignInFileName in per_chr_fastas:
-            alignOutFileName = util.file.mkstempfname('.fasta')
-            aligner.execute(alignInFileName, alignOutFileName)
-            alignOutFileNames.append(alignOutFileName)
             os.unlink(alignInFileName)
         # read in
         self.load_alignments(alignOutFileNames)
@@ -239,6 +300,50 @@ class CoordMapper(DictMixin):
             os.unlink(f)
 
 
+class LazyMapperDict(DictMixin):
+    """ The {other seq id: CoordMapper2Seqs} map of one aligned sequence in a
+        lazy CoordMapper. Each mapper is built the first time it is looked up.
+    """
+
+    def __init__(self):
+        self.alignments = []    # [(this aligned seq, {seq id: aligned seq} of the whole alignment)]
+        self.mappers = {}
+
+    def add_alignment(self, seq, seqs_by_id):
+        self.alignments.append((seq, seqs_by_id))
+
+    def __getitem__(self, key):
+        if key not in self.mappers:
+            for seq, seqs_by_id in self.alignments:
+                if key != seq.id and key in seqs_by_id:
+                    self.mappers[key] = CoordMapper2Seqs(seq.seq, seqs_by_id[key].seq)
+                    break
+            else:
+                raise KeyError(key)
+        return self.mappers[key]
+
+    def __setitem__(self, key, value):
+        raise TypeError("'%s' object does not support item assignment" % self.__class__.__name__)
+
+    def __delitem__(self, key):
+        raise TypeError("'%s' object does not support item deletion" % self.__class__.__name__)
+
+    def __len__(self):
+        return sum(len(seqs_by_id) - 1 for seq, seqs_by_id in self.alignments)
+
+    def __iter__(self):
+        for seq, seqs_by_id in self.alignments:
+            for key in seqs_by_id:
+                if key != seq.id:
+                    yield key
+
+    def __contains__(self, key):
+        return any(key != seq.id and key in seqs_by_id for seq, seqs_by_id in self.alignments)
+
+    def keys(self):
+        return list(self)
+
+
 class CoordMapper2Seqs(object):
     """ Map 1-based coordinates between two aligned sequences.
         Result is a coordinate or an interval, as described in CoordMapper main
@@ -264,35 +369,36 @@ class CoordMapper2Seqs(object):
     #     requires binary search in one of the arrays.
     #     Total space required, in bytes, is const + 8 * (number of indels).
     #     Time for a map in either direction is O(log(number of indels)).
+    #     The arrays are built in one pass over the alignment columns with numpy:
+    #     a pair is kept if it is the first pair of aligned real bases or if the
+    #     column before it is not such a pair; the last pair is always kept.
     #
 
     def __init__(self, seq0, seq1):
-        self.mapArrays = [array.array('I'), array.array('I')]
-        baseCount0 = 0  # Number of real bases in seq0 up to and including cur pos
-        baseCount1 = 0  # Number of real bases in seq1 up to and including cur pos
-        beforeStart = True  # Haven't yet reached first pair of aligned real bases
-        gapSinceLast = False  # Have encounted a gap since last pair in mapArrays
-        for b0, b1 in zip_longest(seq0, seq1):
-            if b0 is None or b1 is None:
-                raise Exception('CoordMapper2Seqs: sequences must be same length.')
-            realBase0 = b0 != '-'
-            realBase1 = b1 != '-'
-            baseCount0 += realBase0
-            baseCount1 += realBase1
-            if realBase0 and realBase1:
-                if beforeStart or gapSinceLast:
-                    self.mapArrays[0].append(baseCount0)
-                    self.mapArrays[1].append(baseCount1)
-                    gapSinceLast = False
-                    beforeStart = False
-                finalPos0 = baseCount0  # Last pair of aligned real bases so far
-                finalPos1 = baseCount1  # Last pair of aligned real bases so far
-            else:
-                gapSinceLast = True
-        if len(self.mapArrays[0]) > 0:
-            if self.mapArrays[0][-1] != finalPos0:
-                self.mapArrays[0].append(finalPos0)
-                self.mapArrays[1].append(finalPos1)
+        real0 = self._real_bases(seq0)
+        real1 = self._real_bases(seq1)
+        if len(real0) != len(real1):
+            raise Exception('CoordMapper2Seqs: sequences must be same length.')
+        baseCount0 = np.cumsum(real0)  # Number of real bases in seq0 up to and including each pos
+        baseCount1 = np.cumsum(real1)  # Number of real bases in seq1 up to and including each pos
+        both = real0 & real1
+        pairs = np.flatnonzero(both)  # Columns with a pair of aligned real bases
+        if len(pairs):
+            keep = np.ones(len(pairs), dtype=bool)
+            keep[1:] = ~both[pairs[1:] - 1]
+            keep[-1] = True
+            pairs = pairs[keep]
+        self.mapArrays = [array.array('I', baseCount0[pairs].tolist()), array.array('I', baseCount1[pairs].tolist())]
+        self._npMapArrays = [np.array(self.mapArrays[0], dtype=np.int64), np.array(self.mapArrays[1], dtype=np.int64)]
+
+    @staticmethod
+    def _real_bases(seq):
+        """ Boolean array that is True at each non-gap position of an aligned sequence """
+        if isinstance(seq, (Bio.Seq.Seq, Bio.Seq.MutableSeq)):
+            seq = str(seq)
+        elif not isinstance(seq, str):
+            seq = ''.join(seq)
+        return np.frombuffer(seq.encode('ascii', 'replace'), dtype=np.uint8) != ord('-')
 
     def __call__(self, fromPos, fromWhich):
         """ fromPos: 1-based coordinate
@@ -321,6 +427,40 @@ class CoordMapper2Seqs(object):
                 result = min(prevPlusOffset, nextToPos - 1)
         return result
 
+    def map_many(self, fromPositions, fromWhich):
+        """ Same as [self(fromPos, fromWhich) for fromPos in fromPositions], but
+            mapping all of the positions at once. """
+        fromPositions = np.asarray(fromPositions)
+        if len(fromPositions) == 0:
+            return []
+        if len(self.mapArrays[0]) == 0:
+            raise Exception('CoordMapper2Seqs: no aligned bases.')
+        if fromPositions.dtype.kind not in 'iu':
+            if fromPositions.dtype.kind != 'f' or np.any(fromPositions != np.floor(fromPositions)):
+                bad = [p for p in fromPositions.tolist() if p != int(p)][:1] or fromPositions.tolist()[:1]
+                raise TypeError('CoordMapper2Seqs: pos %s is not an integer' % bad[0])
+            fromPositions = fromPositions.astype(np.int64)
+        fromArray = self._npMapArrays[fromWhich]
+        toArray = self._npMapArrays[1 - fromWhich]
+        inside = (fromPositions >= fromArray[0]) & (fromPositions < fromArray[-1])
+        insertInd = np.clip(np.searchsorted(fromArray, fromPositions, side='right'), 1, len(fromArray) - 1)
+        prevPlusOffset = toArray[insertInd - 1] + (fromPositions - fromArray[insertInd - 1])
+        nextToPosMinus1 = toArray[insertInd] - 1
+        interval = (fromPositions == fromArray[insertInd] - 1) & (prevPlusOffset < nextToPosMinus1)
+        single = np.minimum(prevPlusOffset, nextToPosMinus1)
+
+        results = []
+        for pos, isInside, isInterval, left, right, result in zip(
+                fromPositions.tolist(), inside.tolist(), interval.tolist(),
+                prevPlusOffset.tolist(), nextToPosMinus1.tolist(), single.tolist()):
+            if isInside:
+                results.append([left, right] if isInterval else result)
+            elif pos == fromArray[-1]:
+                results.append(int(toArray[-1]))
+            else:
+                results.append(None)
+        return results
+
 # ========== snpEff annotation of VCF files ==================
 
 
@@ -464,13 +604,18 @@ def multichr_mafft(args):
     # reorder the data into new FASTA files, where each FASTA file has only variants of its respective chromosome
     transposedFiles = transposeChromosomeFiles(args.inFastas, args.sampleRelationFile, args.sampleNameListFile)
 
+    # align several chromosomes at a time, splitting the threads between them by their size
+    work = [alignment_work(filePath) for filePath in transposedFiles]
+    workers, jobThreads = split_thread_budget(work, args.threads)
+
     # since the FASTA files are
+    jobs = []
     for idx, filePath in enumerate(transposedFiles):
 
         # execute MAFFT alignment. The input file is passed within a list, since argparse ordinarily
         # passes input files in this way, and the MAFFT tool expects lists,
         # but in this case we are creating the input file ourselves
-        tools.mafft.MafftTool().execute(
+        jobs.append(dict(
             inFastas=[os.path.abspath(filePath)],
             outFile=os.path.join(absoluteOutDirectory, "{}_{}.fasta".format(prefix, idx + 1)),
             localpair=args.localpair,
@@ -482,11 +627,59 @@ def multichr_mafft(args):
             verbose=args.verbose,
             outputAsClustal=args.outputAsClustal,
             maxiters=args.maxiters,
-            threads=args.threads)
+            threads=jobThreads[idx]))
+
+    if workers <= 1:
+        for job in jobs:
+            _execute_mafft(job)
+    else:
+        # MafftTool changes the working directory while it runs, so each alignment
+        # needs its own process; the largest ones are started first
+        order = sorted(range(len(jobs)), key=lambda i: work[i], reverse=True)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_execute_mafft, [jobs[i] for i in order]))
 
     return 0
 
 
+def _execute_mafft(kwargs):
+    return tools.mafft.MafftTool().execute(**kwargs)
+
+
+def alignment_work(inFasta):
+    ''' Estimated work of a multiple alignment of the sequences in inFasta:
+        the number of sequences times the length of the longest one.
+    '''
+    with util.file.open_or_gzopen(inFasta, 'r') as inf:
+        lengths = [len(seq) for seq in SeqIO.parse(inf, 'fasta')]
+    return len(lengths) * max(lengths or [0])
+
+
+def split_thread_budget(work, threads=None):
+    ''' Split a budget of threads between jobs with the given estimated work.
+        Returns (number of jobs to run at a time, [threads for each job]).
+        The threads of any jobs running at once never add up to more than
+        the budget: if there are more jobs than threads, each gets one;
+        otherwise all of them run at once, each with one thread plus a share
+        of the rest proportional to its work (by largest remainder, so that
+        the whole budget is used).
+    '''
+    threads = util.misc.sanitize_thread_count(threads)
+    if len(work) >= threads:
+        return (threads, [1] * len(work))
+    total = sum(work)
+    weights = work if total else [1] * len(work)
+    total = sum(weights)
+    extra = threads - len(work)
+    shares = [extra * w / float(total) for w in weights]
+    jobThreads = [1 + int(share) for share in shares]
+    # hand the threads left over from rounding down to the largest remainders
+    left = threads - sum(jobThreads)
+    for i in sorted(range(len(work)), key=lambda i: int(shares[i]) - shares[i])[:left]:
+        jobThreads[i] += 1
+    return (max(1, len(work)), jobThreads)
+
+
 __commands__.append(('multichr_mafft', parser_multichr_mafft))
 
 # ============================
@@ -14,6 +14,8 @@ import itertools
 import re
 import os
 import collections
+import concurrent.futures
+import functools
 
 # third-party
 import Bio.AlignIO
@@ -102,7 +104,8 @@ defaultMaxBias = 10
 
 
 def vphaser_one_sample(inBam, inConsFasta, outTab, vphaserNumThreads=None,
-                       minReadsEach=None, maxBias=None, removeDoublyMappedReads=False):
+                       minReadsEach=None, maxBias=None, removeDoublyMappedReads=False,
+                       libraryBiasEngine='samtools', vphaserPerChrom=False):
     ''' Input: a single BAM file, representing reads from one sample, mapped to
             its own consensus assembly. It may contain multiple read groups and
             libraries.
@@ -110,6 +113,8 @@ def vphaser_one_sample(inBam, inConsFasta, outTab, vphaserNumThreads=None,
             V Phaser-2 output variants with additional column for
             sequence/chrom name, and library counts and p-values appended to
             the counts for each allele.
+        With vphaserPerChrom, V-Phaser 2 runs separately on each chromosome
+            (see iterate_vphaser_by_chrom).
     '''
     samtoolsTool = SamtoolsTool()
 
@@ -142,15 +147,86 @@ def vphaser_one_sample(inBam, inConsFasta, outTab, vphaserNumThreads=None,
         util.file.touch(outTab)
         return None
 
-    variantIter = Vphaser2Tool().iterate(bam_to_process, vphaserNumThreads)
+    if vphaserPerChrom:
+        variantIter = iterate_vphaser_by_chrom(bam_to_process, vphaserNumThreads)
+    else:
+        variantIter = Vphaser2Tool().iterate(bam_to_process, vphaserNumThreads)
     filteredIter = filter_strand_bias(variantIter, minReadsEach, maxBias)
 
-    libraryFilteredIter = compute_library_bias(filteredIter, bam_to_process, inConsFasta)
+    libraryFilteredIter = compute_library_bias(filteredIter, bam_to_process, inConsFasta, engine=libraryBiasEngine)
     with util.file.open_or_gzopen(outTab, 'wt') as outf:
         for row in libraryFilteredIter:
             outf.write('\t'.join(row) + '\n')
 
 
+def _split_bam_by_chrom(inBam):
+    ''' Write the mapped reads of each chromosome of inBam to its own BAM file
+        (with the full header). Returns [(chrom, bam file)] in header order,
+        leaving out chromosomes without reads.
+    '''
+    chromBams = []
+    with pysam.AlignmentFile(inBam, 'rb') as bam:
+        outfs = {}
+        try:
+            for read in bam.fetch(until_eof=True):
+                if read.is_unmapped:
+                    continue
+                if read.reference_id not in outfs:
+                    chromBam = util.file.mkstempfname('.' + str(read.reference_id) + '.bam')
+                    outfs[read.reference_id] = (chromBam, pysam.AlignmentFile(chromBam, 'wb', template=bam))
+                outfs[read.reference_id][1].write(read)
+        except:
+            for chromBam, outf in outfs.values():
+                outf.close()
+                os.unlink(chromBam)
+            raise
+        for chromBam, outf in outfs.values():
+            outf.close()
+        for i in sorted(outfs):
+            chromBams.append((bam.get_reference_name(i), outfs[i][0]))
+    return chromBams
+
+
+def _run_vphaser_on_chrom(chromBam, numThreads):
+    try:
+        return list(Vphaser2Tool().iterate(chromBam, numThreads))
+    finally:
+        os.unlink(chromBam)
+
+
+def iterate_vphaser_by_chrom(inBam, numThreads=None):
+    ''' Like Vphaser2Tool().iterate(inBam, numThreads), but V-Phaser 2 runs
+        on the reads of each chromosome separately, with up to numThreads
+        runs at a time and the threads split between them. Rows are still
+        yielded in the order of chromosomes in the inBam header, each
+        chromosome's as soon as it and all before it have finished, so
+        filtering can start before the last run is done.
+        Read pairs split across chromosomes are seen as unpaired reads.
+    '''
+    threads = util.misc.sanitize_thread_count(numThreads)
+    chromBams = _split_bam_by_chrom(inBam)
+    if not chromBams:
+        return
+    workers = min(threads, len(chromBams))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            runs = []
+            try:
+                for chrom, chromBam in chromBams:
+                    runs.append(executor.submit(_run_vphaser_on_chrom, chromBam, max(1, threads // workers)))
+                for run in runs:
+                    for row in run.result():
+                        yield row
+            finally:
+                # if a run failed or the caller stopped reading, don't start the rest
+                for run in runs:
+                    run.cancel()
+    finally:
+        for chrom, chromBam in chromBams:
+            if os.path.exists(chromBam):
+                os.unlink(chromBam)
+
+
 def filter_strand_bias(isnvs, minReadsEach=None, maxBias=None):
     ''' Take an iterator of V-Phaser output (plus chromosome name prepended)
         and perform hard filtering for strand bias
@@ -177,15 +253,33 @@ def filter_strand_bias(isnvs, minReadsEach=None, maxBias=None):
             yield row
 
 
-def compute_library_bias(isnvs, inBam, inConsFasta):
+def compute_library_bias(isnvs, inBam, inConsFasta, engine='samtools'):
     ''' For each variant, compute read counts in each library and p-value for
           library bias; append them to string for each variant.
         Format is allele:totalF:totalR:1stLibFCount:1stLibRCount:2ndLibFCount:...:p-val.
         Library counts are in alphabetical order of library IDs.
         Note: Total was computed by vphaser, library counts by samtools mpileup,
           so total might not be sum of library counts.
+        engine='pysam' counts the variant positions of each chromosome in one
+          pileup pass over that part of inBam (see get_library_allele_counts)
+          instead of running samtools mpileup per position per library. Its
+          libraries are those of the read group header, so unlike with
+          engine='samtools', a library without any reads gets a column of 0s.
     '''
     alleleCol = 7  # First column of output with allele counts
+    if engine == 'pysam':
+        with util.file.tmp_dir('_library_bias') as t_dir:
+            inBam = _indexed_bam(inBam, t_dir)
+            # variants come one chromosome at a time, so count them in per-chromosome batches
+            for chrom, rows in itertools.groupby(isnvs, key=lambda row: row[0]):
+                rows = list(rows)
+                positions = set((chrom, _library_bias_pos(row)) for row in rows)
+                libs, counts = get_library_allele_counts(inBam, inConsFasta, positions)
+                for row in rows:
+                    libCounts = counts.get((chrom, _library_bias_pos(row))) or [{} for lib in libs]
+                    yield _add_library_bias(row, libCounts, alleleCol)
+        return
+
     samtoolsTool = SamtoolsTool()
     rgs_by_lib = sorted((rg['LB'], rg['ID']) for rg in samtoolsTool.getReadGroups(inBam).values())
     rgs_by_lib = itertools.groupby(rgs_by_lib, lambda x: x[0])
@@ -224,73 +318,86 @@ def compute_library_bias(isnvs, inBam, inConsFasta):
             libBams.append(libBam)
 
     for row in isnvs:
-        consensusAllele = row[3]
-        pos = int(row[1]) if consensusAllele != 'i' else int(row[1]) - 1
+        pos = _library_bias_pos(row)
         chrom = row[0]
         libCounts = [get_mpileup_allele_counts(libBamItem, chrom, pos, inConsFasta, samtools=samtoolsTool) for libBamItem in libBams]
-        numAlleles = len(row) - alleleCol
-        countsMatrix = [[0] * numAlleles for lib in libBams]
-        libCountsByAllele = []
-        for alleleInd in range(numAlleles):
-            allele = row[alleleCol + alleleInd].split(':')[0]
-            libCountsByAllele.append([])
-            for libAlleleCounts, countsRow in zip(libCounts, countsMatrix):
-                f, r = libAlleleCounts.get(allele, [0, 0])
-                libCountsByAllele[-1].append([f, r])
-                countsRow[alleleInd] += f + r
-        for alleleInd in range(numAlleles):
-            contingencyTable = [
-                [countsRow[alleleInd] for countsRow in countsMatrix], [sum(countsRow) - countsRow[alleleInd]
-                                                                       for countsRow in countsMatrix]
-            ]
-            rowSums = map(sum, contingencyTable)
-            dofs = len(libCounts) - 1
-            if dofs < 1:
-                pval = 1.0
-            elif min(rowSums) ** dofs / dofs < 10000:
-                # At this cutoff, fisher_exact should take <~ 0.1 sec
-                pval = fisher_exact(contingencyTable)
-            else:
-                pval = chi2_contingency(contingencyTable)
-            row[alleleCol + alleleInd] = str(AlleleFieldParser(None, *(row[alleleCol + alleleInd].split(':') +
-                                                                       [pval, libCountsByAllele[alleleInd]])))
-        yield row
+        yield _add_library_bias(row, libCounts, alleleCol)
     for bam in libBams:
         os.unlink(bam)
     os.unlink(header_sam)
 
 
+def _library_bias_pos(row):
+    # the pileup position of a variant: indels are reported by mpileup at the base before
+    consensusAllele = row[3]
+    return int(row[1]) if consensusAllele != 'i' else int(row[1]) - 1
+
+
+def _add_library_bias(row, libCounts, alleleCol):
+    ''' Append library counts and library bias p-values to the allele
+        fields of row, given allele counts for each library at its position.
+    '''
+    numAlleles = len(row) - alleleCol
+    countsMatrix = [[0] * numAlleles for lib in libCounts]
+    libCountsByAllele = []
+    for alleleInd in range(numAlleles):
+        allele = row[alleleCol + alleleInd].split(':')[0]
+        libCountsByAllele.append([])
+        for libAlleleCounts, countsRow in zip(libCounts, countsMatrix):
+            f, r = libAlleleCounts.get(allele, [0, 0])
+            libCountsByAllele[-1].append([f, r])
+            countsRow[alleleInd] += f + r
+    for alleleInd in range(numAlleles):
+        contingencyTable = [
+            [countsRow[alleleInd] for countsRow in countsMatrix], [sum(countsRow) - countsRow[alleleInd]
+                                                                   for countsRow in countsMatrix]
+        ]
+        rowSums = map(sum, contingencyTable)
+        dofs = len(libCounts) - 1
+        if dofs < 1:
+            pval = 1.0
+        elif min(rowSums) ** dofs / dofs < 10000:
+            # At this cutoff, fisher_exact should take <~ 0.1 sec
+            pval = fisher_exact(contingencyTable)
+        else:
+            pval = chi2_contingency(contingencyTable)
+        row[alleleCol + alleleInd] = str(AlleleFieldParser(None, *(row[alleleCol + alleleInd].split(':') +
+                                                                   [pval, libCountsByAllele[alleleInd]])))
+    return row
+
+
+_PILEUP_READ_START = re.compile(r'\^.?', re.DOTALL)
+_PILEUP_INDEL = re.compile(r'[+-][0-9]+')
+_PILEUP_SKIPPED = '<>$*'  # Reference skip, end of read, placeholder
+_PILEUP_BASES = '.ACGTN'
+_PILEUP_KNOWN = dict.fromkeys(map(ord, _PILEUP_SKIPPED + _PILEUP_BASES + ',acgtn'))
+
+
 def parse_alleles_string(allelesStr):
     # Return {allele : [forwardCount, reverseCount]}
     # For reference, allele is '.' rather than real allele
+    # Read starts (^ and a mapping quality character) are cut out first, then
+    # the indels of each distinct length (e.g., +3aaa) with one regex each,
+    # leaving single-character alleles to be counted with str.count.
     alleleCounts = {}  # allele : [forwardCount, reverseCount]
-    pos = -1
-    digits = re.compile('[0-9]+')
-    while pos < len(allelesStr) - 1:
-        pos += 1
-        c = allelesStr[pos]
-        if c in '.,':
-            allele = '.'
-            isRev = c == ','
-        elif c in '<>$*':  # Reference skip, end of read, placeholder
-            continue  # Not interested in these
-        elif c == '^':  # Start of read
-            pos += 1  # Skip quality character
-            continue
-        elif c in 'ACGTNacgtn':
-            allele = c.upper()
-            isRev = c == c.lower()
-        elif c in '+-':  # e.g., +3aaa
-            mat = digits.match(allelesStr, pos + 1)
-            indelLen = int(allelesStr[mat.start():mat.end()])
-            indelStr = allelesStr[mat.end():mat.end() + indelLen]
-            allele = 'I' + indelStr.upper() if c == '+' else 'D' + str(indelLen)
+    bases = _PILEUP_READ_START.sub('', allelesStr)
+    for indel in sorted(set(_PILEUP_INDEL.findall(bases)), key=len, reverse=True):
+        indelLen = int(indel[1:])
+        indelRe = re.compile(re.escape(indel) + '(?![0-9])(.{%d})' % indelLen, re.DOTALL)
+        for indelStr, n in collections.Counter(indelRe.findall(bases)).items():
+            allele = 'I' + indelStr.upper() if indel[0] == '+' else 'D' + str(indelLen)
             isRev = indelStr == indelStr.lower()
-            pos += mat.end() - mat.start() + indelLen
-        else:
-            raise Exception('Unknown allele type %s' % c)
-        alleleCounts.setdefault(allele, [0, 0])
-        alleleCounts[allele][isRev] += 1
+            alleleCounts.setdefault(allele, [0, 0])
+            alleleCounts[allele][isRev] += n
+        bases = indelRe.sub('', bases)
+
+    unknown = bases.translate(_PILEUP_KNOWN)
+    if unknown:
+        raise Exception('Unknown allele type %s' % unknown[0])
+    for allele in _PILEUP_BASES:
+        f, r = bases.count(allele), bases.count(',' if allele == '.' else allele.lower())
+        if f or r:
+            alleleCounts[allele] = [f, r]
     return alleleCounts
 
 
@@ -327,6 +434,116 @@ def get_mpileup_allele_counts(inBam, chrom, pos, inConsFasta, samtools=None):
     return alleleCounts
 
 
+def _pileup_regions(positions, max_gap=1000):
+    """ Group a collection of (chrom, pos) into sorted (chrom, start, stop)
+        regions (0-based, half-open) for pileup, joining positions fewer than
+        max_gap bases apart so that reads spanning both are read only once.
+    """
+    regions = []
+    for chrom, pos in sorted(positions):
+        if regions and regions[-1][0] == chrom and pos - regions[-1][2] < max_gap:
+            regions[-1][2] = pos
+        else:
+            regions.append([chrom, pos - 1, pos])
+    return [tuple(region) for region in regions]
+
+
+def get_library_allele_counts(inBam, inConsFasta, positions, max_depth=50000):
+    """ Allele counts as reported by get_mpileup_allele_counts, for each
+        library of inBam at each of positions (a collection of (chrom, pos)),
+        from a single pileup pass over the regions of inBam around those
+        positions (or over all of inBam if it is not coordinate sorted; an
+        unindexed, sorted inBam is indexed first). Reads are assigned to libraries
+        through the read group header. Returns (libraries, {(chrom, pos) :
+        [allele counts for each library]}) for covered positions, where
+        libraries are the sorted library IDs of the read group header. As with
+        samtools mpileup -d, at most max_depth reads are counted per library
+        at each position.
+    """
+    positions = set(positions)
+    with util.file.open_or_gzopen(inConsFasta, 'rt') as inf:
+        refs = dict((seq.id, str(seq.seq)) for seq in Bio.SeqIO.parse(inf, 'fasta'))
+
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as bam:
+        lib_by_rg = dict((rg['ID'], rg['LB']) for rg in bam.header.to_dict().get('RG', []))
+    libs = sorted(set(lib_by_rg.values()))
+    lib_idx = dict((lib, i) for i, lib in enumerate(libs))
+    idx_by_rg = dict((rg, lib_idx[lib]) for rg, lib in lib_by_rg.items())
+
+    counts = {}
+    if not positions or not libs:
+        return (libs, counts)
+    with util.file.tmp_dir('_library_counts') as t_dir:
+        inBam = _indexed_bam(inBam, t_dir)
+        with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as bam:
+            if bam.has_index():
+                regions = [dict(contig=chrom, start=start, stop=stop, truncate=True)
+                           for chrom, start, stop in _pileup_regions(positions)
+                           if chrom in bam.references]
+            else:
+                regions = [{}]
+            for region in regions:
+                _count_library_alleles(bam, region, positions, refs, idx_by_rg, len(libs), max_depth, counts)
+    return (libs, counts)
+
+
+def _indexed_bam(inBam, t_dir):
+    """ inBam, or if it is coordinate sorted but not indexed, an indexed link
+        to it in t_dir (leaving the directory of inBam untouched).
+    """
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as bam:
+        if bam.has_index() or bam.header.to_dict().get('HD', {}).get('SO') != 'coordinate':
+            return inBam
+    linkBam = os.path.join(t_dir, os.path.basename(inBam))
+    os.symlink(os.path.abspath(inBam), linkBam)
+    pysam.index(linkBam)
+    return linkBam
+
+
+def _count_library_alleles(bam, region, positions, refs, idx_by_rg, n_libs, max_depth, counts):
+    """ Add the per-library allele counts at each of positions within region
+        (keyword arguments to pysam's pileup) to counts; see
+        get_library_allele_counts.
+    """
+    for column in bam.pileup(
+        stepper='all', ignore_overlaps=False, ignore_orphans=False,
+        min_base_quality=0, max_depth=2**31 - 1, **region
+    ):
+        chrom = column.reference_name
+        pos = column.reference_pos + 1
+        if (chrom, pos) not in positions:
+            continue
+        ref = refs[chrom]
+        refAllele = ref[pos - 1] if pos <= len(ref) else 'N'
+        libCounts = [{} for i in range(n_libs)]
+        depths = [0] * n_libs
+        for read in column.pileups:
+            alignment = read.alignment
+            i = idx_by_rg.get(alignment.get_tag('RG')) if alignment.has_tag('RG') else None
+            if i is None or depths[i] >= max_depth:
+                continue
+            depths[i] += 1
+            isRev = alignment.is_reverse
+            alleles = []
+            if not read.is_del and not read.is_refskip:
+                base = alignment.query_sequence[read.query_position].upper()
+                alleles.append('.' if base == refAllele.upper() else base)
+            if read.indel > 0:
+                # the inserted bases follow this position's base (or deletion)
+                qpos = read.query_position_or_next if read.is_del else read.query_position + 1
+                alleles.append('I' + alignment.query_sequence[qpos:qpos + read.indel].upper())
+            elif read.indel < 0:
+                alleles.append('D' + str(-read.indel))
+            for allele in alleles:
+                alleleCounts = libCounts[i].setdefault(allele, [0, 0])
+                alleleCounts[isRev] += 1
+        for i, alleleCounts in enumerate(libCounts):
+            if depths[i]:
+                alleleCounts['i'] = alleleCounts['d'] = alleleCounts[refAllele] = \
+                    alleleCounts.get('.', [0, 0])
+        counts[(chrom, pos)] = libCounts
+
+
 def parser_vphaser_one_sample(parser=argparse.ArgumentParser()):
     parser.add_argument("inBam", help="Input Bam file.")
     parser.add_argument("inConsFasta", help="Consensus assembly fasta.")
@@ -345,6 +562,18 @@ def parser_vphaser_one_sample(parser=argparse.ArgumentParser()):
                         default=False,
                         action="store_true",
                         help="""When calling V-Phaser, remove reads mapping to more than one contig. Default is to keep the reads.""")
+    parser.add_argument("--vphaserPerChrom",
+                        default=False,
+                        action="store_true",
+                        help="""Run V-Phaser 2 on each chromosome separately, several at a time
+                (splitting --vphaserNumThreads between them), and filter each chromosome's
+                variants as soon as its run is done. Default is one run over the whole BAM.""")
+    parser.add_argument("--libraryBiasEngine",
+                        default='samtools',
+                        choices=('samtools', 'pysam'),
+                        help="""How to count alleles per library for the library bias test:
+                samtools runs samtools mpileup for each variant and library; pysam counts
+                all variants in one pileup pass over the BAM file (default: %(default)s).""")
     util.cmd.common_args(parser, (('loglevel', None), ('version', None)))
     util.cmd.attach_main(parser, vphaser_one_sample, split_args=True)
     return parser
@@ -442,6 +671,320 @@ def strip_accession_version(acc):
     return acc
 
 
+def _merge_to_vcf_chrom(ref_sequence, alignmentFile, alignment_seqs, samples, isnv_index,
+                        strip_chr_version=False, naive_filter=False, parse_accession=False):
+    ''' Build the merged VCF rows for one reference sequence (chromosome/segment)
+        from its already loaded alignment (alignment_seqs, read from alignmentFile)
+        and the iSNVs in isnv_index, {sample: {sample's chrom: [iSNV rows]}}.
+        Returns the rows as a list of VCF lines.
+    '''
+    lines = []
+    samp_to_seqIndex = dict()
+
+    # make a coordmapper to map all alignments to this reference sequence
+    cm = CoordMapper(lazy=True)
+    cm.load_aligned_seqs(alignment_seqs)
+
+    # ========================
+    # to map from ref->sample
+    # cm[ref_sequence.id][s]
+    # to map sample->ref
+    # cm[s][ref_sequence.id]
+
+    # read in all iSNVs for this chrom and map to reference coords
+    data = []
+
+    # use conditional matching to only include the sequences that match the sample basename provided
+    samplesToUse = [x for x in cm.chrMaps.keys() if sampleIDMatch(x) in samples]
+
+    for seq in alignment_seqs:
+        for sampleName in samplesToUse:
+            if seq.id == sampleName:
+                samp_to_seqIndex[sampleName] = seq.seq.ungap('-')
+                break
+
+    if not len(samp_to_seqIndex) == len(samplesToUse):
+        raise LookupError(
+            "Sequence info not found in file %s for all sample names provided. Check alignment files." %
+            alignmentFile)
+
+    for s in samplesToUse:
+        # map ref->sample
+        s_chrom = cm.mapChr(ref_sequence.id, s)
+        sample_rows = []
+        for row in isnv_index[sampleIDMatch(s)].get(s_chrom, ()):
+            allele_fields = list(AlleleFieldParser(x) for x in row[7:] if x)
+            row = {
+                'sample': s,
+                'CHROM': ref_sequence.id,
+                's_chrom': s_chrom,
+                's_pos': int(row[1]),
+                's_alt': row[2],
+                's_ref': row[3],
+                'alleles': list(x.allele_and_strand_counts() for x in allele_fields),
+                'n_libs': dict(
+                    (x.allele(), sum(1 for f, r in x.lib_counts()
+                                     if f + r > 0)) for x in allele_fields),
+                'lib_bias': dict(
+                    (x.allele(), x.lib_bias_pval()) for x in allele_fields),
+            }
+            # make a sorted allele list
+            row['allele_counts'] = list(sorted(
+                [(a, int(f) + int(r)) for a, f, r in row['alleles']],
+                key=(lambda x: x[1]),
+                reverse=True))
+            # naive filter (quick and dirty)
+            if naive_filter:
+                # require 2 libraries for every allele call
+                row['allele_counts'] = list((a, n) for a, n in row['allele_counts']
+                                            if row['n_libs'][a] >= 2)
+                # recompute total read counts for remaining
+                tot_n = sum(n for a, n in row['allele_counts'])
+                # require allele frequency >= 0.5%
+                row['allele_counts'] = list((a, n) for a, n in row['allele_counts']
+                                            if tot_n > 0 and float(n) / tot_n >= 0.005)
+                # drop this position:sample if no variation left
+                if len(row['allele_counts']) < 2:
+                    log.info(
+                        """dropping iSNV at %s:%s (%s)
+                            because no variation remains after simple filtering""", row['s_chrom'],
+                        row['s_pos'], row['sample'])
+                    continue
+            # reposition vphaser deletions minus one to be consistent with
+            # VCF conventions
+            if row['s_alt'].startswith('D'):
+                for a, n in row['allele_counts']:
+                    if a[0] not in ('D', 'i'):
+                        log.error("allele_counts: " + str(row['allele_counts']))
+                        raise Exception("deletion alleles must always start with D or i")
+                row['s_pos'] = row['s_pos'] - 1
+            sample_rows.append(row)
+
+        # map positions back to reference coordinates, all of this sample's at once
+        s_positions = [row['s_pos'] for row in sample_rows]
+        for row, ref_pos in zip(sample_rows, cm.mapChrMany(s, ref_sequence.id, s_positions)[1]):
+            # an interval [left, right] if the position maps onto an insertion
+            if isinstance(ref_pos, list):
+                row['POS'], row['END'] = ref_pos[0], ref_pos[1]
+            else:
+                row['POS'] = row['END'] = ref_pos
+            if row['POS'] == None or row['END'] == None:
+                raise Exception('consensus extends beyond start or end of reference.')
+            data.append(row)
+
+    # sort all iSNVs (across all samples) and group by position
+    data = sorted(data, key=(lambda row: row['POS']))
+    data = itertools.groupby(data, lambda row: row['POS'])
+
+    # process one reference position at a time from
+    for pos, rows in data:
+        # each of the sample-specific variants for a given ref pos
+        rows = list(rows)
+
+        # define the length of this variation based on the largest deletion
+        end = pos
+        for row in rows:
+            end = max(end, row['END'])
+            for a, n in row['allele_counts']:
+                if a.startswith('D'):
+                    # end of deletion in sample's coord space
+                    local_end = row['s_pos'] + int(a[1:])
+
+                    # end of deletion in reference coord space
+                    ref_end = cm.mapChr(row['s_chrom'], ref_sequence.id, local_end, side=1)[1]
+                    if ref_end is None:
+                        raise Exception('consensus extends ' 'beyond start or end of reference.')
+                    end = max(end, ref_end)
+
+        # find reference allele and consensus alleles
+        refAllele = str(ref_sequence[pos - 1:end].seq)
+        consAlleles = {}  # the full pos-to-end consensus assembly sequence for each sample
+        samp_offsets = {}  # {sample : isnv's index in its consAllele string}
+        for row in rows:
+            s_pos = row['s_pos']
+            sample = row['sample']
+            if samp_offsets.get(sample, s_pos) != s_pos:
+                raise NotImplementedError('Sample %s has variants at 2 '
+                                          'positions %s mapped to same reference position (%s:%s)' %
+                                          (sample, (s_pos, samp_offsets[sample]), ref_sequence.id, pos))
+            samp_offsets[sample] = s_pos
+        for s in samplesToUse:
+            # map ref to s
+            cons_start = cm.mapChr(ref_sequence.id, s, pos, side=-1)[1]
+            cons_stop = cm.mapChr(ref_sequence.id, s, end, side=1)[1]
+            if cons_start is None or cons_stop is None:
+                log.info("variant is outside consensus assembly "
+                         "for %s at %s:%s-%s.", s, ref_sequence.id, pos, end)
+                continue
+
+            cons = samp_to_seqIndex[s]  # .seq.ungap('-')#[ cm.mapChr(ref_sequence.id, s) ]
+
+            allele = str(cons[cons_start - 1:cons_stop]).upper()
+            if s in samp_offsets:
+                samp_offsets[s] -= cons_start
+            if all(a in set(('A', 'C', 'T', 'G')) for a in allele):
+                consAlleles[s] = allele
+            else:
+                log.warning("dropping ambiguous consensus for %s at %s:%s-%s: %s", s, ref_sequence.id, pos,
+                            end, allele)
+
+        # define genotypes and fractions
+        iSNVs = {}  # {sample : {allele : fraction, ...}, ...}
+        iSNVs_read_depth = {}  # {sample: read depth}
+        iSNVs_n_libs = {}  # {sample : {allele : n libraries > 0, ...}, ...}
+        iSNVs_lib_bias = {}  # {sample : {allele : pval, ...}, ...}
+        for s in samplesToUse:
+            # get all rows for this sample and merge allele counts together
+            acounts = dict(itertools.chain.from_iterable(row['allele_counts'] for row in rows if
+                                                         row['sample'] == s))
+            nlibs = dict(itertools.chain.from_iterable(row['n_libs'].items() for row in rows if
+                                                       row['sample'] == s))
+            libbias = dict(itertools.chain.from_iterable(row['lib_bias'].items() for row in rows if
+                                                         row['sample'] == s))
+            if 'i' in acounts and 'd' in acounts:
+                # This sample has both an insertion line and a deletion line at the same spot!
+                # To keep the reference allele from be counted twice, once as an i and once
+                # as a d, average the counts and get rid of one of them.
+                acounts['i'] = int(round((acounts['i'] + acounts['d']) / 2.0, 0))
+                del acounts['d']
+                nlibs['i'] = max(nlibs['i'], nlibs['d'])
+                libbias['i'] = max(libbias['i'], libbias['d'])
+
+            if acounts and s in consAlleles:
+                # we have iSNV data on this sample
+                consAllele = consAlleles[s]
+                tot_n = sum(acounts.values())
+                iSNVs[s] = {}  # {allele : fraction, ...}
+                iSNVs_read_depth[s] = tot_n
+                iSNVs_n_libs[s] = {}
+                iSNVs_lib_bias[s] = {}
+                for orig_a, n in acounts.items():
+                    f = float(n) / tot_n
+                    a = orig_a
+                    if a.startswith('I'):
+                        # insertion point is relative to each sample
+                        insert_point = samp_offsets[s] + 1
+                        a = consAllele[:insert_point] + a[1:] + consAllele[insert_point:]
+                    elif a.startswith('D'):
+                        # deletion is the first consensus base, plus remaining
+                        # consensus seq with the first few positions dropped off
+                        cut_left = samp_offsets[s] + 1
+                        cut_right = samp_offsets[s] + 1 + int(a[1:])
+                        a = consAllele[:cut_left] + consAllele[cut_right:]
+                    elif a in ('i', 'd'):
+                        # this is vphaser's way of saying the "reference" (majority/consensus)
+                        # allele, in the face of other indel variants
+                        a = consAllele
+                    else:
+                        # this is a SNP
+                        if a not in set(('A', 'C', 'T', 'G')):
+                            raise Exception()
+                        if f > 0.5 and a != consAllele[samp_offsets[s]]:
+                            log.warning("vPhaser and assembly pipelines mismatch at "
+                                        "%s:%d (%s) - consensus %s, vPhaser %s, f %.3f", ref_sequence.id,
+                                        pos, s, consAllele[samp_offsets[s]], a, f)
+                        new_allele = list(consAllele)
+                        new_allele[samp_offsets[s]] = a
+                        a = ''.join(new_allele)
+                    if not (a and a == a.upper()):
+                        raise Exception()
+                    iSNVs[s][a] = f
+                    iSNVs_n_libs[s][a] = nlibs[orig_a]
+                    iSNVs_lib_bias[s][a] = libbias[orig_a]
+                if all(len(a) == 1 for a in iSNVs[s].keys()):
+                    if consAllele not in iSNVs[s]:
+                        raise Exception(
+                            """at %s:%s (%s), consensus allele %s
+                                not among iSNV alleles %s -- other cons alleles: %s""" % (
+                                ref_sequence.id, pos, s, consAllele, ', '.join(
+                                    iSNVs[s].keys()), ', '.join(
+                                        consAlleles[s])))
+            elif s in consAlleles:
+                # there is no iSNV data for this sample, so substitute the consensus allele
+                iSNVs[s] = {consAlleles[s]: 1.0}
+
+        # get unique alleles list for this position, in this order:
+        # first:   reference allele,
+        # next:    consensus allele for each sample, in descending order of
+        #          number of samples with that consensus,
+        # finally: all other alleles, sorted first by number of containing samples,
+        #          then by intrahost read frequency summed over the population,
+        #          then by the allele string itself.
+        alleles_cons = [alleleItem for alleleItem, n in sorted(util.misc.histogram(consAlleles.values()).items(),
+                                             key=lambda x: x[1],
+                                             reverse=True) if alleleItem != refAllele]
+        alleles_isnv = list(itertools.chain.from_iterable(
+            [iSNVs[s].items() for s in samplesToUse if s in iSNVs]))
+        alleles_isnv2 = []
+        for a in set(a for a, n in alleles_isnv):
+            counts = list(x[1] for x in alleles_isnv if x[0] == a)
+            if len(counts) > 0 and sum(counts) > 0:
+                # if we filtered any alleles above, make sure to omit absent alleles
+                alleles_isnv2.append((len(counts), sum(counts), a))
+            else:
+                log.info("dropped allele %s at position %s:%s", a, ref_sequence.id, pos)
+        alleles_isnv = list(allele for n_samples, n_reads, allele in reversed(sorted(alleles_isnv2)))
+        alleles = list(util.misc.unique([refAllele] + alleles_cons + alleles_isnv))
+
+        # map alleles from strings to numeric indexes
+        if not alleles:
+            raise Exception()
+        elif len(alleles) == 1:
+            # if we filtered any alleles above, skip this position if there is no variation left here
+            log.info("dropped position %s:%s due to lack of variation", ref_sequence.id, pos)
+            continue
+        alleleMap = dict((a, i) for i, a in enumerate(alleles))
+        # GT col emitted below
+        genos = [str(alleleMap.get(consAlleles.get(s), '.')) for s in samplesToUse]
+        # AF col emitted below, everything excluding the ref allele (one float per non-ref allele)
+        freqs = [(s in iSNVs) and ','.join(map(str, [iSNVs[s].get(a, 0.0) for a in alleles[1:]])) or '.'
+                 for s in samplesToUse]
+        # DP col emitted below
+        depths = [str(iSNVs_read_depth.get(s, '.')) for s in samplesToUse]
+        # NL col, everything including the ref allele (one int per allele)
+        nlibs = [(s in iSNVs_n_libs) and ','.join([str(iSNVs_n_libs[s].get(a, 0)) for a in alleles]) or '.'
+                 for s in samplesToUse]
+        # LB col, everything including the ref allele (one float per allele)
+        pvals = [(s in iSNVs_lib_bias) and ','.join([str(iSNVs_lib_bias[s].get(a, '.')) for a in alleles])
+                 or '.' for s in samplesToUse]
+
+        # prepare output row and write to file
+        c = ref_sequence.id
+        if parse_accession:
+            c = util.genbank.parse_accession_str(c)
+        if strip_chr_version:
+            c = strip_accession_version(c)
+        out = [c, pos, '.', alleles[0], ','.join(alleles[1:]), '.', '.', '.', 'GT:AF:DP:NL:LB']
+        out = out + list(map(':'.join, zip(genos, freqs, depths, nlibs, pvals)))
+        lines.append('\t'.join(map(str, out)) + '\n')
+    return lines
+
+
+def _load_isnv_files(isnvs):
+    ''' Read each of the (distinct) iSNV files once.
+        Returns {isnvs_file: {chrom: [rows]}}, chroms in order of appearance.
+    '''
+    isnv_rows = {}
+    for isnvs_file in isnvs:
+        if isnvs_file not in isnv_rows:
+            by_chrom = collections.OrderedDict()
+            for row in util.file.read_tabfile(isnvs_file):
+                by_chrom.setdefault(row[0], []).append(row)
+            isnv_rows[isnvs_file] = by_chrom
+    return isnv_rows
+
+
+def _load_alignment_files(alignments):
+    ''' Read each of the (distinct) alignment files once.
+        Returns {alignment file: [aligned SeqRecords]}.
+    '''
+    alignment_seqs = {}
+    for alignmentFile in alignments:
+        if alignmentFile not in alignment_seqs:
+            with util.file.open_or_gzopen(alignmentFile, 'r') as inf:
+                alignment_seqs[alignmentFile] = list(Bio.SeqIO.parse(inf, 'fasta'))
+    return alignment_seqs
+
 
 # def merge_to_vcf(refFasta, outVcf, samples, isnvs, assemblies, strip_chr_version=False, naive_filter=False):
 
@@ -454,31 +997,36 @@ def merge_to_vcf(
         alignments,
         strip_chr_version=False,
         naive_filter=False,
-        parse_accession=False):
+        parse_accession=False,
+        threads=None):
     ''' Combine and convert vPhaser2 parsed filtered output text files into VCF format.
         Assumption: consensus assemblies used in creating alignments do not extend beyond ends of reference.
                     the number of alignment files equals the number of chromosomes / segments
+        Each iSNV file and each alignment is read only once, and the chromosomes are
+        merged in separate processes, up to threads at a time.
     '''
 
+    # read everything in once, up front
+    isnv_rows = _load_isnv_files(isnvs)
+    alignment_seqs = _load_alignment_files(alignments)
+    with util.file.open_or_gzopen(refFasta, 'r') as inf:
+        ref_seqs = list(Bio.SeqIO.parse(inf, 'fasta'))
+
     guessed_samples = []
     if not samples:
         samplenames_from_isnvs = []
         for isnvs_file in isnvs:
-            for row in util.file.read_tabfile(isnvs_file):
-                guessed_sample_ID = sampleIDMatch(row[0])
+            for chrom in isnv_rows[isnvs_file]:
+                guessed_sample_ID = sampleIDMatch(chrom)
                 if guessed_sample_ID not in samplenames_from_isnvs:
                     samplenames_from_isnvs.append(guessed_sample_ID)
-        
+
         samplenames_from_alignments = set()
         for alignmentFile in alignments:
-            with util.file.open_or_gzopen(alignmentFile, 'r') as inf:
-                for seq in Bio.SeqIO.parse(inf, 'fasta'):
-                    samplenames_from_alignments.add(sampleIDMatch(seq.id))
+            for seq in alignment_seqs[alignmentFile]:
+                samplenames_from_alignments.add(sampleIDMatch(seq.id))
 
-        refnames = set()
-        with util.file.open_or_gzopen(refFasta, 'r') as inf:
-            for seq in Bio.SeqIO.parse(inf, 'fasta'):
-                    refnames.add(sampleIDMatch(seq.id))
+        refnames = set(sampleIDMatch(seq.id) for seq in ref_seqs)
 
         # sample names from the isnv files, in that order, 
         # followed by sample names seen in the alignments, minus the former and the reference IDs
@@ -493,16 +1041,11 @@ def merge_to_vcf(
         matched_samples = []
         matched_isnv_files = []
         for sample in samples:
-            sample_found=False
             for isnvs_file in isnvs:
-                for row in util.file.read_tabfile(isnvs_file):
-                    if sample==sampleIDMatch(row[0]):
-                        samp_to_isnv[sample] = isnvs_file
-                        sample_found=True
-                        matched_samples.append(sample)
-                        matched_isnv_files.append(isnvs_file)
-                        break
-                if sample_found:
+                if any(sample == sampleIDMatch(chrom) for chrom in isnv_rows[isnvs_file]):
+                    samp_to_isnv[sample] = isnvs_file
+                    matched_samples.append(sample)
+                    matched_isnv_files.append(isnvs_file)
                     break
         samples = matched_samples
         isnvs = matched_isnv_files
@@ -511,9 +1054,11 @@ def merge_to_vcf(
 
     log.info(samp_to_isnv)
 
+    # index the iSNV rows by (sample, chrom): {sample: {chrom: [rows]}}
+    isnv_index = dict((sample, isnv_rows[isnvs_file]) for sample, isnvs_file in samp_to_isnv.items())
+
     # get IDs and sequence lengths for reference sequence
-    with util.file.open_or_gzopen(refFasta, 'r') as inf:
-        ref_chrlens = list((seq.id, len(seq)) for seq in Bio.SeqIO.parse(inf, 'fasta'))
+    ref_chrlens = list((seq.id, len(seq)) for seq in ref_seqs)
 
     # use the output filepath specified if it is a .vcf, otherwise if it is gzipped we need
     # to write to a temp VCF and then compress to vcf.gz later
@@ -561,19 +1106,11 @@ def merge_to_vcf(
         # reference fasta, but we need to relate each reference sequence (chromosome/segment) to a specific
         # alignment file and index within the alignment
         ref_seq_id_to_alignment_file = dict()
-        ref_seq_in_alignment_file = dict()
-
-        # copy the list of alignment files
-        alignmentFiles = list(alignments)
-
-        with util.file.open_or_gzopen(refFasta, 'r') as inf:
-            for refSeq in Bio.SeqIO.parse(inf, 'fasta'):
-                for alignmentFile in alignmentFiles:
-                    with util.file.open_or_gzopen(alignmentFile, 'r') as inf2:
-                        for seq in Bio.SeqIO.parse(inf2, 'fasta'):
-                            if refSeq.id == seq.id:
-                                ref_seq_id_to_alignment_file[seq.id] = alignmentFile
-                                ref_seq_in_alignment_file[seq.id] = seq.seq.ungap('-')
+        ref_ids = set(refSeq.id for refSeq in ref_seqs)
+        for alignmentFile in alignments:
+            for seq in alignment_seqs[alignmentFile]:
+                if seq.id in ref_ids:
+                    ref_seq_id_to_alignment_file[seq.id] = alignmentFile
 
         if len(ref_seq_id_to_alignment_file) < len(ref_chrlens):
             raise LookupError("Not all reference sequences found in alignments.")
@@ -583,301 +1120,42 @@ def merge_to_vcf(
                 "There must be an isnv file for each sample. %s samples, %s isnv files" % (len(samples), len(isnvs)))
 
         for fileName in alignments:
-            with util.file.open_or_gzopen(fileName, 'r') as inf:
-                # get two independent iterators into the alignment file
-                number_of_aligned_sequences = count_iter_items(Bio.SeqIO.parse(inf, 'fasta'))
-                num_isnv_files = len(isnvs)
-                # -1 is to account for inclusion of reference in the alignement in addition
-                # to the assemblies
-
-                # if we had to guess samples only check that the number of isnv files == number of alignments
-                if len(guessed_samples)==0:
-                    if not (number_of_aligned_sequences - 1) == num_isnv_files == len(samples):
-                        raise LookupError(
-                            """The number of isnv files provided (%s) and must equal the number of sequences
-                            seen in the alignment (%s) (plus an extra reference record in the alignment), 
-                            as well as the number of sample names provided (%s)
-                            %s does not have the right number of sequences""" % (num_isnv_files,number_of_aligned_sequences - 1,len(samples),fileName))
-
-        # one reference chrom at a time
-        with open(refFasta, 'r') as inf:
-            for ref_sequence in Bio.SeqIO.parse(inf, 'fasta'):
-                samp_to_seqIndex = dict()
-
-                #ref_sequence = ref_seq_in_alignment_file[refSequence.id]
-                # make a coordmapper to map all alignments to this reference sequence
-                cm = CoordMapper()
-                cm.load_alignments([ref_seq_id_to_alignment_file[ref_sequence.id]])
-
-                # ========================
-                # to map from ref->sample
-                # cm[ref_sequence.id][s]
-                # to map sample->ref
-                # cm[s][ref_sequence.id]
-
-                # read in all iSNVs for this chrom and map to reference coords
-                data = []
-
-                # use conditional matching to only include the sequences that match the sample basename provided
-                samplesToUse = [x for x in cm.chrMaps.keys() if sampleIDMatch(x) in samples]
-
-                alignmentFile = ref_seq_id_to_alignment_file[ref_sequence.id]
-                with util.file.open_or_gzopen(alignmentFile, 'r') as alignFileIn:
-                    for seq in Bio.SeqIO.parse(alignFileIn, 'fasta'):
-                        for sampleName in samplesToUse:
-                            if seq.id == sampleName:
-                                samp_to_seqIndex[sampleName] = seq.seq.ungap('-')
-                                break
-
-                if not len(samp_to_seqIndex) == len(samplesToUse):
+            number_of_aligned_sequences = len(alignment_seqs[fileName])
+            num_isnv_files = len(isnvs)
+            # -1 is to account for inclusion of reference in the alignement in addition
+            # to the assemblies
+
+            # if we had to guess samples only check that the number of isnv files == number of alignments
+            if len(guessed_samples)==0:
+                if not (number_of_aligned_sequences - 1) == num_isnv_files == len(samples):
                     raise LookupError(
-                        "Sequence info not found in file %s for all sample names provided. Check alignment files." %
-                        alignmentFile)
-
-                for s in samplesToUse:
-                    isnv_filepath = samp_to_isnv[sampleIDMatch(s)]
-
-                    for row in util.file.read_tabfile(isnv_filepath):
-                        # map ref->sample
-                        s_chrom = cm.mapChr(ref_sequence.id, s)
-                        if row[0] == s_chrom:
-                            allele_fields = list(AlleleFieldParser(x) for x in row[7:] if x)
-                            row = {
-                                'sample': s,
-                                'CHROM': ref_sequence.id,
-                                's_chrom': s_chrom,
-                                's_pos': int(row[1]),
-                                's_alt': row[2],
-                                's_ref': row[3],
-                                'alleles': list(x.allele_and_strand_counts() for x in allele_fields),
-                                'n_libs': dict(
-                                    (x.allele(), sum(1 for f, r in x.lib_counts()
-                                                     if f + r > 0)) for x in allele_fields),
-                                'lib_bias': dict(
-                                    (x.allele(), x.lib_bias_pval()) for x in allele_fields),
-                            }
-                            # make a sorted allele list
-                            row['allele_counts'] = list(sorted(
-                                [(a, int(f) + int(r)) for a, f, r in row['alleles']],
-                                key=(lambda x: x[1]),
-                                reverse=True))
-                            # naive filter (quick and dirty)
-                            if naive_filter:
-                                # require 2 libraries for every allele call
-                                row['allele_counts'] = list((a, n) for a, n in row['allele_counts']
-                                                            if row['n_libs'][a] >= 2)
-                                # recompute total read counts for remaining
-                                tot_n = sum(n for a, n in row['allele_counts'])
-                                # require allele frequency >= 0.5%
-                                row['allele_counts'] = list((a, n) for a, n in row['allele_counts']
-                                                            if tot_n > 0 and float(n) / tot_n >= 0.005)
-                                # drop this position:sample if no variation left
-                                if len(row['allele_counts']) < 2:
-                                    log.info(
-                                        """dropping iSNV at %s:%s (%s)
-                                            because no variation remains after simple filtering""", row['s_chrom'],
-                                        row['s_pos'], row['sample'])
-                                    continue
-                            # reposition vphaser deletions minus one to be consistent with
-                            # VCF conventions
-                            if row['s_alt'].startswith('D'):
-                                for a, n in row['allele_counts']:
-                                    if a[0] not in ('D', 'i'):
-                                        log.error("allele_counts: " + str(row['allele_counts']))
-                                        raise Exception("deletion alleles must always start with D or i")
-                                row['s_pos'] = row['s_pos'] - 1
-                            # map position back to reference coordinates
-                            row['POS'] = cm.mapChr(s, ref_sequence.id, row['s_pos'], side=-1)[1]
-                            row['END'] = cm.mapChr(s, ref_sequence.id, row['s_pos'], side=1)[1]
-                            if row['POS'] == None or row['END'] == None:
-                                raise Exception('consensus extends beyond start or end of reference.')
-                            data.append(row)
-
-                # sort all iSNVs (across all samples) and group by position
-                data = sorted(data, key=(lambda row: row['POS']))
-                data = itertools.groupby(data, lambda row: row['POS'])
-
-                # process one reference position at a time from
-                for pos, rows in data:
-                    # each of the sample-specific variants for a given ref pos
-                    rows = list(rows)
-
-                    # define the length of this variation based on the largest deletion
-                    end = pos
-                    for row in rows:
-                        end = max(end, row['END'])
-                        for a, n in row['allele_counts']:
-                            if a.startswith('D'):
-                                # end of deletion in sample's coord space
-                                local_end = row['s_pos'] + int(a[1:])
-
-                                # end of deletion in reference coord space
-                                ref_end = cm.mapChr(row['s_chrom'], ref_sequence.id, local_end, side=1)[1]
-                                if ref_end is None:
-                                    raise Exception('consensus extends ' 'beyond start or end of reference.')
-                                end = max(end, ref_end)
-
-                    # find reference allele and consensus alleles
-                    refAllele = str(ref_sequence[pos - 1:end].seq)
-                    consAlleles = {}  # the full pos-to-end consensus assembly sequence for each sample
-                    samp_offsets = {}  # {sample : isnv's index in its consAllele string}
-                    for row in rows:
-                        s_pos = row['s_pos']
-                        sample = row['sample']
-                        if samp_offsets.get(sample, s_pos) != s_pos:
-                            raise NotImplementedError('Sample %s has variants at 2 '
-                                                      'positions %s mapped to same reference position (%s:%s)' %
-                                                      (sample, (s_pos, samp_offsets[sample]), ref_sequence.id, pos))
-                        samp_offsets[sample] = s_pos
-                    for s in samplesToUse:
-                        # map ref to s
-                        cons_start = cm.mapChr(ref_sequence.id, s, pos, side=-1)[1]
-                        cons_stop = cm.mapChr(ref_sequence.id, s, end, side=1)[1]
-                        if cons_start is None or cons_stop is None:
-                            log.info("variant is outside consensus assembly "
-                                     "for %s at %s:%s-%s.", s, ref_sequence.id, pos, end)
-                            continue
-
-                        cons = samp_to_seqIndex[s]  # .seq.ungap('-')#[ cm.mapChr(ref_sequence.id, s) ]
-
-                        allele = str(cons[cons_start - 1:cons_stop]).upper()
-                        if s in samp_offsets:
-                            samp_offsets[s] -= cons_start
-                        if all(a in set(('A', 'C', 'T', 'G')) for a in allele):
-                            consAlleles[s] = allele
-                        else:
-                            log.warning("dropping ambiguous consensus for %s at %s:%s-%s: %s", s, ref_sequence.id, pos,
-                                        end, allele)
-
-                    # define genotypes and fractions
-                    iSNVs = {}  # {sample : {allele : fraction, ...}, ...}
-                    iSNVs_read_depth = {}  # {sample: read depth}
-                    iSNVs_n_libs = {}  # {sample : {allele : n libraries > 0, ...}, ...}
-                    iSNVs_lib_bias = {}  # {sample : {allele : pval, ...}, ...}
-                    for s in samplesToUse:
-                        # get all rows for this sample and merge allele counts together
-                        acounts = dict(itertools.chain.from_iterable(row['allele_counts'] for row in rows if
-                                                                     row['sample'] == s))
-                        nlibs = dict(itertools.chain.from_iterable(row['n_libs'].items() for row in rows if
-                                                                   row['sample'] == s))
-                        libbias = dict(itertools.chain.from_iterable(row['lib_bias'].items() for row in rows if
-                                                                     row['sample'] == s))
-                        if 'i' in acounts and 'd' in acounts:
-                            # This sample has both an insertion line and a deletion line at the same spot!
-                            # To keep the reference allele from be counted twice, once as an i and once
-                            # as a d, average the counts and get rid of one of them.
-                            acounts['i'] = int(round((acounts['i'] + acounts['d']) / 2.0, 0))
-                            del acounts['d']
-                            nlibs['i'] = max(nlibs['i'], nlibs['d'])
-                            libbias['i'] = max(libbias['i'], libbias['d'])
-
-                        if acounts and s in consAlleles:
-                            # we have iSNV data on this sample
-                            consAllele = consAlleles[s]
-                            tot_n = sum(acounts.values())
-                            iSNVs[s] = {}  # {allele : fraction, ...}
-                            iSNVs_read_depth[s] = tot_n
-                            iSNVs_n_libs[s] = {}
-                            iSNVs_lib_bias[s] = {}
-                            for orig_a, n in acounts.items():
-                                f = float(n) / tot_n
-                                a = orig_a
-                                if a.startswith('I'):
-                                    # insertion point is relative to each sample
-                                    insert_point = samp_offsets[s] + 1
-                                    a = consAllele[:insert_point] + a[1:] + consAllele[insert_point:]
-                                elif a.startswith('D'):
-                                    # deletion is the first consensus base, plus remaining
-                                    # consensus seq with the first few positions dropped off
-                                    cut_left = samp_offsets[s] + 1
-                                    cut_right = samp_offsets[s] + 1 + int(a[1:])
-                                    a = consAllele[:cut_left] + consAllele[cut_right:]
-                                elif a in ('i', 'd'):
-                                    # this is vphaser's way of saying the "reference" (majority/consensus)
-                                    # allele, in the face of other indel variants
-                                    a = consAllele
-                                else:
-                                    # this is a SNP
-                                    if a not in set(('A', 'C', 'T', 'G')):
-                                        raise Exception()
-                                    if f > 0.5 and a != consAllele[samp_offsets[s]]:
-                                        log.warning("vPhaser and assembly pipelines mismatch at "
-                                                    "%s:%d (%s) - consensus %s, vPhaser %s, f %.3f", ref_sequence.id,
-                                                    pos, s, consAllele[samp_offsets[s]], a, f)
-                                    new_allele = list(consAllele)
-                                    new_allele[samp_offsets[s]] = a
-                                    a = ''.join(new_allele)
-                                if not (a and a == a.upper()):
-                                    raise Exception()
-                                iSNVs[s][a] = f
-                                iSNVs_n_libs[s][a] = nlibs[orig_a]
-                                iSNVs_lib_bias[s][a] = libbias[orig_a]
-                            if all(len(a) == 1 for a in iSNVs[s].keys()):
-                                if consAllele not in iSNVs[s]:
-                                    raise Exception(
-                                        """at %s:%s (%s), consensus allele %s
-                                            not among iSNV alleles %s -- other cons alleles: %s""" % (
-                                            ref_sequence.id, pos, s, consAllele, ', '.join(
-                                                iSNVs[s].keys()), ', '.join(
-                                                    consAlleles[s])))
-                        elif s in consAlleles:
-                            # there is no iSNV data for this sample, so substitute the consensus allele
-                            iSNVs[s] = {consAlleles[s]: 1.0}
-
-                    # get unique alleles list for this position, in this order:
-                    # first:   reference allele,
-                    # next:    consensus allele for each sample, in descending order of
-                    #          number of samples with that consensus,
-                    # finally: all other alleles, sorted first by number of containing samples,
-                    #          then by intrahost read frequency summed over the population,
-                    #          then by the allele string itself.
-                    alleles_cons = [alleleItem for alleleItem, n in sorted(util.misc.histogram(consAlleles.values()).items(),
-                                                         key=lambda x: x[1],
-                                                         reverse=True) if alleleItem != refAllele]
-                    alleles_isnv = list(itertools.chain.from_iterable(
-                        [iSNVs[s].items() for s in samplesToUse if s in iSNVs]))
-                    alleles_isnv2 = []
-                    for a in set(a for a, n in alleles_isnv):
-                        counts = list(x[1] for x in alleles_isnv if x[0] == a)
-                        if len(counts) > 0 and sum(counts) > 0:
-                            # if we filtered any alleles above, make sure to omit absent alleles
-                            alleles_isnv2.append((len(counts), sum(counts), a))
-                        else:
-                            log.info("dropped allele %s at position %s:%s", a, ref_sequence.id, pos)
-                    alleles_isnv = list(allele for n_samples, n_reads, allele in reversed(sorted(alleles_isnv2)))
-                    alleles = list(util.misc.unique([refAllele] + alleles_cons + alleles_isnv))
-
-                    # map alleles from strings to numeric indexes
-                    if not alleles:
-                        raise Exception()
-                    elif len(alleles) == 1:
-                        # if we filtered any alleles above, skip this position if there is no variation left here
-                        log.info("dropped position %s:%s due to lack of variation", ref_sequence.id, pos)
-                        continue
-                    alleleMap = dict((a, i) for i, a in enumerate(alleles))
-                    # GT col emitted below
-                    genos = [str(alleleMap.get(consAlleles.get(s), '.')) for s in samplesToUse]
-                    # AF col emitted below, everything excluding the ref allele (one float per non-ref allele)
-                    freqs = [(s in iSNVs) and ','.join(map(str, [iSNVs[s].get(a, 0.0) for a in alleles[1:]])) or '.'
-                             for s in samplesToUse]
-                    # DP col emitted below
-                    depths = [str(iSNVs_read_depth.get(s, '.')) for s in samplesToUse]
-                    # NL col, everything including the ref allele (one int per allele)
-                    nlibs = [(s in iSNVs_n_libs) and ','.join([str(iSNVs_n_libs[s].get(a, 0)) for a in alleles]) or '.'
-                             for s in samplesToUse]
-                    # LB col, everything including the ref allele (one float per allele)
-                    pvals = [(s in iSNVs_lib_bias) and ','.join([str(iSNVs_lib_bias[s].get(a, '.')) for a in alleles])
-                             or '.' for s in samplesToUse]
-
-                    # prepare output row and write to file
-                    c = ref_sequence.id
-                    if parse_accession:
-                        c = util.genbank.parse_accession_str(c)
-                    if strip_chr_version:
-                        c = strip_accession_version(c)
-                    out = [c, pos, '.', alleles[0], ','.join(alleles[1:]), '.', '.', '.', 'GT:AF:DP:NL:LB']
-                    out = out + list(map(':'.join, zip(genos, freqs, depths, nlibs, pvals)))
-                    outf.write('\t'.join(map(str, out)) + '\n')
+                        """The number of isnv files provided (%s) and must equal the number of sequences
+                        seen in the alignment (%s) (plus an extra reference record in the alignment), 
+                        as well as the number of sample names provided (%s)
+                        %s does not have the right number of sequences""" % (num_isnv_files,number_of_aligned_sequences - 1,len(samples),fileName))
+
+        # one reference chrom at a time, each with only its own sequences and iSNV rows
+        chrom_args = []
+        for ref_sequence in ref_seqs:
+            alignmentFile = ref_seq_id_to_alignment_file[ref_sequence.id]
+            seq_ids = set(seq.id for seq in alignment_seqs[alignmentFile])
+            chrom_isnvs = dict(
+                (sample, dict((chrom, rows) for chrom, rows in by_chrom.items() if chrom in seq_ids))
+                for sample, by_chrom in isnv_index.items())
+            chrom_args.append((ref_sequence, alignmentFile, alignment_seqs[alignmentFile], samples, chrom_isnvs))
+        merge_chrom = functools.partial(_merge_to_vcf_chrom,
+                                        strip_chr_version=strip_chr_version,
+                                        naive_filter=naive_filter,
+                                        parse_accession=parse_accession)
+
+        workers = min(util.misc.sanitize_thread_count(threads), len(chrom_args))
+        if workers <= 1:
+            for args in chrom_args:
+                outf.writelines(merge_chrom(*args))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                for lines in executor.map(merge_chrom, *zip(*chrom_args)):
+                    outf.writelines(lines)
     # compress output if requested
     if outVcf.endswith('.vcf.gz'):
         pysam.tabix_compress(tmpVcf, outVcf, force=True)
@@ -927,7 +1205,7 @@ def parser_merge_to_vcf(parser=argparse.ArgumentParser()):
                         dest="parse_accession",
                         help="""If set, parse only the accession for the chromosome name.
         Helpful if snpEff has to create its own database""")
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None)))
     util.cmd.attach_main(parser, merge_to_vcf, split_args=True)
     return parser
 
@@ -1067,21 +1345,43 @@ def parse_ann(ann_field, alleles, transcript_blacklist=None):
     return out
 
 
+_VCF_FIXED_COLUMNS = frozenset(('CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'))
+
+
+def _iSNV_site_annotations(info, alleles):
+    ''' The per-site (not per-sample) columns of iSNV_table output '''
+    out = {}
+    if 'EFF' in info:
+        for k, v in parse_eff(info['EFF']).items():
+            out[k] = v
+    if 'ANN' in info:
+        for k, v in parse_ann(info['ANN'], alleles=alleles.split(',')).items():
+            out[k] = v
+    if 'PI' in info:
+        out['Hs_snp'] = info['PI']
+    if 'FWS' in info:
+        out['Fws_snp'] = info['FWS']
+    return out
+
+
 def iSNV_table(vcf_iter):
+    ''' Convert VCF rows (as dicts) to one output row per sample with iSNV data.
+        INFO and its snpEff annotations are parsed once per site and shared
+        by all of the samples at that site.
+    '''
     for row in vcf_iter:
         info = dict(kv.split('=') for kv in row['INFO'].split(';') if kv and kv != '.')
-        samples = [
-            k for k in row.keys() if k not in set(
-                ('CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'))
-        ]
+        samples = [k for k in row.keys() if k not in _VCF_FIXED_COLUMNS]
+        fields = [row[s].split(':', 2) for s in samples]
         # compute Hs: heterozygosity in population based on consensus genotypes alone
-        genos = [row[s].split(':')[0] for s in samples]
-        genos = util.misc.histogram(int(gt) for gt in genos if gt != '.')
+        genos = collections.Counter(int(field[0]) for field in fields if field[0] != '.')
         n = sum(genos.values())
         Hs = 1.0 - sum(k * k / float(n * n) for k in genos.values())
+        alleles = "%s,%s" % (row['REF'], row['ALT'])
+        site = None
         try:
-            for s in samples:
-                f = row[s].split(':')[1]
+            for s, field in zip(samples, fields):
+                f = field[1]
                 if f and f != '.':
                     freqs = list(map(float, f.split(',')))
                     f = sum(freqs)
@@ -1089,22 +1389,15 @@ def iSNV_table(vcf_iter):
                     out = {
                         'chr': row['CHROM'],
                         'pos': row['POS'],
-                        'alleles': "%s,%s" % (row['REF'], row['ALT']),
+                        'alleles': alleles,
                         'sample': s,
                         'iSNV_freq': f,
                         'Hw': Hw,
                         'Hs': Hs
                     }
-                    if 'EFF' in info:
-                        for k, v in parse_eff(info['EFF']).items():
-                            out[k] = v
-                    if 'ANN' in info:
-                        for k, v in parse_ann(info['ANN'], alleles=out['alleles'].split(',')).items():
-                            out[k] = v
-                    if 'PI' in info:
-                        out['Hs_snp'] = info['PI']
-                    if 'FWS' in info:
-                        out['Fws_snp'] = info['FWS']
+                    if site is None:
+                        site = _iSNV_site_annotations(info, alleles)
+                    out.update(site)
                     yield out
         except:
             log.error("VCF parsing error at %s:%s", row['CHROM'], row['POS'])
@@ -9,15 +9,26 @@ __author__ = "irwin@broadinstitute.org, dpark@broadinstitute.org"
 __commands__ = []
 
 import argparse
+import fcntl
+import hashlib
+import heapq
 import logging
-import math
 import os
+import re
 import tempfile
 import shutil
+import struct
+import subprocess
 import sys
+import zlib
+import itertools
 import concurrent.futures
 from contextlib import contextmanager
 import functools
+try:
+    from itertools import zip_longest    # pylint: disable=E0611
+except ImportError:
+    from itertools import izip_longest as zip_longest    # pylint: disable=E0611
 
 from Bio import SeqIO
 import pysam
@@ -42,19 +53,122 @@ log = logging.getLogger(__name__)
 # =======================
 
 
-def purge_unmated(inFastq1, inFastq2, outFastq1, outFastq2, regex=r'^@(\S+)/[1|2]$'):
-    '''Use mergeShuffledFastqSeqs to purge unmated reads, and
-       put corresponding reads in the same order.
+class _UnsortedFastqError(Exception):
+    pass
+
+
+def _fastq_ids(inFastq, regex, threads=None):
+    ''' Yield (read ID, sequence, quality) using the first group of regex
+        (matched against the header line) as the ID.
+    '''
+    for line, seq, qual in _fastq_records(inFastq, threads):
+        mo = regex.search(line.decode('utf-8'))
+        if not mo:
+            raise ValueError("The regular expression provided doesn't match sequence description: %s" % line.decode('utf-8'))
+        yield (mo.group(1).encode('utf-8'), seq, qual)
+
+
+def _write_mate(outf, read_id, mate, seq, qual):
+    outf.write(b'@' + read_id + mate + b'\n' + seq + b'\n+' + read_id + mate + b'\n' + qual + b'\n')
+
+
+def _purge_unmated_sorted(recs1, recs2, outf1, outf2):
+    ''' Merge-join two fastq record streams that are both sorted by ID, in
+        constant memory. Raises _UnsortedFastqError as soon as either stream
+        is found out of order.
+    '''
+    def advance(recs, last_id):
+        rec = next(recs, None)
+        if rec is not None and last_id is not None and rec[0] < last_id:
+            raise _UnsortedFastqError()
+        return rec
+
+    rec1 = advance(recs1, None)
+    rec2 = advance(recs2, None)
+    while rec1 is not None and rec2 is not None:
+        if rec1[0] < rec2[0]:
+            rec1 = advance(recs1, rec1[0])
+        elif rec2[0] < rec1[0]:
+            rec2 = advance(recs2, rec2[0])
+        else:
+            _write_mate(outf1, rec1[0], b'/1', rec1[1], rec1[2])
+            _write_mate(outf2, rec2[0], b'/2', rec2[1], rec2[2])
+            rec1 = advance(recs1, rec1[0])
+            rec2 = advance(recs2, rec2[0])
+    # the rest cannot pair up, but must still be in order for the join to be valid
+    while rec1 is not None:
+        rec1 = advance(recs1, rec1[0])
+    while rec2 is not None:
+        rec2 = advance(recs2, rec2[0])
+
+
+def _purge_unmated_partitioned(recs1, recs2, outf1, outf2, num_buckets):
+    ''' Pair up two fastq record streams in any order by hash partitioning
+        them by ID into num_buckets temp files on disk, joining each bucket in
+        memory, and merging the results back into the order of recs2.
+    '''
+    with util.file.tmp_dir(suffix='_purge_unmated') as t_dir:
+        paths1 = [os.path.join(t_dir, '{}.1.txt'.format(i)) for i in range(num_buckets)]
+        paths2 = [os.path.join(t_dir, '{}.2.txt'.format(i)) for i in range(num_buckets)]
+        paths_out = [os.path.join(t_dir, '{}.out.txt'.format(i)) for i in range(num_buckets)]
+
+        for paths, recs, with_ordinal in ((paths1, recs1, False), (paths2, recs2, True)):
+            outs = [open(path, 'wb') for path in paths]
+            try:
+                for ordinal, (read_id, seq, qual) in enumerate(recs):
+                    row = b'\t'.join((read_id, seq, qual)) + b'\n'
+                    if with_ordinal:
+                        row = str(ordinal).encode('utf-8') + b'\t' + row
+                    outs[zlib.crc32(read_id) % num_buckets].write(row)
+            finally:
+                for outf in outs:
+                    outf.close()
+
+        for path1, path2, path_out in zip(paths1, paths2, paths_out):
+            with open(path1, 'rb') as inf:
+                mates = {}
+                for row in inf:
+                    read_id, seq, qual = row.rstrip(b'\n').split(b'\t')
+                    mates.setdefault(read_id, (seq, qual))
+            with open(path2, 'rb') as inf, open(path_out, 'wb') as outf:
+                for row in inf:
+                    read_id = row.split(b'\t', 2)[1]
+                    if read_id in mates:
+                        seq, qual = mates.pop(read_id)
+                        outf.write(row.rstrip(b'\n') + b'\t' + seq + b'\t' + qual + b'\n')
+            os.unlink(path1)
+            os.unlink(path2)
+
+        def bucket_rows(path):
+            with open(path, 'rb') as inf:
+                for row in inf:
+                    ordinal, rest = row.split(b'\t', 1)
+                    yield (int(ordinal), rest)
+
+        for ordinal, row in heapq.merge(*[bucket_rows(path) for path in paths_out]):
+            read_id, seq2, qual2, seq1, qual1 = row.rstrip(b'\n').split(b'\t')
+            _write_mate(outf1, read_id, b'/1', seq1, qual1)
+            _write_mate(outf2, read_id, b'/2', seq2, qual2)
+
+
+def purge_unmated(inFastq1, inFastq2, outFastq1, outFastq2, regex=r'^@(\S+)/[1|2]$', threads=None, num_buckets=64):
+    '''Purge unmated reads, and put corresponding reads in the same order.
        Corresponding sequences must have sequence identifiers
        of the form SEQID/1 and SEQID/2.
+       Inputs sorted by ID are joined in a single streaming pass; otherwise
+       reads are hash-partitioned on disk so that memory use stays bounded.
+       Output is in the order of inFastq2. Fastq files may be gzipped.
     '''
-    tempOutput = mkstempfname()
-    mergeShuffledFastqSeqsPath = os.path.join(util.file.get_scripts_path(), 'mergeShuffledFastqSeqs.pl')
-    cmdline = [mergeShuffledFastqSeqsPath, '-t', '-r', regex, '-f1', inFastq1, '-f2', inFastq2, '-o', tempOutput]
-    log.debug(' '.join(cmdline))
-    util.misc.run_and_print(cmdline, check=True)
-    shutil.move(tempOutput + '.1.fastq', outFastq1)
-    shutil.move(tempOutput + '.2.fastq', outFastq2)
+    regex = re.compile(regex)
+    try:
+        with _fastq_writer(outFastq1, threads) as outf1, _fastq_writer(outFastq2, threads) as outf2:
+            _purge_unmated_sorted(_fastq_ids(inFastq1, regex, threads), _fastq_ids(inFastq2, regex, threads),
+                                  outf1, outf2)
+    except _UnsortedFastqError:
+        log.info("input fastqs are not sorted by read ID; pairing via on-disk hash partitions")
+        with _fastq_writer(outFastq1, threads) as outf1, _fastq_writer(outFastq2, threads) as outf2:
+            _purge_unmated_partitioned(_fastq_ids(inFastq1, regex, threads), _fastq_ids(inFastq2, regex, threads),
+                                       outf1, outf2, num_buckets)
     return 0
 
 
@@ -65,10 +179,17 @@ def parser_purge_unmated(parser=argparse.ArgumentParser()):
     parser.add_argument('outFastq2', help='Output fastq file; 2nd end of paired-end reads.')
     parser.add_argument(
         "--regex",
-        help="Perl regular expression to parse paired read IDs (default: %(default)s)",
+        help="Regular expression to parse paired read IDs (default: %(default)s)",
         default=r'^@(\S+)/[1|2]$'
     )
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    parser.add_argument(
+        "--numBuckets",
+        dest="num_buckets",
+        type=int,
+        default=64,
+        help="Number of on-disk partitions used to pair unsorted inputs (default: %(default)s)"
+    )
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, purge_unmated, split_args=True)
     return parser
 
@@ -370,37 +491,120 @@ __commands__.append(('sort_bam', parser_sort_bam))
 # ***  downsample_bams  ***
 # ====================
 
+def _template_sample_key(read, seed_prefix):
+    ''' A 64-bit pseudorandom key derived from the read name, so that all reads
+        of a template (mates, secondary/supplementary records) share the same key
+        and are kept or dropped together, regardless of sort order.
+    '''
+    digest = hashlib.md5(seed_prefix + read.query_name.encode('utf-8')).digest()
+    return struct.unpack('<Q', digest[:8])[0]
+
+
+def downsample_bam(inBam, outBam, read_count=None, fraction=None, random_seed=1, threads=None):
+    ''' Downsample inBam to outBam in a single streaming pass, keeping or
+        dropping whole templates (read pairs) at a time.
+
+        Exactly one of read_count or fraction must be given:
+          fraction: keep each template with this probability (constant memory).
+          read_count: keep the templates with the smallest pseudorandom keys,
+            as many as it takes to reach read_count reads (reservoir sampling;
+            holds up to read_count reads in memory). The output is exact up to
+            one template. Raises ValueError if inBam has fewer than read_count
+            reads, without writing outBam.
+
+        Output reads are written in input order. Results are deterministic for
+        a given random_seed. Returns a tuple of (reads in, reads out).
+    '''
+    if (read_count is None) == (fraction is None):
+        raise ValueError("Exactly one of read_count or fraction must be specified")
+    if fraction is not None and not 0 < fraction <= 1:
+        raise ValueError("Fraction must be in range (0,1]. This value was given: %s" % fraction)
+    threads = util.misc.sanitize_thread_count(threads)
+    seed_prefix = '{}\t'.format(random_seed).encode('utf-8')
+
+    n_in = 0
+    n_out = 0
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False, threads=threads) as inb:
+        if fraction is not None:
+            cutoff = int(fraction * 2**64)
+            with pysam.AlignmentFile(outBam, 'wb', template=inb, threads=threads) as outb:
+                for read in inb:
+                    n_in += 1
+                    if _template_sample_key(read, seed_prefix) < cutoff:
+                        outb.write(read)
+                        n_out += 1
+        else:
+            # key -> [(ordinal, read), ...] for the templates currently kept,
+            # plus a max-heap (of negated keys) to find the one to evict next
+            reservoir = {}
+            heap = []
+            for read in inb:
+                ordinal = n_in
+                n_in += 1
+                key = _template_sample_key(read, seed_prefix)
+                if key in reservoir:
+                    reservoir[key].append((ordinal, read))
+                elif n_out < read_count or (heap and key < -heap[0]):
+                    reservoir[key] = [(ordinal, read)]
+                    heapq.heappush(heap, -key)
+                else:
+                    continue
+                n_out += 1
+                while heap and n_out - len(reservoir[-heap[0]]) >= read_count:
+                    n_out -= len(reservoir.pop(-heapq.heappop(heap)))
+            if n_in < read_count:
+                raise ValueError(
+                    "%s has %s reads, which is less than the downsample target specified, %s. Please reduce the target count or omit it to use the read count of the smallest input file."
+                    % (inBam, n_in, read_count)
+                )
+            with pysam.AlignmentFile(outBam, 'wb', template=inb, threads=threads) as outb:
+                for ordinal, read in sorted(itertools.chain.from_iterable(reservoir.values()), key=lambda x: x[0]):
+                    outb.write(read)
+    log.info("downsampled %s from %s to %s reads", os.path.basename(inBam), n_in, n_out)
+    return (n_in, n_out)
+
+
 def parser_downsample_bams(parser=argparse.ArgumentParser()):
     parser.add_argument('in_bams', help='Input bam files.', nargs='+')
     parser.add_argument('--outPath', dest="out_path", type=str, help="""Output path. If not provided, 
                         downsampled bam files will be written to the same paths as each 
                         source bam file""")
-    parser.add_argument('--readCount', dest="specified_read_count", type=int, help='The number of reads to downsample to.')
+    target_group = parser.add_mutually_exclusive_group()
+    target_group.add_argument('--readCount', dest="specified_read_count", type=int, help='The number of reads to downsample to.')
+    target_group.add_argument('--fraction', dest="fraction", type=float,
+                              help='Keep this fraction of read pairs from each file, instead of downsampling to a read count.')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--deduplicateBefore', action='store_true', dest="deduplicate_before", help='de-duplicate reads before downsampling.')
     group.add_argument('--deduplicateAfter', action='store_true', dest="deduplicate_after", help='de-duplicate reads after downsampling.')
+    parser.add_argument('--randomSeed', dest="random_seed", type=int, default=1,
+                        help='Random seed for read selection; results are deterministic for a given seed (default: %(default)s)')
     parser.add_argument(
         '--JVMmemory',
         default=tools.picard.DownsampleSamTool.jvmMemDefault,
-        help='JVM virtual memory size (default: %(default)s)'
+        help='JVM virtual memory size, used for de-duplication (default: %(default)s)'
     )
     parser.add_argument(
         '--picardOptions',
         default=[],
         nargs='*',
-        help='Optional arguments to Picard\'s DownsampleSam, OPTIONNAME=value ...'
+        help='''Picard DownsampleSam options, OPTIONNAME=value ... Reads are now downsampled
+                natively: RANDOM_SEED is honored (in place of --randomSeed) and other options
+                are ignored with a warning.'''
     )
     util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, main_downsample_bams, split_args=True)
     return parser
 
 
-def main_downsample_bams(in_bams, out_path, specified_read_count=None, deduplicate_before=False, deduplicate_after=False, picardOptions=None, threads=None, JVMmemory=None):
-    '''Downsample multiple bam files to the smallest read count in common, or to the specified count.'''
-    if picardOptions is None:
-        picardOptions = []
+def main_downsample_bams(in_bams, out_path, specified_read_count=None, deduplicate_before=False, deduplicate_after=False, picardOptions=None, threads=None, JVMmemory=None, fraction=None, random_seed=1):
+    '''Downsample multiple bam files to the smallest read count in common, or to the specified count or fraction.'''
 
-    opts = list(picardOptions) + []
+    for opt in picardOptions or []:
+        key, _, value = opt.partition('=')
+        if key.upper() == 'RANDOM_SEED':
+            random_seed = int(value)
+        else:
+            log.warning("ignoring Picard option %s; reads are downsampled natively", opt)
 
     def get_read_counts(bams):
         samtools = tools.samtools.SamtoolsTool()
@@ -413,29 +617,27 @@ def main_downsample_bams(in_bams, out_path, specified_read_count=None, deduplica
         return read_counts
 
     def get_downsample_target_count(bams, readcount_requested):
-        read_counts = get_read_counts(bams)
-        downsample_target = 0
+        # a requested count or fraction is applied in a single pass; each file
+        # is checked against the requested count as it is sampled
+        if fraction is not None:
+            return fraction
         if readcount_requested is not None:
-            downsample_target = readcount_requested
-            if downsample_target > min(read_counts.values()):
-                raise ValueError("The smallest file has %s reads, which is less than the downsample target specified, %s. Please reduce the target count or omit it to use the read count of the smallest input file." % (min(read_counts.values()), downsample_target))
+            return readcount_requested
+        return min(get_read_counts(bams).values())
+
+    def downsample_bams(data_pairs, downsample_target, threads=None):
+        total_threads = util.misc.sanitize_thread_count(threads)
+        workers = max(1, min(len(data_pairs), total_threads))
+        if fraction is not None:
+            target_args = {'fraction': downsample_target}
         else:
-            downsample_target = min(read_counts.values())
-        return downsample_target
-
-    def downsample_bams(data_pairs, downsample_target, threads=None, JVMmemory=None):
-        downsamplesam = tools.picard.DownsampleSamTool()
-        workers = util.misc.sanitize_thread_count(threads)
-        JVMmemory = JVMmemory if JVMmemory else tools.picard.DownsampleSamTool.jvmMemDefault
-        jvm_worker_memory = str(max(1,int(JVMmemory.rstrip("g"))/workers))+'g'
-        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-            future_to_file = {executor.submit(downsamplesam.downsample_to_approx_count, *(list(fp)+[downsample_target]), JVMmemory=jvm_worker_memory): fp[0] for fp in data_pairs}
-            for future in concurrent.futures.as_completed(future_to_file):
-                f = future_to_file[future]
-                try:
-                    data = future.result()
-                except Exception as exc:
-                    raise
+            target_args = {'read_count': downsample_target}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(downsample_bam, inBam, outBam, random_seed=random_seed,
+                                       threads=max(1, total_threads // workers), **target_args)
+                       for inBam, outBam in data_pairs]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
 
     def dedup_bams(data_pairs, threads=None, JVMmemory=None):
         workers = util.misc.sanitize_thread_count(threads)
@@ -462,14 +664,14 @@ def main_downsample_bams(in_bams, out_path, specified_read_count=None, deduplica
                 data_pairs = list(zip(deduped_bams, [os.path.join(out_path, os.path.splitext(os.path.basename(x))[0]+".dedup.downsampled-{}.bam".format(downsample_target)) for x in in_bams]))
             else:
                 data_pairs = list(zip(deduped_bams, [os.path.splitext(x)[0]+".dedup.downsampled-{}.bam".format(downsample_target) for x in in_bams]))
-            downsample_bams(data_pairs, downsample_target, threads=threads, JVMmemory=JVMmemory)
+            downsample_bams(data_pairs, downsample_target, threads=threads)
     else:
         downsample_target = get_downsample_target_count(in_bams, specified_read_count)
         if deduplicate_after:
             log.warning("--deduplicateAfter has been specified. Read count of output files is not guaranteed.")
             with util.file.tempfnames(suffixes=[ '{}.downsampled-{}.bam'.format(os.path.splitext(os.path.basename(x))[0], downsample_target) for x in in_bams]) as downsampled_tmp_bams:
                 data_pairs = list(zip(in_bams, downsampled_tmp_bams))
-                downsample_bams(data_pairs, downsample_target, threads=threads, JVMmemory=JVMmemory)
+                downsample_bams(data_pairs, downsample_target, threads=threads)
                 
                 if out_path:
                     util.file.mkdir_p(out_path)
@@ -483,7 +685,7 @@ def main_downsample_bams(in_bams, out_path, specified_read_count=None, deduplica
                 data_pairs = list(zip(in_bams, [os.path.join(out_path, os.path.splitext(os.path.basename(x))[0]+".downsampled-{}.bam".format(downsample_target)) for x in in_bams]))
             else:
                 data_pairs = list(zip(in_bams, [os.path.splitext(x)[0]+".downsampled-{}.bam".format(downsample_target) for x in in_bams]))
-            downsample_bams(data_pairs, downsample_target, threads=threads, JVMmemory=JVMmemory)
+            downsample_bams(data_pairs, downsample_target, threads=threads)
     return 0
 
 __commands__.append(('downsample_bams', parser_downsample_bams))
@@ -507,13 +709,32 @@ def parser_merge_bams(parser=argparse.ArgumentParser()):
         nargs='*',
         help='Optional arguments to Picard\'s MergeSamFiles, OPTIONNAME=value ...'
     )
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    parser.add_argument(
+        '--engine',
+        default='picard',
+        choices=['picard', 'native'],
+        help='''Merge with Picard MergeSamFiles, or in-process with pysam (much faster
+                for small merges). The native merger honors SORT_ORDER from
+                --picardOptions (default: coordinate) and ignores other options.
+                (default: %(default)s)'''
+    )
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, main_merge_bams)
     return parser
 
 
 def main_merge_bams(args):
     '''Merge multiple BAMs into one'''
+    if args.engine == 'native':
+        sort_order = 'coordinate'    # the Picard default
+        for opt in args.picardOptions:
+            key, _, value = opt.partition('=')
+            if key.upper() == 'SORT_ORDER':
+                sort_order = value
+            else:
+                log.warning("ignoring Picard option %s with the native merger", opt)
+        tools.samtools.SamtoolsTool().merge_native(args.inBams, args.outBam, sort_order=sort_order, threads=args.threads)
+        return 0
     opts = list(args.picardOptions) + ['USE_THREADING=true']
     tools.picard.MergeSamFilesTool().execute(args.inBams, args.outBam, picardOptions=opts, JVMmemory=args.JVMmemory)
     return 0
@@ -577,6 +798,216 @@ __commands__.append(('filter_bam', parser_filter_bam))
 # =======================
 
 
+# Picard FastqToSam options that set read group fields
+FASTQ_TO_BAM_RG_OPTIONS = {
+    'READ_GROUP_NAME': 'ID',
+    'SAMPLE_NAME': 'SM',
+    'LIBRARY_NAME': 'LB',
+    'PLATFORM': 'PL',
+    'PLATFORM_UNIT': 'PU',
+    'PLATFORM_MODEL': 'PM',
+    'SEQUENCING_CENTER': 'CN',
+    'RUN_DATE': 'DT',
+    'DESCRIPTION': 'DS',
+    'PREDICTED_INSERT_SIZE': 'PI',
+    'PROGRAM_GROUP': 'PG',
+}
+# Picard options that do not affect FastqToSam output
+FASTQ_TO_BAM_IGNORED_OPTIONS = ('VERBOSITY', 'QUIET', 'VALIDATION_STRINGENCY', 'TMP_DIR', 'MAX_RECORDS_IN_RAM')
+
+
+def fastq_to_bam_read_group(sampleName, picardOptions=None):
+    ''' Build the read group that Picard FastqToSam would write for these
+        arguments (ID defaults to 'A'). Returns None if picardOptions contains
+        an option that fastq_to_ubam does not emulate.
+    '''
+    rg = {'ID': 'A', 'SM': sampleName}
+    for opt in picardOptions or []:
+        key, _, value = opt.partition('=')
+        key = key.upper()
+        if key in FASTQ_TO_BAM_RG_OPTIONS:
+            rg[FASTQ_TO_BAM_RG_OPTIONS[key]] = value
+        elif key not in FASTQ_TO_BAM_IGNORED_OPTIONS:
+            return None
+    return rg
+
+
+def _fastq_records(inFastq, threads=None):
+    ''' Yield (header line, sequence, quality string) as stripped bytes for
+        each record of a fastq file. Gzipped input is decompressed by pigz in a
+        separate process when available, so the two files of a pair
+        decompress in parallel.
+    '''
+    proc = None
+    if inFastq.endswith('.gz') and util.misc.which('pigz'):
+        proc = subprocess.Popen(['pigz', '-dc', '-p', str(util.misc.sanitize_thread_count(threads)), inFastq],
+                                stdout=subprocess.PIPE)
+        inf = proc.stdout
+    else:
+        inf = util.file.open_or_gzopen(inFastq, 'rb')
+    try:
+        while True:
+            line = inf.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            seq = inf.readline().rstrip()
+            plus = inf.readline()
+            qual = inf.readline().rstrip()
+            if not line.startswith(b'@') or not plus.startswith(b'+') or len(seq) != len(qual):
+                raise ValueError("Malformed fastq record in %s: %s" % (inFastq, line.rstrip().decode('utf-8')))
+            yield (line.rstrip(), seq, qual)
+    finally:
+        inf.close()
+        if proc is not None and proc.wait() not in (0, -13):
+            raise subprocess.CalledProcessError(proc.returncode, 'pigz -dc ' + inFastq)
+
+
+@contextmanager
+def _fastq_writer(outFastq, threads=None):
+    ''' Open a fastq file for writing bytes, compressing with pigz in a
+        separate process if the name ends in .gz and pigz is available.
+    '''
+    if outFastq.endswith('.gz') and util.misc.which('pigz'):
+        with open(outFastq, 'wb') as outf:
+            proc = subprocess.Popen(['pigz', '-c', '-p', str(util.misc.sanitize_thread_count(threads))],
+                                    stdin=subprocess.PIPE, stdout=outf)
+            try:
+                yield proc.stdin
+            finally:
+                proc.stdin.close()
+                if proc.wait() != 0:
+                    raise subprocess.CalledProcessError(proc.returncode, 'pigz -c > ' + outFastq)
+    else:
+        with util.file.open_or_gzopen(outFastq, 'wb') as outf:
+            yield outf
+
+
+def _read_fastq(inFastq, threads=None):
+    ''' Yield (name, sequence, quality string) for each record of a fastq
+        file, with any /1 or /2 suffix and comment stripped from the name.
+    '''
+    for line, seq, qual in _fastq_records(inFastq, threads):
+        name = line[1:].split(None, 1)[0]
+        if name.endswith(b'/1') or name.endswith(b'/2'):
+            name = name[:-2]
+        yield (name.decode('utf-8'), seq.decode('utf-8'), qual.decode('utf-8'))
+
+
+def _fastq_may_be_phred64(inFastq, max_records=10000):
+    ''' Whether the qualities of the first max_records reads of a fastq file
+        could be phred+64, i.e., none of them is below '@' (phred+33 Q31).
+        FastqToSam detects the quality encoding, but fastq_to_ubam assumes
+        phred+33, so such files are left to Picard.
+    '''
+    seen = False
+    for line, seq, qual in itertools.islice(_fastq_records(inFastq), max_records):
+        if qual:
+            if min(bytearray(qual)) < ord('@'):
+                return False
+            seen = True
+    return seen
+
+
+def _unaligned_segment(name, seq, qual, flag, rg_id):
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.query_sequence = seq
+    read.flag = flag
+    read.reference_id = -1
+    read.reference_start = -1
+    read.next_reference_id = -1
+    read.next_reference_start = -1
+    read.mapping_quality = 0
+    read.query_qualities = pysam.qualitystring_to_array(qual)
+    if rg_id is not None:
+        read.set_tag('RG', rg_id)
+    return read
+
+
+def _sorted_by_name(records, max_records_in_ram=500000):
+    ''' Yield tuples of strings sorted by their first element (the read name),
+        keeping records with the same name in input order. Names compare as
+        plain strings, which is Picard's queryname order. Runs of more than
+        max_records_in_ram records are sorted and spilled to temporary files,
+        then merged, so memory use stays bounded.
+    '''
+    records = iter(records)
+    run = list(itertools.islice(records, max_records_in_ram))
+    if len(run) < max_records_in_ram:
+        # everything fits in memory (list.sort is stable)
+        run.sort(key=lambda rec: rec[0])
+        for rec in run:
+            yield rec
+        return
+
+    def spilled_run(path, run_idx):
+        with open(path, 'rb') as inf:
+            for i, line in enumerate(inf):
+                rec = tuple(line.rstrip(b'\n').decode('utf-8').split('\t'))
+                yield (rec[0], run_idx, i, rec)
+
+    with util.file.tmp_dir(suffix='_sort_by_name') as t_dir:
+        paths = []
+        while run:
+            run.sort(key=lambda rec: rec[0])
+            paths.append(os.path.join(t_dir, '{}.txt'.format(len(paths))))
+            with open(paths[-1], 'wb') as outf:
+                for rec in run:
+                    outf.write('\t'.join(rec).encode('utf-8') + b'\n')
+            run = list(itertools.islice(records, max_records_in_ram))
+        for _, _, _, rec in heapq.merge(*[spilled_run(path, i) for i, path in enumerate(paths)]):
+            yield rec
+
+
+def fastq_to_ubam(inFastq1, inFastq2, outBam, header, threads=None, max_records_in_ram=500000):
+    ''' Convert fastq reads (paired if inFastq2 is given; either may be
+        gzipped) to an unaligned bam in a single streaming pass, like Picard
+        FastqToSam but with header applied at write time. header is a pysam
+        header dict; reads are tagged with its first read group, if any.
+        As with FastqToSam, reads are sorted by name (mates adjacent, read 1
+        first) and the header is marked SO:queryname. At most
+        max_records_in_ram reads (or pairs) are held in memory; larger inputs
+        are sorted in runs on disk and merged. Unlike FastqToSam, this does not
+        detect the quality encoding: qualities must be phred+33.
+        Raises ValueError if the two fastqs are not properly paired.
+        Returns the number of reads written.
+    '''
+    if max_records_in_ram < 1:
+        raise ValueError("max_records_in_ram must be at least 1, not %s" % max_records_in_ram)
+    threads = util.misc.sanitize_thread_count(threads)
+    header = dict(header)
+    hd = dict(header.get('HD', {}))
+    hd.setdefault('VN', '1.5')
+    hd['SO'] = 'queryname'
+    hd.pop('GO', None)
+    header['HD'] = hd
+    rg_id = header['RG'][0]['ID'] if header.get('RG') else None
+
+    def read_pairs():
+        for rec1, rec2 in zip_longest(_read_fastq(inFastq1, threads), _read_fastq(inFastq2, threads)):
+            if rec1 is None or rec2 is None:
+                raise ValueError("%s and %s have different numbers of reads" % (inFastq1, inFastq2))
+            if rec1[0] != rec2[0]:
+                raise ValueError("Mismatched read names in paired fastqs: %s and %s" % (rec1[0], rec2[0]))
+            yield rec1 + rec2[1:]
+
+    n_reads = 0
+    with pysam.AlignmentFile(outBam, 'wb', header=header, threads=threads) as outb:
+        if inFastq2:
+            # 0x1 paired, 0x4 unmapped, 0x8 mate unmapped, 0x40/0x80 first/second in pair
+            for name, seq1, qual1, seq2, qual2 in _sorted_by_name(read_pairs(), max_records_in_ram):
+                outb.write(_unaligned_segment(name, seq1, qual1, 0x1 | 0x4 | 0x8 | 0x40, rg_id))
+                outb.write(_unaligned_segment(name, seq2, qual2, 0x1 | 0x4 | 0x8 | 0x80, rg_id))
+                n_reads += 2
+        else:
+            for name, seq, qual in _sorted_by_name(_read_fastq(inFastq1, threads), max_records_in_ram):
+                outb.write(_unaligned_segment(name, seq, qual, 0x4, rg_id))
+                n_reads += 1
+    return n_reads
+
+
 def fastq_to_bam(
     inFastq1,
     inFastq2,
@@ -584,19 +1015,36 @@ def fastq_to_bam(
     sampleName=None,
     header=None,
     JVMmemory=tools.picard.FastqToSamTool.jvmMemDefault,
-    picardOptions=None
+    picardOptions=None,
+    threads=None
 ):
     ''' Convert a pair of fastq paired-end read files and optional text header
         to a single bam file.
     '''
     picardOptions = picardOptions or []
 
+    if sampleName is None:
+        sampleName = 'Dummy'    # Will get overwritten by rehead command
+    rg = fastq_to_bam_read_group(sampleName, picardOptions)
+    if rg is not None and not _fastq_may_be_phred64(inFastq1):
+        # every option is one we can emulate: convert natively, in one pass
+        if header:
+            with open(header, 'rt') as inf:
+                bam_header = pysam.AlignmentHeader.from_text(inf.read()).to_dict()
+        else:
+            bam_header = {'RG': [rg]}
+        max_records_in_ram = 500000    # the Picard default
+        for opt in picardOptions:
+            key, _, value = opt.partition('=')
+            if key.upper() == 'MAX_RECORDS_IN_RAM':
+                max_records_in_ram = int(value)
+        fastq_to_ubam(inFastq1, inFastq2, outBam, bam_header, threads=threads, max_records_in_ram=max_records_in_ram)
+        return 0
+
     if header:
         fastqToSamOut = mkstempfname('.bam')
     else:
         fastqToSamOut = outBam
-    if sampleName is None:
-        sampleName = 'Dummy'    # Will get overwritten by rehead command
     if header:
         # With the header option, rehead will be called after FastqToSam.
         # This will invalidate any md5 file, which would be a slow to construct
@@ -634,9 +1082,11 @@ def parser_fastq_to_bam(parser=argparse.ArgumentParser()):
         nargs='*',
         help='''Optional arguments to Picard\'s FastqToSam,
                 OPTIONNAME=value ...  Note that header-related options will be
-                overwritten by HEADER if present.'''
+                overwritten by HEADER if present. Options other than read group
+                fields fall back to running Picard, as do fastqs whose qualities
+                might be phred+64 (the in-process conversion assumes phred+33).'''
     )
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, fastq_to_bam, split_args=True)
     return parser
 
@@ -677,59 +1127,49 @@ defaultMaxReads = 1000
 defaultFormat = 'fastq'
 
 
-def split_bam(inBam, outBams):
+def _is_query_grouped(header):
+    ''' True if a BAM header dict says reads with the same name are adjacent,
+        either by queryname sorting or by query grouping (eg fastq_to_ubam).
+    '''
+    hd = header.get('HD', {})
+    return hd.get('SO') == 'queryname' or hd.get('GO') == 'query'
+
+
+def split_bam(inBam, outBams, threads=None):
     '''Split BAM file equally into several output BAM files. '''
-    samtools = tools.samtools.SamtoolsTool()
-    picard = tools.picard.PicardTools()
-
-    # get totalReadCount and maxReads
-    # maxReads = totalReadCount / num files, but round up to the nearest
-    # even number in order to keep read pairs together (assuming the input
-    # is sorted in query order and has no unmated reads, which can be
-    # accomplished by Picard RevertSam with SANITIZE=true)
-    totalReadCount = samtools.count(inBam)
-    maxReads = int(math.ceil(float(totalReadCount) / len(outBams) / 2) * 2)
-    log.info("splitting %d reads into %d files of %d reads each", totalReadCount, len(outBams), maxReads)
-
-    # load BAM header into memory
-    header = samtools.getHeader(inBam)
-    if 'SO:queryname' not in header[0]:
-        raise Exception('Input BAM file must be sorted in queryame order')
-
-    # dump to bigsam
-    bigsam = mkstempfname('.sam')
-    samtools.view(['-@', '3'], inBam, bigsam)
-
-    # split bigsam into little ones
-    with util.file.open_or_gzopen(bigsam, 'rt') as inf:
-        for outBam in outBams:
-            log.info("preparing file " + outBam)
-            tmp_sam_reads = mkstempfname('.sam')
-            with open(tmp_sam_reads, 'wt') as outf:
-                for row in header:
-                    outf.write('\t'.join(row) + '\n')
-                for _ in range(maxReads):
-                    line = inf.readline()
-                    if not line:
-                        break
-                    outf.write(line)
-                if outBam == outBams[-1]:
-                    for line in inf:
-                        outf.write(line)
-            picard.execute(
-                "SamFormatConverter", [
-                    'INPUT=' + tmp_sam_reads, 'OUTPUT=' + outBam, 'VERBOSITY=WARNING'
-                ],
-                JVMmemory='512m'
-            )
-            os.unlink(tmp_sam_reads)
-    os.unlink(bigsam)
+    # Reads are dealt out to the output files round-robin, one query name at
+    # a time, in a single streaming pass. This keeps read pairs together
+    # (the input must be sorted in queryname order) and leaves each output
+    # in queryname order, without needing a total read count up front.
+    threads = util.misc.sanitize_thread_count(threads)
+    # split the thread budget between BGZF decompression of the input and
+    # BGZF compression of each of the outputs
+    out_threads = max(1, threads // (len(outBams) + 1))
+
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False, threads=out_threads) as inb:
+        if not _is_query_grouped(inb.header.to_dict()):
+            raise Exception('Input BAM file must be sorted in queryname order')
+
+        outs = [pysam.AlignmentFile(outBam, 'wb', template=inb, threads=out_threads) for outBam in outBams]
+        read_counts = [0] * len(outs)
+        try:
+            for i, (_, reads) in enumerate(itertools.groupby(inb, key=lambda read: read.query_name)):
+                idx = i % len(outs)
+                for read in reads:
+                    outs[idx].write(read)
+                    read_counts[idx] += 1
+        finally:
+            for outb in outs:
+                outb.close()
+
+    for outBam, read_count in zip(outBams, read_counts):
+        log.info("wrote %d reads to %s", read_count, outBam)
 
 
 def parser_split_bam(parser=argparse.ArgumentParser()):
     parser.add_argument('inBam', help='Input BAM file.')
     parser.add_argument('outBams', nargs='+', help='Output BAM files')
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, split_bam, split_args=True)
     return parser
 
@@ -740,6 +1180,130 @@ __commands__.append(('split_bam', parser_split_bam))
 # ***  reheader_bam   ***
 # =======================
 
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+# htslib never puts more than this much uncompressed data in one BGZF block
+BGZF_BLOCK_DATA_SIZE = 0xff00
+
+
+def _read_bgzf_block(inf):
+    ''' Read one BGZF block from a file object. Returns a tuple of
+        (raw block bytes, decompressed data), or None at end of file.
+    '''
+    head = inf.read(12)
+    if not head:
+        return None
+    if len(head) < 12 or head[:4] != BGZF_MAGIC:
+        raise ValueError('not a BGZF file')
+    xlen = struct.unpack('<H', head[10:12])[0]
+    extra = inf.read(xlen)
+    bsize = None
+    pos = 0
+    while pos + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if extra[pos:pos + 2] == b'BC' and slen == 2:
+            bsize = struct.unpack('<H', extra[pos + 4:pos + 6])[0]
+        pos += 4 + slen
+    if bsize is None:
+        raise ValueError('not a BGZF file')
+    rest = inf.read(bsize + 1 - 12 - xlen)
+    data = zlib.decompress(rest[:-8], -15)
+    return (head + extra + rest, data)
+
+
+def _write_bgzf(outf, data, level=6):
+    ''' Write data to a file object as BGZF blocks. Returns bytes written. '''
+    written = 0
+    for start in range(0, len(data), BGZF_BLOCK_DATA_SIZE):
+        chunk = data[start:start + BGZF_BLOCK_DATA_SIZE]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(chunk) + compressor.flush()
+        block = (BGZF_MAGIC + b'\x00\x00\x00\x00\x00\xff' + struct.pack('<HBBHH', 6, ord('B'), ord('C'), 2, len(cdata) + 25) +
+                 cdata + struct.pack('<II', zlib.crc32(chunk) & 0xffffffff, len(chunk)))
+        outf.write(block)
+        written += len(block)
+    return written
+
+
+def _bam_header_length(data):
+    ''' Length in bytes of the binary BAM header at the start of data (magic,
+        text, and reference list), or None if data does not hold all of it yet.
+    '''
+    if len(data) < 8:
+        return None
+    if data[:4] != b'BAM\x01':
+        raise ValueError('not a BAM file')
+    pos = 8 + struct.unpack('<i', data[4:8])[0]
+    if len(data) < pos + 4:
+        return None
+    n_ref = struct.unpack('<i', data[pos:pos + 4])[0]
+    pos += 4
+    for i in range(n_ref):
+        if len(data) < pos + 4:
+            return None
+        pos += 4 + struct.unpack('<i', data[pos:pos + 4])[0] + 4
+    if len(data) < pos:
+        return None
+    return pos
+
+
+def _rename_header_text(text, mapper):
+    ''' Apply a "KEY:old" -> "KEY:new" mapping to the fields of @RG lines. '''
+    lines = []
+    for line in text.split('\n'):
+        if line.startswith('@RG\t'):
+            line = '\t'.join(mapper.get(x, x) for x in line.split('\t'))
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def reheader_bam_file(inBam, outBam, mapper):
+    ''' Copy inBam to outBam while renaming @RG header fields according to
+        mapper (a dict of "KEY:old" -> "KEY:new").
+
+        For BGZF-compressed BAM files only the blocks holding the header are
+        decompressed and rewritten; every block after that is copied byte for
+        byte, without recompression. Other inputs (SAM, CRAM) go through
+        samtools reheader.
+
+        Returns a tuple of (bytes rewritten, bytes copied) in outBam.
+    '''
+    with open(inBam, 'rb') as inf:
+        is_bgzf = inf.read(4) == BGZF_MAGIC
+    if not is_bgzf:
+        samtools = tools.samtools.SamtoolsTool()
+        with util.file.tempfname('.sam') as header_file:
+            with open(header_file, 'wt') as outf:
+                for row in samtools.getHeader(inBam):
+                    if row[0] == '@RG':
+                        row = [mapper.get(x, x) for x in row]
+                    outf.write('\t'.join(row) + '\n')
+            samtools.reheader(inBam, header_file, outBam)
+        return (os.path.getsize(outBam), 0)
+
+    with open(inBam, 'rb') as inf:
+        with open(outBam, 'wb') as outf:
+            data = b''
+            header_len = None
+            while header_len is None:
+                block = _read_bgzf_block(inf)
+                if block is None:
+                    raise ValueError('%s: truncated BAM header' % inBam)
+                data += block[1]
+                header_len = _bam_header_length(data)
+            l_text = struct.unpack('<i', data[4:8])[0]
+            text = data[8:8 + l_text].rstrip(b'\x00').decode('utf-8')
+            new_text = _rename_header_text(text, mapper).encode('utf-8')
+            new_header = b'BAM\x01' + struct.pack('<i', len(new_text)) + new_text + data[8 + l_text:header_len]
+
+            # the header, and any reads that share its last block, are recompressed
+            rewritten = _write_bgzf(outf, new_header)
+            if len(data) > header_len:
+                rewritten += _write_bgzf(outf, data[header_len:])
+            # everything after is copied verbatim, including the EOF marker block
+            copied = os.fstat(inf.fileno()).st_size - inf.tell()
+            shutil.copyfileobj(inf, outf)
+    return (rewritten, copied)
+
 
 def parser_reheader_bam(parser=argparse.ArgumentParser()):
     parser.add_argument('inBam', help='Input reads, BAM format.')
@@ -762,16 +1326,7 @@ def main_reheader_bam(args):
     '''
     # read mapping file
     mapper = dict((a + ':' + b, a + ':' + c) for a, b, c in util.file.read_tabfile(args.rgMap))
-    # read and convert bam header
-    header_file = mkstempfname('.sam')
-    with open(header_file, 'wt') as outf:
-        for row in tools.samtools.SamtoolsTool().getHeader(args.inBam):
-            if row[0] == '@RG':
-                row = [mapper.get(x, x) for x in row]
-            outf.write('\t'.join(row) + '\n')
-    # write new bam with new header
-    tools.samtools.SamtoolsTool().reheader(args.inBam, header_file, args.outBam)
-    os.unlink(header_file)
+    reheader_bam_file(args.inBam, args.outBam, mapper)
     return 0
 
 
@@ -780,7 +1335,7 @@ __commands__.append(('reheader_bam', parser_reheader_bam))
 
 def parser_reheader_bams(parser=argparse.ArgumentParser()):
     parser.add_argument('rgMap', help='Tabular file containing three columns: field, old, new.')
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, main_reheader_bams)
     return parser
 
@@ -799,19 +1354,20 @@ def main_reheader_bams(args):
     '''
     # read mapping file
     mapper = dict((a + ':' + b, a + ':' + c) for a, b, c in util.file.read_tabfile(args.rgMap) if a != 'FN')
-    files = list((b, c) for a, b, c in util.file.read_tabfile(args.rgMap) if a == 'FN')
-    header_file = mkstempfname('.sam')
-    # read and convert bam headers
-    for inBam, outBam in files:
-        if os.path.isfile(inBam):
-            with open(header_file, 'wt') as outf:
-                for row in tools.samtools.SamtoolsTool().getHeader(inBam):
-                    if row[0] == '@RG':
-                        row = [mapper.get(x, x) for x in row]
-                    outf.write('\t'.join(row) + '\n')
-            # write new bam with new header
-            tools.samtools.SamtoolsTool().reheader(inBam, header_file, outBam)
-    os.unlink(header_file)
+    files = list((b, c) for a, b, c in util.file.read_tabfile(args.rgMap) if a == 'FN' and os.path.isfile(b))
+    if not files:
+        return 0
+    # files are independent, so reheader them in parallel
+    workers = min(len(files), util.misc.sanitize_thread_count(args.threads))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(reheader_bam_file, inBam, outBam, mapper) for inBam, outBam in files]
+        total_rewritten = total_copied = 0
+        for (inBam, outBam), future in zip(files, futures):
+            rewritten, copied = future.result()
+            log.info("%s -> %s: %d bytes rewritten, %d bytes copied", inBam, outBam, rewritten, copied)
+            total_rewritten += rewritten
+            total_copied += copied
+    log.info("reheadered %d files: %d bytes rewritten, %d bytes copied", len(files), total_rewritten, total_copied)
     return 0
 
 
@@ -884,9 +1440,8 @@ def rmdup_cdhit_bam(inBam, outBam, max_mismatches=None, jvm_memory=None):
         for fn in in_fastqs:
             os.unlink(fn)
 
-    with util.file.fifo(name='merged.sam') as merged_bam:
-        merge_opts = ['SORT_ORDER=queryname']
-        tools.picard.MergeSamFilesTool().execute(out_bams, merged_bam, picardOptions=merge_opts, JVMmemory=jvm_memory, background=True)
+    with util.file.tempfname('.merged.bam') as merged_bam:
+        tools.samtools.SamtoolsTool().merge_native(out_bams, merged_bam, sort_order='queryname')
         tools.picard.ReplaceSamHeaderTool().execute(merged_bam, inBam, outBam, JVMmemory=jvm_memory)
 
 
@@ -936,12 +1491,16 @@ def _merge_fastqs_and_mvicuna(lb, files):
 
     return readList
 
-def rmdup_mvicuna_bam(inBam, outBam, JVMmemory=None):
+def rmdup_mvicuna_bam(inBam, outBam, JVMmemory=None, engine='mvicuna', threads=None):
     ''' Remove duplicate reads from BAM file using M-Vicuna. The
         primary advantage to this approach over Picard's MarkDuplicates tool
         is that Picard requires that input reads are aligned to a reference,
         and M-Vicuna can operate on unaligned reads.
+        With engine='native', duplicates are instead removed in-process by
+        rmdup_prefix_bam, without conversion to FASTQ, M-Vicuna or Picard.
     '''
+    if engine == 'native':
+        return rmdup_prefix_bam(inBam, outBam, threads=threads)
 
     # Convert BAM -> FASTQ pairs per read group and load all read groups
     tempDir = tempfile.mkdtemp()
@@ -989,7 +1548,18 @@ def parser_rmdup_mvicuna_bam(parser=argparse.ArgumentParser()):
         default=tools.picard.FilterSamReadsTool.jvmMemDefault,
         help='JVM virtual memory size (default: %(default)s)'
     )
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    parser.add_argument(
+        '--engine',
+        default='mvicuna',
+        choices=['mvicuna', 'native'],
+        help='''Remove duplicates with M-Vicuna, or in-process in a single streaming
+                pass over the BAM. The native engine calls read pairs from the same
+                library duplicates if the first 50 bases of both mates match exactly
+                (M-Vicuna also tolerates a few mismatches), and keeps unmated reads
+                (de-duplicated on their own) where M-Vicuna drops them.
+                (default: %(default)s)'''
+    )
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, rmdup_mvicuna_bam, split_args=True)
     return parser
 
@@ -997,6 +1567,180 @@ def parser_rmdup_mvicuna_bam(parser=argparse.ArgumentParser()):
 __commands__.append(('rmdup_mvicuna_bam', parser_rmdup_mvicuna_bam))
 
 
+def _read_pairs(bam):
+    ''' Iterate over a queryname-grouped BAM, yielding the list of records
+        sharing each query name (i.e. a read pair, or a lone unmated read).
+    '''
+    for _, reads in itertools.groupby(bam, key=lambda read: read.query_name):
+        yield list(reads)
+
+
+def _pair_dup_key(reads, library, prefix_len):
+    ''' Hash the library name and the first prefix_len bases of each mate
+        into a 64-bit integer key.
+    '''
+    seqs = [None, None]
+    for read in reads:
+        idx = 1 if read.is_read2 else 0
+        if seqs[idx] is None:
+            seqs[idx] = (read.query_sequence or '')[:prefix_len]
+    key = '\t'.join((library, seqs[0] or '', seqs[1] or '')).encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+
+def rmdup_prefix_bam(inBam, outBam, prefix_len=50, max_keys_in_memory=10000000, num_buckets=64, threads=None):
+    ''' Remove duplicate reads from BAM file in a single streaming pass,
+        without conversion to FASTQ or any external tools. Like M-Vicuna's
+        DupRm, read pairs from the same library are considered duplicates
+        if the first prefix_len bases of both mates are identical; the first
+        pair encountered is kept. Unlike M-Vicuna, mismatches are not
+        tolerated and unmated reads are de-duplicated (on their own prefix)
+        rather than dropped. The output preserves the input order. This is
+        the native engine of rmdup_mvicuna_bam.
+
+        Pair keys are held in memory as 64-bit hashes. If more than
+        max_keys_in_memory distinct keys are seen, the remaining reads are
+        hash-partitioned into num_buckets temp files on disk, each of which
+        is de-duplicated separately and merged back in input order.
+    '''
+    threads = util.misc.sanitize_thread_count(threads)
+    io_threads = max(1, threads // 2)
+
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as bam:
+        header = bam.header.to_dict()
+    if not _is_query_grouped(header):
+        # mates must be adjacent for single-pass pairing
+        log.info("input is not sorted in queryname order; sorting before duplicate removal")
+        sortedBam = mkstempfname('.sorted.bam')
+        pysam.sort('-n', '-@', str(threads), '-o', sortedBam, inBam, catch_stdout=False)
+        try:
+            return rmdup_prefix_bam(sortedBam, outBam, prefix_len=prefix_len, max_keys_in_memory=max_keys_in_memory,
+                                    num_buckets=num_buckets, threads=threads)
+        finally:
+            os.unlink(sortedBam)
+
+    rg_to_lb = dict((rg['ID'], rg.get('LB', 'none')) for rg in header.get('RG', []))
+    log.info("found %d distinct libraries and %d read groups", len(set(rg_to_lb.values())), len(rg_to_lb))
+
+    seen = set()
+    buckets = None
+    total_pairs = 0
+    kept_pairs = 0
+    with util.file.tmp_dir(suffix='_rmdup_buckets') as bucket_dir:
+        with pysam.AlignmentFile(inBam, 'rb', check_sq=False, threads=io_threads) as inb:
+            with pysam.AlignmentFile(outBam, 'wb', template=inb, threads=io_threads) as outb:
+                try:
+                    for ordinal, reads in enumerate(_read_pairs(inb)):
+                        total_pairs += 1
+                        rg = reads[0].get_tag('RG') if reads[0].has_tag('RG') else None
+                        key = _pair_dup_key(reads, rg_to_lb.get(rg, 'none'), prefix_len)
+
+                        if buckets is None:
+                            if key not in seen:
+                                seen.add(key)
+                                kept_pairs += 1
+                                for read in reads:
+                                    outb.write(read)
+                                if len(seen) >= max_keys_in_memory:
+                                    log.info("more than %d distinct read pairs seen; spilling to %d buckets on disk",
+                                             max_keys_in_memory, num_buckets)
+                                    buckets = _DupBuckets(bucket_dir, inb, num_buckets, seen)
+                                    seen = None
+                        else:
+                            buckets.add(key, ordinal, reads)
+
+                    if buckets is not None:
+                        for reads in buckets.dedup_and_merge():
+                            kept_pairs += 1
+                            for read in reads:
+                                outb.write(read)
+                finally:
+                    if buckets is not None:
+                        buckets.close()
+
+    log.info("kept %d of %d read pairs/unmated reads", kept_pairs, total_pairs)
+    return 0
+
+
+def _read_uint64s(path):
+    ''' load a file of packed little-endian 64-bit unsigned integers '''
+    with open(path, 'rb') as inf:
+        data = inf.read()
+    return struct.unpack('<{}Q'.format(len(data) // 8), data)
+
+
+class _DupBuckets(object):
+    ''' On-disk hash partitions of read pairs for rmdup_prefix_bam. All pairs
+        with the same key land in the same bucket, so each bucket can be
+        de-duplicated independently with 1/num_buckets of the memory.
+        Ordinals (input positions) are kept alongside the reads so that the
+        per-bucket survivors can be merged back in original order. The bucket
+        files are written to tmp_dir, which the caller removes.
+    '''
+
+    def __init__(self, tmp_dir, template, num_buckets, seen_keys):
+        self.tmp_dir = tmp_dir
+        self.num_buckets = num_buckets
+        self.bams = []
+        self.ordinals = []
+        self.keys = []
+        for i in range(num_buckets):
+            self.bams.append(pysam.AlignmentFile(self._path(i, 'bam'), 'wb0', template=template))
+            self.ordinals.append(open(self._path(i, 'ordinals'), 'wb'))
+            self.keys.append(open(self._path(i, 'keys'), 'wb'))
+
+        # keys already seen (and written out) before spilling
+        seen_per_bucket = [[] for _ in range(num_buckets)]
+        for key in seen_keys:
+            seen_per_bucket[key % num_buckets].append(key)
+        for i, keys in enumerate(seen_per_bucket):
+            with open(self._path(i, 'seen'), 'wb') as outf:
+                outf.write(struct.pack('<{}Q'.format(len(keys)), *keys))
+
+    def _path(self, i, ext):
+        return os.path.join(self.tmp_dir, '{}.{}'.format(i, ext))
+
+    def add(self, key, ordinal, reads):
+        i = key % self.num_buckets
+        for read in reads:
+            self.bams[i].write(read)
+        self.ordinals[i].write(struct.pack('<Q', ordinal))
+        self.keys[i].write(struct.pack('<Q', key))
+
+    def _dedup_bucket(self, i):
+        ''' de-duplicate one bucket, writing survivors and returning their ordinals '''
+        seen = set(_read_uint64s(self._path(i, 'seen')))
+        ordinals = _read_uint64s(self._path(i, 'ordinals'))
+        keys = _read_uint64s(self._path(i, 'keys'))
+        kept_ordinals = []
+        with pysam.AlignmentFile(self._path(i, 'bam'), 'rb', check_sq=False) as inb:
+            with pysam.AlignmentFile(self._path(i, 'kept.bam'), 'wb0', template=inb) as outb:
+                for j, reads in enumerate(_read_pairs(inb)):
+                    if keys[j] not in seen:
+                        seen.add(keys[j])
+                        kept_ordinals.append(ordinals[j])
+                        for read in reads:
+                            outb.write(read)
+        return kept_ordinals
+
+    def _iter_kept(self, i, kept_ordinals):
+        with pysam.AlignmentFile(self._path(i, 'kept.bam'), 'rb', check_sq=False) as inb:
+            for j, reads in enumerate(_read_pairs(inb)):
+                yield (kept_ordinals[j], reads)
+
+    def close(self):
+        for f in self.bams + self.ordinals + self.keys:
+            f.close()
+
+    def dedup_and_merge(self):
+        ''' yield the surviving read pairs of all buckets in input order '''
+        self.close()
+        kept = [self._dedup_bucket(i) for i in range(self.num_buckets)]
+        # ordinals are unique, so the merge never needs to compare reads
+        for _, reads in heapq.merge(*[self._iter_kept(i, kept[i]) for i in range(self.num_buckets)]):
+            yield reads
+
+
 
 def parser_rmdup_prinseq_fastq(parser=argparse.ArgumentParser()):
     parser.add_argument('inFastq1', help='Input fastq file; 1st end of paired-end reads.')
@@ -1184,6 +1928,93 @@ def main_gatk_realign(args):
 
 __commands__.append(('gatk_realign', parser_gatk_realign))
 
+# ================================
+# ***  reference index cache   ***
+# ================================
+
+# environment variable naming a default directory for indexed_reference's cache
+REF_INDEX_CACHE_ENV = 'VIRAL_NGS_REF_INDEX_CACHE'
+
+
+def _file_sha256(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as inf:
+        for chunk in iter(lambda: inf.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _build_reference_index(refFasta, index_type, novoalign_license_path=None):
+    ''' Build one kind of index next to refFasta (which must end in .fasta) '''
+    if index_type == 'picard':
+        tools.picard.CreateSequenceDictionaryTool().execute(refFasta, overwrite=True)
+    elif index_type == 'samtools':
+        tools.samtools.SamtoolsTool().faidx(refFasta, overwrite=True)
+    elif index_type == 'novoalign':
+        tools.novoalign.NovoalignTool(license_path=novoalign_license_path).index_fasta(refFasta)
+    elif index_type == 'bwa':
+        tools.bwa.Bwa().index(refFasta)
+    else:
+        raise ValueError("unrecognized index type: {}".format(index_type))
+
+
+@contextmanager
+def _exclusive_lock(lock_file):
+    with open(lock_file, 'a') as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+
+@contextmanager
+def indexed_reference(refFasta, index_types=('picard', 'samtools'), cache_dir=None, novoalign_license_path=None):
+    ''' Yield the path of a copy of refFasta that has been indexed for each of
+        index_types ('picard', 'samtools', 'novoalign', and/or 'bwa').
+
+        If cache_dir is given (or the VIRAL_NGS_REF_INDEX_CACHE environment
+        variable is set), indexes are kept there, keyed by the SHA-256 of the
+        reference contents, and each is built only once per distinct reference.
+        Builds are serialized with a file lock, so concurrent jobs against the
+        same reference wait for one another rather than duplicating work; the
+        cache should be on a local disk where flock is reliable.
+
+        Otherwise, the reference is copied to a temp directory and indexed
+        from scratch.
+    '''
+    cache_dir = cache_dir or os.environ.get(REF_INDEX_CACHE_ENV)
+
+    if not cache_dir:
+        with util.file.tmp_dir(suffix='_ref_index') as t_dir:
+            refFastaCopy = os.path.join(t_dir, 'ref.fasta')
+            shutil.copyfile(refFasta, refFastaCopy)
+            for index_type in index_types:
+                _build_reference_index(refFastaCopy, index_type, novoalign_license_path=novoalign_license_path)
+            yield refFastaCopy
+        return
+
+    util.file.mkdir_p(cache_dir)
+    entry = os.path.join(cache_dir, _file_sha256(refFasta))
+    cachedFasta = os.path.join(entry, 'ref.fasta')
+    with _exclusive_lock(entry + '.lock'):
+        util.file.mkdir_p(entry)
+        if not os.path.isfile(cachedFasta):
+            shutil.copyfile(refFasta, cachedFasta + '.tmp')
+            os.rename(cachedFasta + '.tmp', cachedFasta)
+        for index_type in index_types:
+            # the marker is only written once the index is complete, so an
+            # interrupted build is redone by the next caller
+            marker = os.path.join(entry, '.{}.done'.format(index_type))
+            if os.path.isfile(marker):
+                log.debug("using cached %s index for %s", index_type, refFasta)
+            else:
+                log.info("building %s index for %s in %s", index_type, refFasta, entry)
+                _build_reference_index(cachedFasta, index_type, novoalign_license_path=novoalign_license_path)
+                util.file.touch(marker)
+    yield cachedFasta
+
+
 # =========================
 
 
@@ -1197,7 +2028,8 @@ def align_and_fix(
     threads=None,
     skip_mark_dupes=False,
     gatk_path=None,
-    novoalign_license_path=None
+    novoalign_license_path=None,
+    ref_index_cache=None
 ):
     ''' Take reads, align to reference with Novoalign, optionally mark duplicates
         with Picard, realign indels with GATK, and optionally filters
@@ -1209,51 +2041,45 @@ def align_and_fix(
 
     assert aligner in ["novoalign", "bwa"]
 
-    refFastaCopy = mkstempfname('.ref_copy.fasta')
-    shutil.copyfile(refFasta, refFastaCopy)
-
-    tools.picard.CreateSequenceDictionaryTool().execute(refFastaCopy, overwrite=True)
-    tools.samtools.SamtoolsTool().faidx(refFastaCopy, overwrite=True)
-
     if aligner_options is None:
         if aligner=="novoalign":
             aligner_options = '-r Random'
         elif aligner=='bwa':
             aligner_options = '' # use defaults
 
-    bam_aligned = mkstempfname('.aligned.bam')
-    if aligner=="novoalign":
+    with indexed_reference(refFasta, ('picard', 'samtools', aligner), cache_dir=ref_index_cache,
+                           novoalign_license_path=novoalign_license_path) as refFastaCopy:
 
-        tools.novoalign.NovoalignTool(license_path=novoalign_license_path).index_fasta(refFastaCopy)
+        bam_aligned = mkstempfname('.aligned.bam')
+        if aligner=="novoalign":
 
-        tools.novoalign.NovoalignTool(license_path=novoalign_license_path).execute(
-            inBam, refFastaCopy, bam_aligned,
-            options=aligner_options.split(),
-            JVMmemory=JVMmemory
-        )
-    elif aligner=='bwa':
-        bwa = tools.bwa.Bwa()
-        bwa.index(refFastaCopy)
+            tools.novoalign.NovoalignTool(license_path=novoalign_license_path).execute(
+                inBam, refFastaCopy, bam_aligned,
+                options=aligner_options.split(),
+                JVMmemory=JVMmemory
+            )
+        elif aligner=='bwa':
+            bwa = tools.bwa.Bwa()
 
-        opts = aligner_options.split()
+            opts = aligner_options.split()
 
-        bwa.align_mem_bam(inBam, refFastaCopy, bam_aligned, options=opts)
+            bwa.align_mem_bam(inBam, refFastaCopy, bam_aligned, options=opts)
 
-    if skip_mark_dupes:
-        bam_marked = bam_aligned
-    else:
-        bam_marked = mkstempfname('.mkdup.bam')
-        tools.picard.MarkDuplicatesTool().execute(
-            [bam_aligned], bam_marked, picardOptions=['CREATE_INDEX=true'],
-            JVMmemory=JVMmemory
-        )
-        os.unlink(bam_aligned)
+        if skip_mark_dupes:
+            bam_marked = bam_aligned
+        else:
+            bam_marked = mkstempfname('.mkdup.bam')
+            tools.picard.MarkDuplicatesTool().execute(
+                [bam_aligned], bam_marked, picardOptions=['CREATE_INDEX=true'],
+                JVMmemory=JVMmemory
+            )
+            os.unlink(bam_aligned)
 
-    tools.samtools.SamtoolsTool().index(bam_marked)
+        tools.samtools.SamtoolsTool().index(bam_marked)
 
-    bam_realigned = mkstempfname('.realigned.bam')
-    tools.gatk.GATKTool(path=gatk_path).local_realign(bam_marked, refFastaCopy, bam_realigned, JVMmemory=JVMmemory, threads=threads)
-    os.unlink(bam_marked)
+        bam_realigned = mkstempfname('.realigned.bam')
+        tools.gatk.GATKTool(path=gatk_path).local_realign(bam_marked, refFastaCopy, bam_realigned, JVMmemory=JVMmemory, threads=threads)
+        os.unlink(bam_marked)
 
     if outBamAll:
         shutil.copyfile(bam_realigned, outBamAll)
@@ -1301,6 +2127,14 @@ def parser_align_and_fix(parser=argparse.ArgumentParser()):
         dest="novoalign_license_path",
         help='A path to the novoalign.lic file. This overrides the NOVOALIGN_LICENSE_PATH environment variable. (default: %(default)s)'
     )
+    parser.add_argument(
+        '--refIndexCache',
+        default=None,
+        dest="ref_index_cache",
+        help='''Directory (on local disk) in which to cache reference indexes, keyed by reference
+                contents, so that they are only built once per reference. (default: the {}
+                environment variable if set, otherwise indexes are rebuilt on every call)'''.format(REF_INDEX_CACHE_ENV)
+    )
     util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, align_and_fix, split_args=True)
     return parser
@@ -1312,7 +2146,7 @@ __commands__.append(('align_and_fix', parser_align_and_fix))
 
 
 def bwamem_idxstats(inBam, refFasta, outBam=None, outStats=None,
-        min_score_to_filter=None, aligner_options=None):
+        min_score_to_filter=None, aligner_options=None, ref_index_cache=None):
     ''' Take reads, align to reference with BWA-MEM and perform samtools idxstats.
     '''
 
@@ -1326,13 +2160,10 @@ def bwamem_idxstats(inBam, refFasta, outBam=None, outStats=None,
     samtools = tools.samtools.SamtoolsTool()
     bwa = tools.bwa.Bwa()
 
-    ref_indexed = util.file.mkstempfname('.reference.fasta')
-    shutil.copyfile(refFasta, ref_indexed)
-    bwa.index(ref_indexed)
-
     bwa_opts = [] if aligner_options is None else aligner_options.split()
-    bwa.mem(inBam, ref_indexed, bam_aligned, options=bwa_opts,
-            min_score_to_filter=min_score_to_filter)
+    with indexed_reference(refFasta, ('bwa',), cache_dir=ref_index_cache) as ref_indexed:
+        bwa.mem(inBam, ref_indexed, bam_aligned, options=bwa_opts,
+                min_score_to_filter=min_score_to_filter)
 
     if outStats is not None:
         samtools.idxstats(bam_aligned, outStats)
@@ -1366,6 +2197,14 @@ def parser_bwamem_idxstats(parser=argparse.ArgumentParser()):
         '--alignerOptions',
         dest="aligner_options",
         help="bwa options (default: bwa defaults)")
+    parser.add_argument(
+        '--refIndexCache',
+        default=None,
+        dest="ref_index_cache",
+        help='''Directory (on local disk) in which to cache reference indexes, keyed by reference
+                contents, so that they are only built once per reference. (default: the {}
+                environment variable if set, otherwise indexes are rebuilt on every call)'''.format(REF_INDEX_CACHE_ENV)
+    )
     util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, bwamem_idxstats, split_args=True)
     return parser
@@ -1396,9 +2235,9 @@ __commands__.append(('extract_tarball', parser_extract_tarball))
 
 # =========================
 
-def fasta_read_names(in_fasta, out_read_names):
-    """Save the read names of reads in a .fasta file to a text file"""
-    with util.file.open_or_gzopen(in_fasta) as in_fasta_f, open(out_read_names, 'wt') as out_read_names_f:
+def _fasta_read_names(in_fasta):
+    """Yield the read names in a .fasta file, collapsing mates into one"""
+    with util.file.open_or_gzopen(in_fasta) as in_fasta_f:
         last_read_name = None
         for line in in_fasta_f:
             if line.startswith('>'):
@@ -1406,22 +2245,68 @@ def fasta_read_names(in_fasta, out_read_names):
                 if read_name.endswith('/1') or read_name.endswith('/2'):
                     read_name = read_name[:-2]
                 if read_name != last_read_name:
-                    out_read_names_f.write(read_name+'\n')
+                    yield read_name
                 last_read_name = read_name
 
 
-def read_names(in_reads, out_read_names, threads=None):
-    """Extract read names from a sequence file"""
-    _in_reads = in_reads
-    with util.file.tmp_dir(suffix='_read_names.txt') as t_dir:
-        if in_reads.endswith('.bam'):
-            _in_reads = os.path.join(t_dir, 'reads.fasta')
-            tools.samtools.SamtoolsTool().bam2fa(in_reads, _in_reads)
-        fasta_read_names(_in_reads, out_read_names)
+def fasta_read_names(in_fasta, out_read_names):
+    """Save the read names of reads in a .fasta file to a text file"""
+    with open(out_read_names, 'wt') as out_read_names_f:
+        for read_name in _fasta_read_names(in_fasta):
+            out_read_names_f.write(read_name+'\n')
+
+
+def read_name_hash(read_name):
+    """64-bit hash of a read name, as stored in a hashed read name set"""
+    return struct.unpack('<Q', hashlib.md5(read_name.encode('utf-8')).digest()[:8])[0]
+
+
+def load_read_name_hashes(in_hashes):
+    """Load a hashed read name set (written by read_names with hashed=True)
+    as a python set; test membership with read_name_hash(name) in the set."""
+    return set(_read_uint64s(in_hashes))
+
+
+def bam_read_names(in_bam, threads=None):
+    """Yield the read names in a bam file, collapsing consecutive records with
+    the same name (mates) into one and skipping secondary and supplementary
+    alignments, as samtools fasta does."""
+    with pysam.AlignmentFile(in_bam, 'rb', check_sq=False, threads=util.misc.sanitize_thread_count(threads)) as inb:
+        last_read_name = None
+        for read in inb:
+            if read.is_secondary or read.is_supplementary:
+                continue
+            read_name = read.query_name
+            if read_name != last_read_name:
+                yield read_name
+            last_read_name = read_name
+
+
+def read_names(in_reads, out_read_names, threads=None, hashed=False):
+    """Extract read names from a sequence file. With hashed=True, write a
+    compact binary set instead of text: the sorted, unique 64-bit hashes
+    of the read names (see read_name_hash and load_read_name_hashes)."""
+    if in_reads.endswith('.bam'):
+        names = bam_read_names(in_reads, threads=threads)
+    else:
+        names = _fasta_read_names(in_reads)
+
+    if hashed:
+        hashes = sorted(set(read_name_hash(name) for name in names))
+        with open(out_read_names, 'wb') as outf:
+            for i in range(0, len(hashes), 65536):
+                chunk = hashes[i:i + 65536]
+                outf.write(struct.pack('<{}Q'.format(len(chunk)), *chunk))
+    else:
+        with open(out_read_names, 'wt') as outf:
+            for name in names:
+                outf.write(name + '\n')
 
 def parser_read_names(parser=argparse.ArgumentParser()):
     parser.add_argument('in_reads', help='the input reads ([compressed] fasta or bam)')
     parser.add_argument('out_read_names', help='the read names')
+    parser.add_argument('--hashed', action='store_true', default=False,
+                        help='write a binary set of sorted 64-bit read name hashes instead of a text list')
     util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, read_names, split_args=True)
     return parser
@@ -5,6 +5,7 @@ __author__ = "dpark@broadinstitute.org"
 import assembly
 import util.cmd
 import util.file
+import Bio.Seq
 import Bio.SeqIO
 import Bio.Data.IUPACData
 import unittest
@@ -15,11 +16,14 @@ import shutil
 import tempfile
 import argparse
 import itertools
+import random
 import pytest
+import pysam
 import tools.mummer
 import tools.novoalign
 import tools.picard
 from test import TestCaseWithTmp, _CPUS
+from mock import patch
 
 
 def makeFasta(seqs, outFasta):
@@ -537,6 +541,39 @@ class TestImputeFromReference(TestCaseWithTmp):
             str(Bio.SeqIO.read(outFasta, 'fasta').seq),
             str(Bio.SeqIO.read(expected, 'fasta').seq))
 
+    def test_segments_in_parallel(self):
+        # stand in for the aligner: the test segments are already the same
+        # length as their references, so the unaligned pair is an alignment
+        def fake_align(self, inFasta, outFasta, **kwargs):
+            shutil.copyfile(inFasta, outFasta)
+        refs = ['ACGTACGTAC' * 3, 'GGGGCCCCAA' * 3, 'TTTTAAAACC' * 3, 'CACACAGTGT' * 3]
+        asms = [ref[:12] + 'NNNN' + ref[16:] for ref in refs]
+        inRef = util.file.mkstempfname('.ref.fasta')
+        inFasta = util.file.mkstempfname('.asm.fasta')
+        util.file.makeFastaFile([('ref{}'.format(i), seq) for i, seq in enumerate(refs)], inRef)
+        util.file.makeFastaFile([('asm{}'.format(i), seq) for i, seq in enumerate(asms)], inFasta)
+        outFasta = util.file.mkstempfname('.fasta')
+        with patch('tools.muscle.MuscleTool.execute', fake_align):
+            assembly.impute_from_reference(
+                inFasta, inRef, outFasta,
+                minLengthFraction=0.8, minUnambig=0.5, replaceLength=2,
+                newName='sample', aligner='muscle', threads=4)
+        out = list(Bio.SeqIO.parse(outFasta, 'fasta'))
+        self.assertEqual([seq.id for seq in out], ['sample-1', 'sample-2', 'sample-3', 'sample-4'])
+        self.assertEqual([str(seq.seq) for seq in out], refs)
+
+
+class TestModifyContig(TestCaseWithTmp):
+
+    def test_call_reference_ns(self):
+        inAln = util.file.mkstempfname('.fasta')
+        util.file.makeFastaFile([('ref', 'ACGTACGTAC'), ('contig', 'ACNNACGTA-')], inAln)
+        outFasta = util.file.mkstempfname('.fasta')
+        assembly.modify_contig(inAln, outFasta, 'ref', call_reference_ns=True)
+        out = Bio.SeqIO.read(outFasta, 'fasta')
+        self.assertEqual(out.id, 'contig')
+        self.assertEqual(str(out.seq), 'ACGTACGTA')
+
 
 class TestMutableSequence(unittest.TestCase):
     ''' Test the MutableSequence class '''
@@ -573,6 +610,16 @@ class TestMutableSequence(unittest.TestCase):
         x.modify(8, 'Y')
         self.assertEqual(x.emit(), ('chr', 'GjGY'))
 
+    def test_get(self):
+        x = assembly.MutableSequence('chr', 5, 8, 'ATCG')
+        self.assertRaises(IndexError, x.get, 4)
+        self.assertRaises(IndexError, x.get, 9)
+        self.assertEqual([x.get(p) for p in range(5, 9)], ['A', 'T', 'C', 'G'])
+        x.modify(6, 'GAT')
+        x.modify(7, '')
+        x.modify(8, 'Y')
+        self.assertEqual([x.get(p) for p in range(5, 9)], ['A', 'GAT', '', 'Y'])
+
     def test_modify_blank(self):
         x = assembly.MutableSequence('chr', 5, 8)
         self.assertEqual(x.emit(), ('chr', 'NNNN'))
@@ -618,6 +665,67 @@ class TestMutableSequence(unittest.TestCase):
         x.replay_deletions()
         self.assertEqual(x.emit(), ('chr', 'ATG'))
 
+    def test_modify_deletions_then_insertion(self):
+        x = assembly.MutableSequence('chr', 1, 6, 'ATCGAT')
+        x.modify(3, 'CCC')
+        x.replace(2, 4, 'T')
+        self.assertEqual(x.emit(), ('chr', 'ATAT'))
+        x.modify(3, 'GG')
+        self.assertEqual(x.emit(), ('chr', 'ATGGAT'))
+        x.replay_deletions()
+        self.assertEqual(x.emit(), ('chr', 'ATAT'))
+
+    @pytest.mark.slow
+    def test_large_contig(self):
+        # 1 Mb contig with thousands of non-overlapping SNPs, insertions and
+        # deletions, checked against splicing the edits into a plain string
+        rng = random.Random(1)
+        length = 1000000
+        init = ''.join(rng.choice('ACGT') for i in range(length))
+        edits = []
+        for pos in sorted(rng.sample(range(1, length - 20, 20), 5000)):
+            kind = rng.choice(('snp', 'ins', 'del'))
+            if kind == 'snp':
+                edits.append((pos, pos, rng.choice('ACGT')))
+            elif kind == 'ins':
+                edits.append((pos, pos, init[pos - 1] + ''.join(rng.choice('ACGT') for i in range(rng.randint(1, 10)))))
+            else:
+                edits.append((pos, pos + rng.randint(1, 10), init[pos - 1]))
+        expected = init
+        for start, stop, new_seq in reversed(edits):
+            expected = expected[:start - 1] + new_seq + expected[stop:]
+
+        x = assembly.MutableSequence('chr', 1, length, init)
+        for start, stop, new_seq in edits:
+            x.replace(start, stop, new_seq)
+        x.replay_deletions()
+        name, seq = x.emit()
+        self.assertEqual(seq, expected)
+
+
+class TestContigModifier(unittest.TestCase):
+    ''' Test the ContigModifier class '''
+
+    def test_call_reference_ambiguous(self):
+        x = assembly.ContigModifier('ACGTAC', 'RYNTKa')
+        x.call_reference_ambiguous()
+        self.assertEqual(x.get_stripped_consensus(), 'ACGTKa')
+
+    def test_ends(self):
+        x = assembly.ContigModifier('--ACGTACGT-', 'GGAC-TNN---')
+        x.trim_ends()
+        self.assertEqual(x.get_stripped_consensus(), 'ACTNN')
+        x.replace_end_gaps()
+        x.call_reference_ns()
+        self.assertEqual(x.get_stripped_consensus(), 'ACTACGT')
+        x.replace_5ends(3)
+        self.assertEqual(x.get_stripped_consensus(), 'ACGTACGT')
+
+    def test_remove_end_ns(self):
+        x = assembly.ContigModifier('ACGTACGT', 'Nn-CGTNN')
+        x.remove_end_ns()
+        self.assertEqual(x.get_stripped_consensus(), 'CGT')
+
 
 class TestManualSnpCaller(unittest.TestCase):
     ''' Test the vcfrow_parse_and_call_snps method.. lots of edge cases. '''
@@ -725,6 +833,107 @@ class TestManualSnpCaller(unittest.TestCase):
         actual = list(actual)[0][1].strip('N')
         self.assertEqual(actual, expected)
 
+    def test_vcf_file_to_seqs_multisample(self):
+        rows = [
+            ['chr1', '2', '.', 'A', 'C', '.', '.', '.', 'GT:AD', '1:0,5', '0:5,0', '.:0,0', '1:0,9'],
+            ['chr1', '4', '.', 'GT', 'G', '.', '.', '.', 'GT:AD', '0:4,0', '1:0,4', '1:1,6', '0:9,0'],
+            ['chr2', '1', '.', 'T', 'A', '.', '.', '.', 'GT:AD', '.:0,0', '.:0,0', '1:0,5', '.:0,0'],
+            ['chr3', '3', '.', 'G', 'T,A', '.', '.', '.', 'GT:AD', '1:2,3,4', '2:0,0,5', '1:0,5,0', '0:5,0,0'],
+        ]
+        chrlens = {'chr1': 5, 'chr2': 2, 'chr3': 3}
+        samples = ['s1', 's2', 's3', 's4']
+        inVcf = util.file.mkstempfname('.vcf')
+        with open(inVcf, 'wt') as outf:
+            outf.write('##fileformat=VCFv4.1\n')
+            outf.write('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples) + '\n')
+            for row in rows:
+                outf.write('\t'.join(row) + '\n')
+        expected = [
+            ('chr1-s1', 'NCNGT'), ('chr1-s2', 'NANG'), ('chr1-s3', 'NNNG'), ('chr1-s4', 'NCNGT'),
+            ('chr2-s1', 'NN'), ('chr2-s2', 'NN'), ('chr2-s3', 'AN'), ('chr2-s4', 'NN'),
+            ('chr3-s1', 'NND'), ('chr3-s2', 'NNA'), ('chr3-s3', 'NNT'), ('chr3-s4', 'NNG'),
+        ]
+        self.assertEqual(list(assembly.vcf_to_seqs(rows, chrlens, samples, min_dp=2)), expected)
+        for threads in (1, 2, 3):
+            actual = assembly.vcf_file_to_seqs(inVcf, chrlens, samples, min_dp=2, threads=threads)
+            self.assertEqual(list(actual), expected)
+
+    def test_vcf_to_seqs_mixed_alleles(self):
+        # ambiguity codes only where all passing alleles are one base long,
+        # case-insensitive; rows with non-ACGT alleles still call per sample
+        rows = [
+            ['c', '1', '.', 'A', 'a,C', '.', '.', '.', 'GT:AD', '0:3,3,0', '0:3,0,3', '0:1,1,6'],
+            ['c', '2', '.', 'T', 'G,A,CGT', '.', '.', '.', 'GT:AD', '0:5,1,5,0', '0:3,3,5,0', '0:0,3,3,3'],
+            ['c', '3', '.', 'C', 'N,*', '.', '.', '.', 'GT:AD', '0:5,0,0', '0:0,4,1', '0:0,0,9'],
+            ['c', '4', '.', 'GT', 'G', '.', '.', '.', 'GT:AD', '0:9,0', '0:0,9', '0:5,5'],
+        ]
+        samples = ['s1', 's2', 's3']
+        self.assertEqual(
+            list(assembly.vcf_to_seqs(rows, {'c': 5}, samples, min_dp=2)),
+            [('c-s1', 'AWCGT'), ('c-s2', 'MDNG'), ('c-s3', 'CG*GT')]
+        )
+
+
+class TestPileupConsensus(TestCaseWithTmp):
+    ''' Test the pysam pileup consensus caller used by refine_assembly --engine pileup. '''
+
+    ref = 'ATGCGTACCTGAAGTCCGATTACAGGCTTAGCCATGAACT'
+
+    def write_bam(self, reads):
+        inBam = util.file.mkstempfname('.bam')
+        header = {'HD': {'VN': '1.4', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr', 'LN': len(self.ref)}]}
+        with pysam.AlignmentFile(inBam, 'wb', header=header) as outf:
+            for i, (seq, cigar) in enumerate(reads):
+                read = pysam.AlignedSegment()
+                read.query_name = 'read%d' % i
+                read.reference_id = 0
+                read.reference_start = 0
+                read.mapping_quality = 60
+                read.cigartuples = cigar
+                read.query_sequence = seq
+                read.query_qualities = pysam.qualitystring_to_array('I' * len(seq))
+                outf.write(read)
+        return inBam
+
+    def test_snps_and_indels(self):
+        ref = self.ref
+        # six reads with a SNP at 10, a deletion of 21-22 and an insertion after 30,
+        # five of all ten reads with a SNP at 5
+        variant = (ref[:9] + 'A' + ref[10:20] + ref[22:30] + 'TT' + ref[30:], [(0, 20), (2, 2), (0, 8), (1, 2), (0, 10)])
+        reads = [variant] * 6 + [(ref, [(0, len(ref))])] * 4
+        reads = [(seq[:4] + ('A' if i < 5 else seq[4]) + seq[5:], cigar) for i, (seq, cigar) in enumerate(reads)]
+        inBam = self.write_bam(reads)
+        inFasta = util.file.mkstempfname('.fasta')
+        makeFasta([('chr', ref)], inFasta)
+        outFasta = util.file.mkstempfname('.fasta')
+        outVcf = util.file.mkstempfname('.vcf')
+
+        assembly.pileup_consensus(inBam, inFasta, outFasta, outVcf=outVcf, min_coverage=3, chr_names=['sample1'])
+        expected = ref[:4] + 'R' + ref[5:9] + 'A' + ref[10:20] + ref[22:30] + 'TT' + ref[30:]
+        self.assertEqual([(r.id, str(r.seq)) for r in Bio.SeqIO.parse(outFasta, 'fasta')], [('sample1', expected)])
+
+        with open(outVcf, 'rt') as inf:
+            rows = [line.rstrip('\n').split('\t') for line in inf if not line.startswith('#')]
+        # one row per position, plus one for each of the two indels
+        self.assertEqual(len(rows), len(ref) + 2)
+        self.assertIn(['chr', '20', '.', ref[19:22], ref[19], '.', '.', 'DP=10', 'GT:AD:DP', '1:4,6:10'], rows)
+        self.assertIn(['chr', '30', '.', ref[29], ref[29] + 'TT', '.', '.', 'DP=10', 'GT:AD:DP', '1:4,6:10'], rows)
+
+    def test_minority_indel_and_low_coverage(self):
+        ref = self.ref
+        deletion = (ref[:20] + ref[22:], [(0, 20), (2, 2), (0, 18)])
+        inBam = self.write_bam([deletion] * 2 + [(ref, [(0, len(ref))])] * 4)
+        inFasta = util.file.mkstempfname('.fasta')
+        makeFasta([('chr', ref)], inFasta)
+        outFasta = util.file.mkstempfname('.fasta')
+
+        assembly.pileup_consensus(inBam, inFasta, outFasta, min_coverage=3)
+        # 21-22 are only covered by the four reads without the deletion
+        self.assertEqual(str(Bio.SeqIO.read(outFasta, 'fasta').seq), ref)
+
+        assembly.pileup_consensus(inBam, inFasta, outFasta, min_coverage=5)
+        self.assertEqual(str(Bio.SeqIO.read(outFasta, 'fasta').seq), ref[:20] + 'NN' + ref[22:])
+
 
 class TestDeambigAndTrimFasta(TestCaseWithTmp):
     ''' Test the deambig_fasta and trim_fasta commands. '''
@@ -764,6 +973,28 @@ class TestDeambigAndTrimFasta(TestCaseWithTmp):
                 for i in range(len(outseq)):
                     self.assertIn(outseq[i], vals[i])
 
+    def test_deambig_fasta_seeded(self):
+        inseqs = ['ACGTNNNNRYKMSWBDHVN' * 50, 'nnnnacgt']
+        fasta_in = util.file.mkstempfname()
+        makeFasta([(str(i), inseqs[i]) for i in range(len(inseqs))], fasta_in)
+        outs = []
+        for seed in (7, 7, 8):
+            fasta_out = util.file.mkstempfname()
+            assembly.deambig_fasta(fasta_in, fasta_out, random_seed=seed)
+            outs.append([str(rec.seq) for rec in Bio.SeqIO.parse(fasta_out, 'fasta')])
+        self.assertEqual(outs[0], outs[1])
+        self.assertNotEqual(outs[0], outs[2])
+        self.assertTrue(outs[0][1].endswith('ACGT'))
+        self.assertTrue(all(set(seq) <= set('ACGT') for seq in outs[0]))
+
+    def test_deambig_seq_bad_base(self):
+        self.assertRaises(KeyError, assembly.deambig_seq, 'ACGT-ACGT')
+
+    def test_unambig_count(self):
+        self.assertEqual(assembly.unambig_count('ACGTacgtNnRY-*'), 8)
+        self.assertEqual(assembly.unambig_count(''), 0)
+        self.assertEqual(assembly.unambig_count(Bio.Seq.Seq('NNAN')), 1)
+
 
 class TestContigChooser(unittest.TestCase):
     ''' Test the contig_chooser heuristic used by our MUMmer-based custom scaffolder. '''
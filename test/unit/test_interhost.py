@@ -8,6 +8,12 @@ import util.file
 import unittest
 import argparse
 import itertools
+import os
+import random
+import shutil
+import tempfile
+import threading
+from mock import patch
 
 
 class TestCommandHelp(unittest.TestCase):
@@ -306,3 +312,168 @@ class TestSpecificAlignments(test.TestCaseWithTmp):
         self.assertEqual(cm.mapChr('s2', 's1', 2), ('s1', 1))
         self.assertEqual(cm.mapChr('s2', 's1', 3), ('s1', 1))
         self.assertEqual(cm.mapChr('s2', 's1', 4), ('s1', 2))
+
+    def test_map_many(self):
+        alignment = makeTempFasta([('s1', 'ATCTG-'), ('s2', 'AC--GA'), ('s3', '-TTTG-'), ('s4', '-TC---')])
+        cm = interhost.CoordMapper()
+        cm.load_alignments([alignment])
+        positions = [6, -1, 0, 1, 2, 3, 4, 5, 3]
+        for a, b in itertools.permutations(('s1', 's2', 's3', 's4'), 2):
+            self.assertEqual(cm.mapChrMany(a, b, positions), (b, [cm.mapChr(a, b, i)[1] for i in positions]))
+            for side in (-1, 1):
+                self.assertEqual(cm.mapChrMany(a, b, positions, side),
+                                 (b, [cm.mapChr(a, b, i, side)[1] for i in positions]))
+        self.assertEqual(cm.mapChrMany('s1', 's2', []), ('s2', []))
+        with self.assertRaises(TypeError):
+            cm.mapChrMany('s1', 's2', [1, 1.5])
+        self.assertRaises(KeyError, cm.mapChrMany, 's1', 'nonexistentchr', [1])
+
+    def test_map_many_no_real_bases(self):
+        alignment = makeTempFasta([('s1', 'AA'), ('s2', '--'),])
+        cm = interhost.CoordMapper()
+        cm.load_alignments([alignment])
+        self.assertEqual(cm.mapChrMany('s1', 's2', []), ('s2', []))
+        with self.assertRaises(Exception):
+            cm.mapChrMany('s1', 's2', [1])
+
+
+class TestLazyCoordMapper(test.TestCaseWithTmp):
+    """ A lazy CoordMapper must map exactly like an eager one, while only
+        building the mappers that are actually used.
+    """
+
+    def test_same_as_eager(self):
+        alignment = makeTempFasta([
+            ('s1', 'ATCTG-'),
+            ('s2', 'AC--GA'),
+            ('s3', 'A-TTG-'),
+            ('s4', 'A-C-GA'),
+            ('s5', 'A--CG-'),
+        ])
+        eager = interhost.CoordMapper()
+        eager.load_alignments([alignment])
+        lazy = interhost.CoordMapper(lazy=True)
+        lazy.load_alignments([alignment])
+        self.assertEqual(list(lazy.keys()), list(eager.keys()))
+        for a in eager.keys():
+            self.assertEqual(list(lazy[a].keys()), list(eager[a].keys()))
+            for b in eager[a].keys():
+                for i in range(-1, 8):
+                    self.assertEqual(lazy.mapChr(a, b, i), eager.mapChr(a, b, i))
+
+    def test_builds_mappers_on_first_use(self):
+        alignment = makeTempFasta([('ref', 'ATCG'), ('s1', 'AC-G'), ('s2', 'AG-T'), ('s3', 'ATCT')])
+        cm = interhost.CoordMapper(lazy=True)
+        cm.load_alignments([alignment])
+        self.assertEqual(sum(len(cm[s].mappers) for s in cm), 0)
+        self.assertEqual(cm.mapChr('ref', 's1', 4), ('s1', 3))
+        self.assertEqual(cm.mapChr('s1', 'ref', 2), ('ref', [2, 3]))
+        self.assertEqual(sum(len(cm[s].mappers) for s in cm), 2)
+        self.assertEqual(cm.mapChr('s2', 's3'), 's3')
+        self.assertRaises(KeyError, cm.mapChr, 's1', 's1', 1)
+        self.assertRaises(KeyError, cm.mapChr, 's1', 'nonexistentchr', 1)
+
+    def test_keys(self):
+        # DictMixin on Python 2 has no keys() of its own, and mapChr relies on it
+        alignment = makeTempFasta([('ref', 'ATCG'), ('s1', 'AC-G')])
+        cm = interhost.CoordMapper(lazy=True)
+        cm.load_alignments([alignment])
+        self.assertEqual(cm['ref'].keys(), ['s1'])
+        self.assertEqual(cm['s1'].keys(), ['ref'])
+        self.assertEqual(cm.mapChr('ref', 's1', 4), ('s1', 3))
+        self.assertEqual(cm.mapChrMany('s1', 'ref', [2]), ('ref', [[2, 3]]))
+
+    def test_load_errors(self):
+        cm = interhost.CoordMapper(lazy=True)
+        with self.assertRaises(Exception):
+            cm.load_alignments([makeTempFasta([('s1', 'AA'), ('s2', 'A')])])
+        cm = interhost.CoordMapper(lazy=True)
+        with self.assertRaises(KeyError):
+            cm.load_alignments([makeTempFasta([('s1', 'AA'), ('s1', 'AT')])])
+        cm = interhost.CoordMapper(lazy=True)
+        cm.load_alignments([makeTempFasta([('s1', 'AA'), ('s2', 'AT')])])
+        with self.assertRaises(KeyError):
+            cm.load_alignments([makeTempFasta([('s1', 'AA'), ('s2', 'AT')])])
+
+
+class TestConcurrentAlignment(test.TestCaseWithTmp):
+    """ The aligners themselves are mocked here: each "alignment" is a copy
+        of its (equal length) input sequences.
+    """
+
+    def setUp(self):
+        super(TestConcurrentAlignment, self).setUp()
+        self.genomes = [
+            makeTempFasta([('s%d_chr1' % i, 'ACGT' * 25), ('s%d_chr2' % i, 'TTGCA' * 4), ('s%d_chr3' % i, 'G' * 20)])
+            for i in range(3)
+        ]
+
+    def test_split_thread_budget(self):
+        with patch('util.misc.sanitize_thread_count', lambda threads=None: threads):
+            self.assertEqual(interhost.split_thread_budget([300, 60, 60], 4), (3, [2, 1, 1]))
+            self.assertEqual(interhost.split_thread_budget([10, 10], 8), (2, [4, 4]))
+            self.assertEqual(interhost.split_thread_budget([10], 8), (1, [8]))
+            self.assertEqual(interhost.split_thread_budget([0, 0], 8), (2, [4, 4]))
+            self.assertEqual(interhost.split_thread_budget([], 8), (1, []))
+            # the remainder is handed out rather than left unused
+            self.assertEqual(interhost.split_thread_budget([10, 10, 10], 8), (3, [3, 3, 2]))
+            self.assertEqual(interhost.split_thread_budget([50, 30, 20], 10), (3, [5, 3, 2]))
+            # never more threads in flight than the budget
+            self.assertEqual(interhost.split_thread_budget([1000, 1, 1, 1], 4), (4, [1, 1, 1, 1]))
+            self.assertEqual(interhost.split_thread_budget([1000, 1, 1, 1, 1], 3), (3, [1, 1, 1, 1, 1]))
+            rng = random.Random(48)
+            for _ in range(200):
+                work = [rng.randint(0, 1000) for _ in range(rng.randint(1, 10))]
+                threads = rng.randint(1, 16)
+                workers, jobThreads = interhost.split_thread_budget(work, threads)
+                self.assertEqual(len(jobThreads), len(work))
+                self.assertTrue(min(jobThreads) >= 1)
+                self.assertLessEqual(sum(sorted(jobThreads, reverse=True)[:workers]), threads)
+                if len(work) < threads:
+                    self.assertEqual(sum(jobThreads), threads)
+
+    def test_multichr_mafft(self):
+        def mock_execute(tool, inFastas, outFile, threads=None, **kwargs):
+            shutil.copyfile(inFastas[0], outFile)
+            with open(outFile + '.threads', 'wt') as outf:
+                outf.write(str(threads))
+            return outFile
+
+        outDir = tempfile.mkdtemp()
+        args = interhost.parser_multichr_mafft(argparse.ArgumentParser()).parse_args(
+            self.genomes + [outDir, '--threads', '4'])
+        with patch('tools.mafft.MafftTool.execute', mock_execute):
+            with patch('util.misc.sanitize_thread_count', lambda threads=None: threads):
+                interhost.multichr_mafft(args)
+        for idx, (chrom, threads) in enumerate((('chr1', '2'), ('chr2', '1'), ('chr3', '1'))):
+            outFile = os.path.join(outDir, 'aligned_{}.fasta'.format(idx + 1))
+            with open(outFile, 'rt') as inf:
+                self.assertEqual([line.strip('>\n') for line in inf if line.startswith('>')],
+                                 ['s%d_%s' % (i, chrom) for i in range(3)])
+            with open(outFile + '.threads', 'rt') as inf:
+                self.assertEqual(inf.read(), threads)
+
+    def test_align_and_load_sequences(self):
+        class MockAligner(object):
+            def execute(self, inFasta, outFasta):
+                shutil.copyfile(inFasta, outFasta)
+
+        cm = interhost.CoordMapper()
+        cm.align_and_load_sequences(self.genomes, aligner=MockAligner(), threads=2)
+        self.assertEqual(list(cm.keys()), ['s%d_chr%d' % (i, c) for c in (1, 2, 3) for i in range(3)])
+        self.assertEqual(cm.mapChr('s0_chr2', 's2_chr2', 7), ('s2_chr2', 7))
+
+    def test_align_and_load_sequences_serial_by_default(self):
+        class MockAligner(object):
+            def __init__(self):
+                self.threads = set()
+
+            def execute(self, inFasta, outFasta):
+                self.threads.add(threading.current_thread().name)
+                shutil.copyfile(inFasta, outFasta)
+
+        aligner = MockAligner()
+        cm = interhost.CoordMapper()
+        cm.align_and_load_sequences(self.genomes, aligner=aligner)
+        self.assertEqual(aligner.threads, set([threading.current_thread().name]))
+        self.assertEqual(list(cm.keys()), ['s%d_chr%d' % (i, c) for c in (1, 2, 3) for i in range(3)])
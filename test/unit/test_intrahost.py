@@ -4,6 +4,7 @@ __author__ = "dpark@broadinstitute.org"
 
 # built-ins
 from collections import OrderedDict
+import collections
 import os
 import os.path
 import shutil
@@ -11,8 +12,13 @@ import tempfile
 import itertools
 import argparse
 import unittest
+import random
+import re
 
 # third-party
+import pytest
+import pysam
+from mock import patch
 import Bio
 import Bio.SeqRecord
 import Bio.Seq
@@ -152,6 +158,123 @@ class TestIntrahostFilters(unittest.TestCase):
         self.assertEqual(output[0][7:], expected[7:])
 
 
+def parse_alleles_string_by_char(allelesStr):
+    # reference implementation of intrahost.parse_alleles_string: one character at a time
+    alleleCounts = {}
+    pos = -1
+    digits = re.compile('[0-9]+')
+    while pos < len(allelesStr) - 1:
+        pos += 1
+        c = allelesStr[pos]
+        if c in '.,':
+            allele = '.'
+            isRev = c == ','
+        elif c in '<>$*':
+            continue
+        elif c == '^':
+            pos += 1
+            continue
+        elif c in 'ACGTNacgtn':
+            allele = c.upper()
+            isRev = c == c.lower()
+        elif c in '+-':
+            mat = digits.match(allelesStr, pos + 1)
+            indelLen = int(allelesStr[mat.start():mat.end()])
+            indelStr = allelesStr[mat.end():mat.end() + indelLen]
+            allele = 'I' + indelStr.upper() if c == '+' else 'D' + str(indelLen)
+            isRev = indelStr == indelStr.lower()
+            pos += mat.end() - mat.start() + indelLen
+        else:
+            raise Exception('Unknown allele type %s' % c)
+        alleleCounts.setdefault(allele, [0, 0])
+        alleleCounts[allele][isRev] += 1
+    return alleleCounts
+
+
+def random_pileup_string(rng, depth, indels=None):
+    # mpileup read bases column: read starts with any mapping quality character,
+    # matches, mismatches, indels (random, or drawn from indels), deletions,
+    # reference skips and read ends
+    reads = []
+    for i in range(depth):
+        isRev = rng.random() < 0.5
+        read = ''
+        if rng.random() < 0.1:
+            read += '^' + chr(rng.randint(33, 126))
+        read += rng.choice(['.', 'A', 'C', 'G', 'T', 'N', '*', '>'] if not isRev else [',', 'a', 'c', 'g', 't', 'n', '*', '<'])
+        if rng.random() < 0.1:
+            indel = rng.choice(indels) if indels else ''.join(rng.choice('ACGTN') for j in range(rng.randint(1, 12)))
+            read += rng.choice('+-') + str(len(indel)) + (indel.lower() if isRev else indel)
+        if rng.random() < 0.1:
+            read += '$'
+        reads.append(read)
+    return ''.join(reads)
+
+
+class TestParseAllelesString(unittest.TestCase):
+
+    def test_examples(self):
+        self.assertEqual(intrahost.parse_alleles_string(''), {})
+        self.assertEqual(
+            intrahost.parse_alleles_string('^+.,$A+2ACc-3nnn^,,*>g'),
+            {'.': [1, 2], 'A': [1, 0], 'C': [0, 1], 'G': [0, 1], 'IAC': [1, 0], 'D3': [0, 1]}
+        )
+        self.assertRaises(Exception, intrahost.parse_alleles_string, '..#,')
+
+    def test_matches_char_by_char_parser(self):
+        rng = random.Random(7)
+        for i in range(2000):
+            allelesStr = random_pileup_string(rng, rng.randint(0, 40))
+            self.assertEqual(
+                intrahost.parse_alleles_string(allelesStr), parse_alleles_string_by_char(allelesStr), allelesStr)
+
+    @pytest.mark.slow
+    def test_deep_pileup(self):
+        rng = random.Random(1)
+        # 50,000x sites, each with a few indel alleles
+        pileups = [random_pileup_string(rng, 50000, ['A', 'TT', 'GCA', 'ACGTACGTAC']) for i in range(10)]
+        expected = [parse_alleles_string_by_char(p) for p in pileups]
+        actual = [intrahost.parse_alleles_string(p) for p in pileups]
+        self.assertEqual(actual, expected)
+
+
+class TestISNVTable(unittest.TestCase):
+
+    def vcf_row(self, pos, info, **samples):
+        row = OrderedDict([('CHROM', 'chr1'), ('POS', str(pos)), ('ID', '.'), ('REF', 'A'), ('ALT', 'C,G'),
+                           ('QUAL', '.'), ('FILTER', '.'), ('INFO', info), ('FORMAT', 'GT:AF:DP:NL:LB')])
+        row.update(samples)
+        return row
+
+    def test_isnv_table(self):
+        ann = ','.join('|'.join([a, 'missense_variant', 'MODERATE', 'GP', 'g', 'transcript', 'GP.1',
+                                 'protein_coding', '1/1', 'c.10A>' + a, 'p.Ala3' + aa, '1/2', '3/4', '4/300', '', ''])
+                       for a, aa in (('C', 'Pro'), ('G', 'Gly')))
+        rows = [
+            self.vcf_row(4, 'ANN=%s;PI=0.5;FWS=0.25' % ann,
+                         s1='0:0.1,0.2:100:1,1,1:.', s2='1:.:80:.:.', s3='.:.:.:.:.', s4='0:0.0,0.1:60:1,0,1:.'),
+            self.vcf_row(9, '.', s1='0:0.0,0.0:100:.:.', s2='0:.:80:.:.'),
+        ]
+        with patch('intrahost.parse_ann', side_effect=intrahost.parse_ann) as parse_ann:
+            out = list(intrahost.iSNV_table(rows))
+        self.assertEqual(parse_ann.call_count, 1)
+        self.assertEqual([(r['pos'], r['sample']) for r in out], [('4', 's1'), ('4', 's4'), ('9', 's1')])
+        self.assertEqual([r['alleles'] for r in out], ['A,C,G'] * 3)
+        self.assertAlmostEqual(out[0]['iSNV_freq'], 0.3)
+        self.assertAlmostEqual(out[0]['Hw'], 1.0 - (0.49 + 0.01 + 0.04))
+        self.assertAlmostEqual(out[0]['Hs'], 1.0 - (4.0 + 1.0) / 9)
+        self.assertAlmostEqual(out[1]['Hw'], 1.0 - (0.81 + 0.01))
+        for r in out[:2]:
+            self.assertEqual(r['eff_aa'], 'Ala3Pro,Ala3Gly')
+            self.assertEqual(r['eff_protein'], 'Glycoprotein')
+            self.assertEqual((r['Hs_snp'], r['Fws_snp']), ('0.5', '0.25'))
+        # each row has its own copy of the site annotations
+        out[0]['eff_gene'] = 'changed'
+        self.assertEqual(out[1]['eff_gene'], 'GP')
+        self.assertEqual((out[2]['iSNV_freq'], out[2]['Hw'], out[2]['Hs']), (0.0, 0.0, 0.0))
+        self.assertNotIn('eff_aa', out[2])
+
+
 #@unittest.skipIf(tools.is_osx(), "vphaser2 osx binary from bioconda has issues")
 class TestPerSample(test.TestCaseWithTmp):
     ''' This tests step 1 of the iSNV calling process
@@ -181,6 +304,143 @@ class TestPerSample(test.TestCaseWithTmp):
         expected = os.path.join(myInputDir, 'vphaser_one_sample_expected.txt')
         self.assertEqualContents(outTab, expected)
 
+    def test_vphaser_by_chrom(self):
+        # V-Phaser 2 itself is mocked: one row per chromosome with reads, giving
+        # the number of reads and the threads it was run with
+        def mock_iterate(tool, inBam, numThreads=None):
+            with pysam.AlignmentFile(inBam, 'rb') as bam:
+                counts = collections.Counter(read.reference_name for read in bam.fetch(until_eof=True)
+                                             if not read.is_unmapped)
+                for chrom in bam.references:
+                    if counts[chrom]:
+                        yield [chrom, str(counts[chrom]), str(numThreads)]
+
+        inBam = os.path.join(util.file.get_test_input_path(self), 'in.2libs.bam')
+        with patch('tools.vphaser2.Vphaser2Tool.iterate', mock_iterate):
+            with patch('util.misc.sanitize_thread_count', lambda threads=None: threads):
+                whole = list(intrahost.Vphaser2Tool().iterate(inBam, 4))
+                by_chrom = list(intrahost.iterate_vphaser_by_chrom(inBam, 4))
+        self.assertEqual([row[0] for row in by_chrom], ['chr1', 'chr2'])
+        self.assertEqual([row[:2] for row in by_chrom], [row[:2] for row in whole])
+        self.assertEqual([row[2] for row in by_chrom], ['2', '2'])
+
+    def test_vphaser_by_chrom_cleanup(self):
+        # per-chromosome BAMs are removed when a V-Phaser 2 run fails and when
+        # the caller stops reading early
+        def mock_iterate(tool, inBam, numThreads=None):
+            with pysam.AlignmentFile(inBam, 'rb') as bam:
+                chroms = set(read.reference_name for read in bam.fetch(until_eof=True))
+            if 'chr2' in chroms:
+                raise RuntimeError('V-Phaser 2 failed')
+            yield ['chr1', '1', str(numThreads)]
+            yield ['chr1', '2', str(numThreads)]
+
+        chromBams = []
+        def split_bam_by_chrom(inBam):
+            chromBams.extend(split_bam_by_chrom_orig(inBam))
+            return list(chromBams)
+        split_bam_by_chrom_orig = intrahost._split_bam_by_chrom
+
+        inBam = os.path.join(util.file.get_test_input_path(self), 'in.2libs.bam')
+        with patch('tools.vphaser2.Vphaser2Tool.iterate', mock_iterate):
+            with patch('intrahost._split_bam_by_chrom', split_bam_by_chrom):
+                with self.assertRaises(RuntimeError):
+                    list(intrahost.iterate_vphaser_by_chrom(inBam, 1))
+                self.assertEqual(len(chromBams), 2)
+                self.assertFalse(any(os.path.exists(chromBam) for chrom, chromBam in chromBams))
+
+                del chromBams[:]
+                rows = intrahost.iterate_vphaser_by_chrom(inBam, 1)
+                self.assertEqual(next(rows)[:2], ['chr1', '1'])
+                rows.close()
+                self.assertEqual(len(chromBams), 2)
+                self.assertFalse(any(os.path.exists(chromBam) for chrom, chromBam in chromBams))
+
+    def test_library_bias_single_pileup_pass(self):
+        # library counts from one pysam pileup pass should match those of
+        # samtools mpileup recorded in the expected vphaser_one_sample outputs
+        myInputDir = util.file.get_test_input_path(self)
+        for inBam, refFasta, expected in (
+            ('in.bam', 'ref.fasta', 'vphaser_one_sample_expected.txt'),
+            ('in.2libs.bam', 'ref.fasta', 'vphaser_one_sample_2libs_expected.txt'),
+            ('in.3libs.bam', 'ref.fasta', 'vphaser_one_sample_3libs_expected.txt'),
+            ('in.indels.bam', 'ref.indels.fasta', 'vphaser_one_sample_indels_expected.txt'),
+        ):
+            with open(os.path.join(myInputDir, expected), 'rt') as inf:
+                expected = [line.rstrip('\n').split('\t') for line in inf]
+            isnvs = [row[:7] + [':'.join(field.split(':')[:3]) for field in row[7:]] for row in expected]
+            actual = intrahost.compute_library_bias(
+                isnvs, os.path.join(myInputDir, inBam), os.path.join(myInputDir, refFasta), engine='pysam')
+            self.assertEqual(list(actual), expected)
+
+    def test_library_bias_per_chromosome(self):
+        # iSNVs are counted one chromosome at a time, as they stream in
+        myInputDir = util.file.get_test_input_path(self)
+        with open(os.path.join(myInputDir, 'vphaser_one_sample_2libs_expected.txt'), 'rt') as inf:
+            expected = [line.rstrip('\n').split('\t') for line in inf]
+        consumed = []
+
+        def isnvs():
+            for row in expected:
+                consumed.append(row[0])
+                yield row[:7] + [':'.join(field.split(':')[:3]) for field in row[7:]]
+
+        batches = []
+        def get_library_allele_counts(inBam, inConsFasta, positions):
+            batches.append(set(chrom for chrom, pos in positions))
+            return get_library_allele_counts_orig(inBam, inConsFasta, positions)
+        get_library_allele_counts_orig = intrahost.get_library_allele_counts
+
+        with patch('intrahost.get_library_allele_counts', get_library_allele_counts):
+            actual = intrahost.compute_library_bias(
+                isnvs(), os.path.join(myInputDir, 'in.2libs.bam'), os.path.join(myInputDir, 'ref.fasta'),
+                engine='pysam')
+            self.assertEqual(next(actual), expected[0])
+            self.assertEqual(consumed.count('chr2'), 1)
+            self.assertEqual([next(actual)] + list(actual), expected[1:])
+        self.assertEqual(batches, [set(['chr1']), set(['chr2'])])
+
+    def test_library_allele_counts_empty_library(self):
+        # libraries come from the read group header, even if they have no reads
+        myInputDir = util.file.get_test_input_path(self)
+        inBam = util.file.mkstempfname('.bam')
+        with pysam.AlignmentFile(os.path.join(myInputDir, 'in.2libs.bam'), 'rb') as inb:
+            header = inb.header.to_dict()
+            header['RG'].append({'ID': 'ReadGroup0', 'PL': '454', 'SM': 'unknown', 'LB': 'lib0'})
+            with pysam.AlignmentFile(inBam, 'wb', header=header) as outb:
+                for read in inb:
+                    outb.write(read)
+        libs, counts = intrahost.get_library_allele_counts(inBam, os.path.join(myInputDir, 'ref.fasta'),
+                                                           [('chr1', 1000)])
+        self.assertEqual(libs, ['lib0', 'lib1', 'lib2'])
+        self.assertEqual(counts[('chr1', 1000)][0], {})
+        self.assertTrue(counts[('chr1', 1000)][1])
+
+    def test_pileup_regions(self):
+        positions = [('chr2', 5), ('chr1', 3000), ('chr1', 10), ('chr1', 900), ('chr1', 1899)]
+        self.assertEqual(intrahost._pileup_regions(positions),
+                         [('chr1', 9, 1899), ('chr1', 2999, 3000), ('chr2', 4, 5)])
+
+    def test_library_allele_counts_by_region(self):
+        # counts from pileups over regions of an (indexed) sorted BAM are the
+        # same as from a pileup over all of a BAM not marked as sorted
+        myInputDir = util.file.get_test_input_path(self)
+        inBam = os.path.join(myInputDir, 'in.3libs.bam')
+        refFasta = os.path.join(myInputDir, 'ref.fasta')
+        unsortedBam = util.file.mkstempfname('.bam')
+        with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as inb:
+            header = inb.header.to_dict()
+            header['HD']['SO'] = 'unsorted'
+            with pysam.AlignmentFile(unsortedBam, 'wb', header=header) as outb:
+                for read in inb:
+                    outb.write(read)
+        with open(os.path.join(myInputDir, 'vphaser_one_sample_3libs_expected.txt'), 'rt') as inf:
+            positions = set((row[0], int(row[1])) for row in (line.split('\t') for line in inf))
+        by_region = intrahost.get_library_allele_counts(inBam, refFasta, positions)
+        self.assertEqual(by_region, intrahost.get_library_allele_counts(unsortedBam, refFasta, positions))
+        self.assertEqual(set(by_region[1]), positions)
+        self.assertFalse(os.path.exists(inBam + '.bai'))
+
 
 class VcfMergeRunner:
     ''' This creates test data and feeds it to intrahost.merge_to_vcf
@@ -334,6 +594,37 @@ class TestVcfMerge(test.TestCaseWithTmp):
             self.assertEqual(vcf.samples(), ['s1', 's2'])
             self.assertEqual(vcf.chrlens(), {'ref1': 8, 'ref2': 5})
 
+    def test_reads_each_input_once(self):
+        # pre-aligned inputs, so no aligner is needed
+        ref = makeTempFasta([('ref1', 'ATCGGACT'), ('ref2', 'GGCCCA')])
+        aligned = [
+            makeTempFasta([('ref1', 'ATCGGACT'), ('s1-1', 'ATCGGAC-'), ('s2-1', '-TCGGACT')]),
+            makeTempFasta([('ref2', 'GGCCCA'), ('s1-2', 'GGCCCA'), ('s2-2', 'GGCCCA')]),
+        ]
+        isnvs = {'s1': MockVphaserOutput(), 's2': MockVphaserOutput()}
+        isnvs['s1'].add_snp('s1-1', 3, [('C', 80, 80), ('A', 20, 20)])
+        isnvs['s1'].add_snp('s1-2', 5, [('C', 60, 60), ('T', 40, 40)])
+        isnvs['s2'].add_snp('s2-1', 5, [('A', 70, 70), ('T', 30, 30)])
+        isnv_files = []
+        for sample in ('s1', 's2'):
+            isnv_files.append(util.file.mkstempfname('.txt'))
+            with open(isnv_files[-1], 'wt') as outf:
+                for row in isnvs[sample]:
+                    outf.write('\t'.join(map(str, row)) + '\n')
+
+        for samples in (['s1', 's2'], []):
+            outVcf = util.file.mkstempfname('.vcf.gz')
+            with patch('util.file.read_tabfile', side_effect=util.file.read_tabfile) as read_tabfile:
+                intrahost.merge_to_vcf(ref, outVcf, samples, isnv_files, aligned)
+            self.assertEqual(sorted(c[0][0] for c in read_tabfile.call_args_list), sorted(isnv_files))
+            with util.vcf.VcfReader(outVcf) as vcf:
+                self.assertEqual(vcf.samples(), ['s1', 's2'])
+                rows = list(vcf.get())
+            self.assertEqual([(row.contig, row.pos + 1, row.ref, row.alt) for row in rows],
+                             [('ref1', 3, 'C', 'A'), ('ref1', 6, 'A', 'T'), ('ref2', 5, 'C', 'T')])
+            self.assertEqual([':'.join(row[0].split(':')[:2]) for row in rows], ['0:0.2', '0:0.0', '0:0.4'])
+            self.assertEqual([':'.join(row[1].split(':')[:2]) for row in rows], ['0:0.0', '0:0.3', '0:0.0'])
+
     def test_simple_snps(self):
         merger = VcfMergeRunner([('ref1', 'ATCGGACT')])
         merger.add_genome('s1', [('s1-1', 'ATCGGAC')])
@@ -7,6 +7,10 @@ import argparse
 import filecmp
 import os
 import glob
+import concurrent.futures
+
+import pysam
+from mock import patch, ANY
 
 import read_utils
 import shutil
@@ -62,6 +66,34 @@ class TestPurgeUnmated(TestCaseWithTmp):
         self.assertEqualContents(outFastq1, expected1Fastq)
         self.assertEqualContents(outFastq2, expected2Fastq)
 
+    def write_fastq(self, fname, records):
+        with util.file.open_or_gzopen(fname, 'wt') as outf:
+            for read_id, seq in records:
+                outf.write('@{}\n{}\n+\n{}\n'.format(read_id, seq, 'I' * len(seq)))
+
+    def test_sorted_and_unsorted_inputs_agree(self):
+        ids1 = ['r{:03d}'.format(i) for i in range(0, 200, 2)] + ['r{:03d}'.format(i) for i in range(1, 200, 6)]
+        ids2 = ['r{:03d}'.format(i) for i in range(0, 200, 3)]
+        outputs = []
+        for ordering in (sorted, lambda ids: list(reversed(ids))):
+            inFastq1 = util.file.mkstempfname('.1.fastq.gz')
+            inFastq2 = util.file.mkstempfname('.2.fastq')
+            self.write_fastq(inFastq1, [(x + '/1', 'ACGT') for x in ordering(ids1)])
+            self.write_fastq(inFastq2, [(x + '/2', 'GGCA') for x in ordering(ids2)])
+            outFastq1 = util.file.mkstempfname('.1.fastq')
+            outFastq2 = util.file.mkstempfname('.2.fastq.gz')
+            read_utils.purge_unmated(inFastq1, inFastq2, outFastq1, outFastq2, num_buckets=3)
+            with util.file.open_or_gzopen(outFastq1, 'rt') as inf1, util.file.open_or_gzopen(outFastq2, 'rt') as inf2:
+                out1 = inf1.read().splitlines()
+                out2 = inf2.read().splitlines()
+            # reads stay in the order of the second input
+            expected = [x for x in ordering(ids2) if x in set(ids1)]
+            self.assertEqual(out1[0::4], ['@' + x + '/1' for x in expected])
+            self.assertEqual(out2[0::4], ['@' + x + '/2' for x in expected])
+            self.assertEqual(out1[2::4], ['+' + x + '/1' for x in expected])
+            outputs.append(sorted(zip(out1[0::4], out2[0::4])))
+        self.assertEqual(outputs[0], outputs[1])
+
 
 class TestBwamemIdxstats(TestCaseWithTmp):
 
@@ -106,6 +138,7 @@ class TestFastqBam(TestCaseWithTmp):
         expected1_7Sam = os.path.join(myInputDir, 'expected.java1_7.sam')
         expected1_8Sam = os.path.join(myInputDir, 'expected.java1_8.sam')
         expected1_8Sam_v15 = os.path.join(myInputDir, 'expected.java1_8_v1.5.sam')
+        expectedNativeSam = os.path.join(myInputDir, 'expected.native.sam')
         expectedFastq1 = os.path.join(myInputDir, 'expected.fastq1')
         outBamCmd = util.file.mkstempfname('.bam')
         outBamTxt = util.file.mkstempfname('.bam')
@@ -148,6 +181,9 @@ class TestFastqBam(TestCaseWithTmp):
                                                                   shallow=False) or
                                                       filecmp.cmp(outSam,
                                                                   expected1_8Sam_v15,
+                                                                  shallow=False) or
+                                                      filecmp.cmp(outSam,
+                                                                  expectedNativeSam,
                                                                   shallow=False))
 
         # in1.fastq, in2.fastq, inHeader.txt -> out.bam; header from txt
@@ -155,6 +191,229 @@ class TestFastqBam(TestCaseWithTmp):
         args = parser.parse_args([inFastq1, inFastq2, outBamTxt, '--header', inHeader])
         args.func_main(args)
 
+        with pysam.AlignmentFile(outBamTxt, 'rb', check_sq=False) as inb:
+            self.assertEqual(inb.header.to_dict()['RG'][0]['SM'], 'txtSample')
+            self.assertEqual([read.get_tag('RG') for read in inb], ['A', 'A'])
+
+
+class TestFastqToUbam(TestCaseWithTmp):
+
+    def setUp(self):
+        super(TestFastqToUbam, self).setUp()
+        self.header = {'RG': [{'ID': 'rg1', 'SM': 'sample1'}]}
+
+    def write_fastq(self, records, suffix='.fastq'):
+        fname = util.file.mkstempfname(suffix)
+        with util.file.open_or_gzopen(fname, 'wt') as outf:
+            for name, seq in records:
+                outf.write('@{}\n{}\n+\n{}\n'.format(name, seq, 'I' * len(seq)))
+        return fname
+
+    def read_bam(self, bam):
+        with pysam.AlignmentFile(bam, 'rb', check_sq=False) as inb:
+            return inb.header.to_dict(), [(r.query_name, r.flag, r.query_sequence, r.get_tag('RG')) for r in inb]
+
+    def test_paired_gz(self):
+        fq1 = self.write_fastq([('r1/1', 'ACGT'), ('r2/1 extra', 'GGGG')], '.1.fastq.gz')
+        fq2 = self.write_fastq([('r1/2', 'TTTT'), ('r2/2 extra', 'CCCA')], '.2.fastq.gz')
+        outBam = util.file.mkstempfname('.bam')
+        self.assertEqual(read_utils.fastq_to_ubam(fq1, fq2, outBam, self.header, threads=2), 4)
+        header, reads = self.read_bam(outBam)
+        self.assertEqual(header['RG'], self.header['RG'])
+        self.assertEqual(header['HD']['SO'], 'queryname')
+        self.assertEqual(reads, [('r1', 77, 'ACGT', 'rg1'), ('r1', 141, 'TTTT', 'rg1'),
+                                 ('r2', 77, 'GGGG', 'rg1'), ('r2', 141, 'CCCA', 'rg1')])
+
+    def test_sorted_by_name(self):
+        names = ['r{}'.format(i) for i in (7, 10, 3, 1, 12, 5, 9, 2, 11, 8, 4, 6)]
+        fq1 = self.write_fastq([(name + '/1', 'ACGT') for name in names])
+        fq2 = self.write_fastq([(name + '/2', 'TTTT') for name in names])
+        for max_records_in_ram in (100, 5, 1):
+            outBam = util.file.mkstempfname('.bam')
+            read_utils.fastq_to_ubam(fq1, fq2, outBam, self.header, max_records_in_ram=max_records_in_ram)
+            header, reads = self.read_bam(outBam)
+            self.assertEqual(header['HD']['SO'], 'queryname')
+            self.assertEqual([(name, flag) for name, flag, _, _ in reads],
+                             [(name, flag) for name in sorted(names) for flag in (77, 141)])
+
+        outBam = util.file.mkstempfname('.bam')
+        read_utils.fastq_to_ubam(fq1, None, outBam, self.header, max_records_in_ram=5)
+        self.assertEqual([name for name, _, _, _ in self.read_bam(outBam)[1]], sorted(names))
+
+    def test_max_records_in_ram_at_least_one(self):
+        fq1 = util.file.mkstempfname('.fastq')
+        with open(fq1, 'wt') as outf:
+            outf.write('@r1\nACGT\n+\nII#I\n@r2\nGGGG\n+\nIIII\n')
+        outBam = util.file.mkstempfname('.bam')
+        with self.assertRaises(ValueError):
+            read_utils.fastq_to_ubam(fq1, None, outBam, self.header, max_records_in_ram=0)
+        with self.assertRaises(ValueError):
+            read_utils.fastq_to_bam(fq1, None, outBam, sampleName='s1', picardOptions=['MAX_RECORDS_IN_RAM=0'])
+
+    def test_phred64_left_to_picard(self):
+        phred33 = util.file.mkstempfname('.fastq')
+        phred64 = util.file.mkstempfname('.fastq')
+        with open(phred33, 'wt') as outf:
+            outf.write('@r1\nACGT\n+\nII#I\n@r2\nGGGG\n+\nIIII\n')
+        with open(phred64, 'wt') as outf:
+            outf.write('@r1\nACGT\n+\nhhBh\n@r2\nGGGG\n+\nhhhh\n')
+        self.assertFalse(read_utils._fastq_may_be_phred64(phred33))
+        self.assertTrue(read_utils._fastq_may_be_phred64(phred64))
+        self.assertFalse(read_utils._fastq_may_be_phred64(self.write_fastq([])))
+
+        outBam = util.file.mkstempfname('.bam')
+        with patch('tools.picard.FastqToSamTool.execute') as execute:
+            read_utils.fastq_to_bam(phred64, None, outBam, sampleName='s1')
+        self.assertEqual(execute.call_count, 1)
+
+    def test_single_end(self):
+        fq1 = self.write_fastq([('r1', 'ACGT'), ('r2', 'GGGG')])
+        outBam = util.file.mkstempfname('.bam')
+        read_utils.fastq_to_ubam(fq1, None, outBam, self.header)
+        self.assertEqual(self.read_bam(outBam)[1], [('r1', 4, 'ACGT', 'rg1'), ('r2', 4, 'GGGG', 'rg1')])
+
+    def test_empty(self):
+        fq1 = self.write_fastq([])
+        fq2 = self.write_fastq([])
+        outBam = util.file.mkstempfname('.bam')
+        self.assertEqual(read_utils.fastq_to_ubam(fq1, fq2, outBam, self.header), 0)
+        self.assertEqual(self.read_bam(outBam)[1], [])
+
+    def test_mismatched_names(self):
+        fq1 = self.write_fastq([('r1/1', 'ACGT'), ('r2/1', 'GGGG')])
+        fq2 = self.write_fastq([('r1/2', 'TTTT'), ('r3/2', 'CCCA')])
+        with self.assertRaises(ValueError):
+            read_utils.fastq_to_ubam(fq1, fq2, util.file.mkstempfname('.bam'), self.header)
+
+    def test_unequal_lengths(self):
+        fq1 = self.write_fastq([('r1/1', 'ACGT'), ('r2/1', 'GGGG')])
+        fq2 = self.write_fastq([('r1/2', 'TTTT')])
+        with self.assertRaises(ValueError):
+            read_utils.fastq_to_ubam(fq1, fq2, util.file.mkstempfname('.bam'), self.header)
+
+    def test_read_group_from_picard_options(self):
+        rg = read_utils.fastq_to_bam_read_group('s1', ['LIBRARY_NAME=lib1', 'PLATFORM=illumina', 'QUIET=TRUE'])
+        self.assertEqual(rg, {'ID': 'A', 'SM': 's1', 'LB': 'lib1', 'PL': 'illumina'})
+        self.assertIsNone(read_utils.fastq_to_bam_read_group('s1', ['CREATE_MD5_FILE=true']))
+
+
+
+class TestSplitBam(TestCaseWithTmp):
+
+    def read_names(self, bam):
+        with pysam.AlignmentFile(bam, 'rb', check_sq=False) as inb:
+            return [read.query_name for read in inb]
+
+    def test_split_bam(self):
+        inBam = os.path.join(util.file.get_test_input_path(), 'G5012.3.testreads.bam')
+        outBams = [util.file.mkstempfname('.{}.bam'.format(i)) for i in range(3)]
+        read_utils.split_bam(inBam, outBams, threads=2)
+
+        in_names = self.read_names(inBam)
+        in_order = dict((name, i) for i, name in reversed(list(enumerate(in_names))))
+        out_names = [self.read_names(outBam) for outBam in outBams]
+
+        # every read is written exactly once
+        self.assertEqual(sorted(in_names), sorted(sum(out_names, [])))
+        for names in out_names:
+            # outputs are roughly equal in size
+            self.assertAlmostEqual(len(names), len(in_names) / len(outBams), delta=2)
+            # outputs stay in the same (queryname) order as the input
+            positions = [in_order[name] for name in names]
+            self.assertEqual(positions, sorted(positions))
+        # read pairs are never split across outputs
+        for i, names in enumerate(out_names):
+            for j, other in enumerate(out_names):
+                if i != j:
+                    self.assertFalse(set(names) & set(other))
+
+    def test_split_empty_bam(self):
+        inBam = os.path.join(util.file.get_test_input_path(), 'empty.bam')
+        outBams = [util.file.mkstempfname('.{}.bam'.format(i)) for i in range(2)]
+        read_utils.split_bam(inBam, outBams)
+        for outBam in outBams:
+            self.assertEqual(self.read_names(outBam), [])
+
+
+class TestReheaderBams(TestCaseWithTmp):
+
+    def setUp(self):
+        super(TestReheaderBams, self).setUp()
+        self.inBams = [os.path.join(util.file.get_test_input_path(), x)
+                       for x in ('G5012.3.testreads.bam', 'G5012.3.mini.bam', 'empty.bam')]
+
+    def read_bam(self, bam):
+        with pysam.AlignmentFile(bam, 'rb', check_sq=False) as inb:
+            return inb.header.to_dict(), [read.to_string() for read in inb]
+
+    def test_reheader_bams(self):
+        outBams = [util.file.mkstempfname('.bam') for x in self.inBams]
+        rgMap = util.file.mkstempfname('.txt')
+        with open(rgMap, 'wt') as outf:
+            outf.write('SM\tG5012.3\tsample_one\n')
+            outf.write('LB\tG5012.3.l1\tlib_one\n')
+            for inBam, outBam in zip(self.inBams, outBams):
+                outf.write('FN\t{}\t{}\n'.format(inBam, outBam))
+        parser = read_utils.parser_reheader_bams(argparse.ArgumentParser())
+        args = parser.parse_args([rgMap, '--threads', '2'])
+        args.func_main(args)
+
+        for inBam, outBam in zip(self.inBams, outBams):
+            in_header, in_reads = self.read_bam(inBam)
+            out_header, out_reads = self.read_bam(outBam)
+            self.assertEqual(in_reads, out_reads)
+            self.assertEqual(len(in_header.get('RG', [])), len(out_header.get('RG', [])))
+            for in_rg, out_rg in zip(in_header.get('RG', []), out_header.get('RG', [])):
+                expected = dict(in_rg)
+                if expected.get('SM') == 'G5012.3':
+                    expected['SM'] = 'sample_one'
+                if expected.get('LB') == 'G5012.3.l1':
+                    expected['LB'] = 'lib_one'
+                self.assertEqual(out_rg, expected)
+
+    def test_reads_copied_verbatim(self):
+        outBam = util.file.mkstempfname('.bam')
+        rewritten, copied = read_utils.reheader_bam_file(self.inBams[0], outBam, {'SM:G5012.3': 'SM:other'})
+        self.assertEqual(rewritten + copied, os.path.getsize(outBam))
+        self.assertGreater(copied, rewritten)
+        with open(self.inBams[0], 'rb') as inf:
+            tail = inf.read()[-copied:]
+        with open(outBam, 'rb') as inf:
+            self.assertEqual(inf.read()[-copied:], tail)
+
+
+class TestReadNames(TestCaseWithTmp):
+
+    def setUp(self):
+        super(TestReadNames, self).setUp()
+        self.inBam = os.path.join(util.file.get_test_input_path(), 'G5012.3.subset.bam')
+        with pysam.AlignmentFile(self.inBam, 'rb', check_sq=False) as inb:
+            self.expected = []
+            for read in inb:
+                if not self.expected or self.expected[-1] != read.query_name:
+                    self.expected.append(read.query_name)
+
+    def test_bam_read_names(self):
+        out_names = util.file.mkstempfname('.txt')
+        read_utils.read_names(self.inBam, out_names, threads=2)
+        with open(out_names, 'rt') as inf:
+            self.assertEqual([line.rstrip('\n') for line in inf], self.expected)
+
+    def test_fasta_read_names(self):
+        in_fasta = util.file.mkstempfname('.fasta')
+        with open(in_fasta, 'wt') as outf:
+            outf.write('>r1/1\nACGT\n>r1/2\nACGT\n>r2\nGG\n')
+        out_names = util.file.mkstempfname('.txt')
+        read_utils.read_names(in_fasta, out_names)
+        self.assertEqual(util.file.slurp_file(out_names), 'r1\nr2\n')
+
+    def test_hashed_read_names(self):
+        out_hashes = util.file.mkstempfname('.bin')
+        read_utils.read_names(self.inBam, out_hashes, hashed=True)
+        hashes = read_utils.load_read_name_hashes(out_hashes)
+        self.assertEqual(os.path.getsize(out_hashes), 8 * len(set(self.expected)))
+        self.assertEqual(hashes, set(read_utils.read_name_hash(name) for name in self.expected))
+        self.assertNotIn(read_utils.read_name_hash('not-a-read'), hashes)
 
 
 class TestRmdupUnaligned(TestCaseWithTmp):
@@ -205,6 +464,70 @@ class TestRmdupUnaligned(TestCaseWithTmp):
         self.assertEqual(samtools.count(output_bam), 0)
 
 
+class TestRmdupPrefix(TestCaseWithTmp):
+
+    def read_strings(self, bam):
+        with pysam.AlignmentFile(bam, 'rb', check_sq=False) as inb:
+            return [read.to_string() for read in inb]
+
+    def test_canned_input(self):
+        input_bam = os.path.join(util.file.get_test_input_path(), 'TestRmdupUnaligned', 'input.bam')
+        output_bam = util.file.mkstempfname("output.bam")
+        read_utils.rmdup_prefix_bam(input_bam, output_bam)
+
+        in_reads = self.read_strings(input_bam)
+        out_reads = self.read_strings(output_bam)
+        self.assertEqual(len(out_reads), 1766)
+        # output is an in-order subset of the input
+        kept = set(out_reads)
+        self.assertEqual(out_reads, [r for r in in_reads if r in kept])
+
+    def test_spill_to_disk_matches_in_memory(self):
+        input_bam = os.path.join(util.file.get_test_input_path(), 'TestRmdupUnaligned', 'input.bam')
+        in_memory_bam = util.file.mkstempfname("in_memory.bam")
+        spilled_bam = util.file.mkstempfname("spilled.bam")
+        read_utils.rmdup_prefix_bam(input_bam, in_memory_bam)
+        read_utils.rmdup_prefix_bam(input_bam, spilled_bam, max_keys_in_memory=100, num_buckets=7)
+        self.assertEqual(self.read_strings(in_memory_bam), self.read_strings(spilled_bam))
+
+    def test_shorter_prefix_removes_more(self):
+        input_bam = os.path.join(util.file.get_test_input_path(), 'TestRmdupUnaligned', 'input.bam')
+        output_bam = util.file.mkstempfname("output.bam")
+        read_utils.rmdup_prefix_bam(input_bam, output_bam, prefix_len=10)
+        self.assertEqual(len(self.read_strings(output_bam)), 1760)
+
+    def test_empty_input(self):
+        empty_bam = os.path.join(util.file.get_test_input_path(), 'empty.bam')
+        output_bam = util.file.mkstempfname("output.bam")
+        read_utils.rmdup_prefix_bam(empty_bam, output_bam)
+        self.assertEqual(self.read_strings(output_bam), [])
+
+    def test_buckets_removed_on_failure(self):
+        input_bam = os.path.join(util.file.get_test_input_path(), 'TestRmdupUnaligned', 'input.bam')
+        bucket_dirs = []
+
+        def failing_add(buckets, key, ordinal, reads):
+            bucket_dirs.append(buckets.tmp_dir)
+            raise IOError('disk full')
+
+        with patch('read_utils._DupBuckets.add', failing_add):
+            with self.assertRaises(IOError):
+                read_utils.rmdup_prefix_bam(input_bam, util.file.mkstempfname("output.bam"),
+                                            max_keys_in_memory=100, num_buckets=7)
+        self.assertEqual(len(bucket_dirs), 1)
+        self.assertFalse(os.path.exists(bucket_dirs[0]))
+
+    def test_native_engine_of_rmdup_mvicuna_bam(self):
+        input_bam = os.path.join(util.file.get_test_input_path(), 'TestRmdupUnaligned', 'input.bam')
+        expected_bam = util.file.mkstempfname("expected.bam")
+        output_bam = util.file.mkstempfname("output.bam")
+        read_utils.rmdup_prefix_bam(input_bam, expected_bam)
+        args = read_utils.parser_rmdup_mvicuna_bam(argparse.ArgumentParser()).parse_args(
+            [input_bam, output_bam, '--engine', 'native'])
+        args.func_main(args)
+        self.assertEqual(self.read_strings(output_bam), self.read_strings(expected_bam))
+
+
 class TestMvicuna(TestCaseWithTmp):
     """
     Input consists of 3 read pairs.
@@ -238,6 +561,57 @@ class TestMvicuna(TestCaseWithTmp):
 
 
 
+class TestIndexedReference(TestCaseWithTmp):
+
+    def setUp(self):
+        super(TestIndexedReference, self).setUp()
+        self.refFasta = util.file.mkstempfname('.ref.fasta')
+        shutil.copyfile(os.path.join(util.file.get_test_input_path(), 'ebov-makona.fasta'), self.refFasta)
+        self.cache_dir = tempfile.mkdtemp()
+        self.builds = []
+
+    def fake_build(self, refFasta, index_type, novoalign_license_path=None):
+        self.builds.append(index_type)
+        util.file.touch(refFasta + '.' + index_type)
+
+    def test_indexes_built_once_per_reference(self):
+        with patch('read_utils._build_reference_index', side_effect=self.fake_build):
+            with read_utils.indexed_reference(self.refFasta, ('picard', 'bwa'), cache_dir=self.cache_dir) as ref1:
+                self.assertTrue(os.path.isfile(ref1 + '.bwa'))
+            with read_utils.indexed_reference(self.refFasta, ('picard', 'novoalign'), cache_dir=self.cache_dir) as ref2:
+                self.assertTrue(os.path.isfile(ref2 + '.novoalign'))
+        self.assertEqual(ref1, ref2)
+        self.assertEqual(self.builds, ['picard', 'bwa', 'novoalign'])
+        self.assertEqualContents(ref1, self.refFasta)
+
+    def test_cache_keyed_on_contents(self):
+        otherFasta = util.file.mkstempfname('.other.fasta')
+        shutil.copyfile(os.path.join(util.file.get_test_input_path(), 'G5012.3.fasta'), otherFasta)
+        with patch('read_utils._build_reference_index', side_effect=self.fake_build):
+            with read_utils.indexed_reference(self.refFasta, ('bwa',), cache_dir=self.cache_dir) as ref1:
+                pass
+            with read_utils.indexed_reference(otherFasta, ('bwa',), cache_dir=self.cache_dir) as ref2:
+                pass
+        self.assertNotEqual(ref1, ref2)
+        self.assertEqual(self.builds, ['bwa', 'bwa'])
+
+    def test_concurrent_callers_build_once(self):
+        def use_ref(_):
+            with read_utils.indexed_reference(self.refFasta, ('samtools',), cache_dir=self.cache_dir) as ref:
+                return ref
+        with patch('read_utils._build_reference_index', side_effect=self.fake_build):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                refs = list(executor.map(use_ref, range(8)))
+        self.assertEqual(len(set(refs)), 1)
+        self.assertEqual(self.builds, ['samtools'])
+
+    def test_without_cache(self):
+        with patch('read_utils._build_reference_index', side_effect=self.fake_build):
+            with read_utils.indexed_reference(self.refFasta, ('picard',)) as ref:
+                self.assertTrue(os.path.isfile(ref + '.picard'))
+            self.assertFalse(os.path.exists(ref))
+
+
 class TestAlignAndFix(TestCaseWithTmp):
     def setUp(self):
         super(TestAlignAndFix, self).setUp()
@@ -347,3 +721,61 @@ class TestDownsampleBams(TestCaseWithTmp):
 
         with self.assertRaises(ValueError):
             read_utils.main_downsample_bams([self.larger_bam, self.smaller_bam], temp_dir, specified_read_count=target_count, JVMmemory="1g")
+
+    def test_downsample_fraction(self):
+        temp_dir = tempfile.mkdtemp()
+        read_utils.main_downsample_bams([self.larger_bam], temp_dir, fraction=0.25)
+
+        output_bams = list(glob.glob(os.path.join(temp_dir, '*.downsampled-0.25.bam')))
+        self.assertEqual(len(output_bams), 1)
+        self.assertAlmostEqual(self.samtools.count(output_bams[0]), 18710 * 0.25, delta=300)
+
+    def test_downsample_picard_options(self):
+        temp_dir = tempfile.mkdtemp()
+        with patch('read_utils.log.warning') as warning:
+            read_utils.main_downsample_bams([self.smaller_bam], temp_dir, fraction=0.5,
+                                            picardOptions=['RANDOM_SEED=7', 'STRATEGY=Chained'])
+        warning.assert_called_once_with(ANY, 'STRATEGY=Chained')
+
+        expected_bam = util.file.mkstempfname('.bam')
+        read_utils.downsample_bam(self.smaller_bam, expected_bam, fraction=0.5, random_seed=7)
+        names = []
+        for out in (expected_bam, glob.glob(os.path.join(temp_dir, '*.downsampled-0.5.bam'))[0]):
+            with pysam.AlignmentFile(out, 'rb', check_sq=False) as outb:
+                names.append([read.query_name for read in outb])
+        self.assertEqual(names[0], names[1])
+
+    def test_downsample_bam_keeps_pairs_in_order(self):
+        out_bam = util.file.mkstempfname('.bam')
+        n_in, n_out = read_utils.downsample_bam(self.larger_bam, out_bam, read_count=3000)
+        self.assertEqual((n_in, n_out), (18710, 3000))
+
+        orig_order = {}
+        with pysam.AlignmentFile(self.larger_bam, 'rb', check_sq=False) as inb:
+            for i, read in enumerate(inb):
+                orig_order[(read.query_name, read.is_read1)] = i
+        with pysam.AlignmentFile(out_bam, 'rb', check_sq=False) as outb:
+            reads = [(read.query_name, read.is_read1) for read in outb]
+        self.assertEqual(len(reads), 3000)
+        self.assertEqual(sorted(reads, key=orig_order.get), reads)
+        names = [name for name, is_read1 in reads]
+        self.assertTrue(all(names.count(name) == 2 for name in names))
+
+    def test_downsample_bam_deterministic(self):
+        out1, out2, out3 = [util.file.mkstempfname('.bam') for i in range(3)]
+        read_utils.downsample_bam(self.smaller_bam, out1, fraction=0.5, random_seed=7)
+        read_utils.downsample_bam(self.smaller_bam, out2, fraction=0.5, random_seed=7)
+        read_utils.downsample_bam(self.smaller_bam, out3, fraction=0.5, random_seed=8)
+        names = []
+        for out in (out1, out2, out3):
+            with pysam.AlignmentFile(out, 'rb', check_sq=False) as outb:
+                names.append([read.query_name for read in outb])
+        self.assertEqual(names[0], names[1])
+        self.assertNotEqual(names[0], names[2])
+
+    def test_downsample_bam_too_few_reads(self):
+        out_bam = util.file.mkstempfname('.bam')
+        os.unlink(out_bam)
+        with self.assertRaises(ValueError):
+            read_utils.downsample_bam(self.smaller_bam, out_bam, read_count=5000)
+        self.assertFalse(os.path.exists(out_bam))
@@ -5,11 +5,84 @@ __author__ = "tomkinsc@broadinstitute.org"
 import os.path
 import tempfile
 import subprocess
+import threading
+import time
+import unittest
+import pysam
 import util.file
 import tools.bwa
 import tools.samtools
+from mock import patch
 from test import TestCaseWithTmp
 
+class TestReadGroupScheduling(unittest.TestCase):
+
+    def test_all_concurrent_split_by_size(self):
+        schedule = tools.bwa.Bwa._schedule_read_groups({'a': 100, 'b': 300, 'c': 400}, 16, 8)
+        self.assertEqual(schedule, [('c', 8), ('b', 6), ('a', 2)])
+
+    def test_limited_workers(self):
+        schedule = tools.bwa.Bwa._schedule_read_groups({'a': 100, 'b': 100, 'c': 600, 'd': 200}, 8, 2)
+        self.assertEqual(schedule, [('c', 7), ('d', 3), ('a', 2), ('b', 2)])
+
+    def test_at_least_one_thread(self):
+        schedule = tools.bwa.Bwa._schedule_read_groups({'a': 1, 'b': 10000}, 4, 4)
+        self.assertEqual(schedule, [('b', 3), ('a', 1)])
+
+    def _run(self, schedule, threads, workers):
+        lock = threading.Lock()
+        in_use = [0, 0]
+        granted = {}
+
+        def align(rg, rg_threads):
+            with lock:
+                granted[rg] = rg_threads
+                in_use[0] += rg_threads
+                in_use[1] = max(in_use[1], in_use[0])
+            time.sleep(0.01 * rg_threads)
+            with lock:
+                in_use[0] -= rg_threads
+            return rg
+
+        done = list(tools.bwa.Bwa._run_read_groups(schedule, threads, workers, align))
+        self.assertEqual(sorted(done), sorted(rg for rg, _ in schedule))
+        return granted, in_use[1]
+
+    def test_threads_in_flight_within_budget(self):
+        for rg_sizes, threads, workers in (({'a': 100, 'b': 100, 'c': 600, 'd': 200}, 8, 2),
+                                           ({'a': 1000, 'b': 1, 'c': 1, 'd': 1}, 4, 4),
+                                           ({'a': 5, 'b': 5, 'c': 5}, 2, 8)):
+            schedule = tools.bwa.Bwa._schedule_read_groups(rg_sizes, threads, workers)
+            granted, peak = self._run(schedule, threads, workers)
+            self.assertLessEqual(peak, threads)
+            self.assertTrue(all(n >= 1 for n in granted.values()))
+
+    def test_default_single_worker(self):
+        granted, peak = self._run([('a', 6), ('b', 2)], 6, 1)
+        self.assertEqual(granted, {'a': 6, 'b': 2})
+        self.assertEqual(peak, 6)
+
+
+class TestAlignReadGroupsCleanup(TestCaseWithTmp):
+
+    def test_split_bams_removed_on_failure(self):
+        in_bam = os.path.join(util.file.get_test_input_path(), 'G5012.3.subset.bam')
+        with pysam.AlignmentFile(in_bam, 'rb', check_sq=False) as inb:
+            rgs = [rg['ID'] for rg in inb.header.to_dict()['RG']]
+        seen = []
+
+        def failing_align(inBam, *args, **kwargs):
+            seen.append(inBam)
+            raise subprocess.CalledProcessError(1, 'bwa')
+
+        bwa = tools.bwa.Bwa()
+        with patch.object(bwa, 'align_mem_one_rg', failing_align):
+            self.assertRaises(subprocess.CalledProcessError, bwa.align_mem_rgs_parallel,
+                              in_bam, 'refDb', util.file.mkstempfname('.bam'), rgs, threads=1)
+        self.assertTrue(seen)
+        self.assertFalse(os.path.exists(os.path.dirname(seen[0])))
+
+
 class TestToolBwa(TestCaseWithTmp):
 
     def setUp(self):
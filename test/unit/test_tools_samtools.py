@@ -7,6 +7,7 @@ import os, os.path
 import tempfile
 import shutil
 import Bio.SeqIO, Bio.SeqRecord, Bio.Seq
+import pysam
 import util
 import util.file
 import tools
@@ -70,6 +71,112 @@ class TestToolSamtools(TestCaseWithTmp):
 
         assert samtools.count(out_bam)==39, "Output read count does not match the expected count."
 
+    def test_split_by_read_group(self):
+        samtools = tools.samtools.SamtoolsTool()
+        in_bam = os.path.join(util.file.get_test_input_path(), 'G5012.3.testreads.bam')
+        rg_to_outBam = {
+            'HAVA0.1': util.file.mkstempfname('.HAVA0.1.bam'),
+            'HBDJG.2': util.file.mkstempfname('.HBDJG.2.bam'),
+            'HBDCC.1': util.file.mkstempfname('.HBDCC.1.bam'),
+        }
+        counts = samtools.split_by_read_group(in_bam, rg_to_outBam)
+        self.assertEqual(counts, {'HAVA0.1': 782, 'HBDJG.2': 13500, 'HBDCC.1': 0})
+        for rg, out_bam in rg_to_outBam.items():
+            with pysam.AlignmentFile(out_bam, 'rb', check_sq=False) as inb:
+                self.assertEqual([x['ID'] for x in inb.header.to_dict()['RG']], [rg])
+                self.assertEqual(set(read.get_tag('RG') for read in inb), set([rg]) if counts[rg] else set())
+
+    def test_merge_native_unsorted(self):
+        samtools = tools.samtools.SamtoolsTool()
+        in_bams = [os.path.join(util.file.get_test_input_path(), x) for x in ('G5012.3.subset.bam', 'G5012.3.mini.bam')]
+        out_bam = util.file.mkstempfname('.bam')
+        self.assertEqual(samtools.merge_native(in_bams, out_bam, sort_order='unsorted'), 200 + 4548)
+        with pysam.AlignmentFile(out_bam, 'rb', check_sq=False) as inb:
+            header = inb.header.to_dict()
+            out_names = [read.query_name for read in inb]
+        self.assertEqual(header['HD']['SO'], 'unsorted')
+        self.assertEqual(len(header['RG']), 12)
+        expected_names = []
+        for in_bam in in_bams:
+            with pysam.AlignmentFile(in_bam, 'rb', check_sq=False) as inb:
+                expected_names.extend(read.query_name for read in inb)
+        self.assertEqual(out_names, expected_names)
+
+    def test_merge_native_queryname_with_rg_collision(self):
+        samtools = tools.samtools.SamtoolsTool()
+        in_bam = os.path.join(util.file.get_test_input_path(), 'G5012.3.subset.bam')
+        # same read group IDs, but a different sample
+        other_bam = util.file.mkstempfname('.bam')
+        with pysam.AlignmentFile(in_bam, 'rb', check_sq=False) as inb:
+            header = inb.header.to_dict()
+            for rg in header['RG']:
+                rg['SM'] = 'other'
+            with pysam.AlignmentFile(other_bam, 'wb', header=header) as outb:
+                for read in inb:
+                    outb.write(read)
+        out_bam = util.file.mkstempfname('.bam')
+        samtools.merge_native([in_bam, other_bam], out_bam, sort_order='queryname')
+        with pysam.AlignmentFile(out_bam, 'rb', check_sq=False) as inb:
+            header = inb.header.to_dict()
+            reads = [(read.query_name, read.get_tag('RG')) for read in inb]
+        rgs = dict((rg['ID'], rg['SM']) for rg in header['RG'])
+        self.assertEqual(len(rgs), 24)
+        self.assertEqual(rgs['HAVA0.1'], 'G5012.3')
+        self.assertEqual(rgs['HAVA0.1.1'], 'other')
+        self.assertEqual(len(reads), 400)
+        names = [name for name, rg in reads]
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(len([rg for name, rg in reads if rg.endswith('.1.1') or rg.endswith('.2.1')]), 200)
+
+    def write_unaligned_bam(self, names):
+        bam = util.file.mkstempfname('.bam')
+        header = {'HD': {'VN': '1.5', 'SO': 'queryname'}, 'RG': [{'ID': 'A', 'SM': 's'}]}
+        with pysam.AlignmentFile(bam, 'wb', header=header) as outb:
+            for name in names:
+                for flag in (77, 141):
+                    read = pysam.AlignedSegment()
+                    read.query_name = name
+                    read.query_sequence = 'ACGT'
+                    read.flag = flag
+                    read.reference_id = read.next_reference_id = -1
+                    read.reference_start = read.next_reference_start = -1
+                    outb.write(read)
+        return bam
+
+    def test_merge_native_queryname_order(self):
+        samtools = tools.samtools.SamtoolsTool()
+        in_bams = [self.write_unaligned_bam(['r1', 'r10', 'r3']), self.write_unaligned_bam(['r11', 'r2'])]
+        out_bam = util.file.mkstempfname('.bam')
+        self.assertEqual(samtools.merge_native(in_bams, out_bam, sort_order='queryname'), 10)
+        with pysam.AlignmentFile(out_bam, 'rb', check_sq=False) as inb:
+            reads = [(read.query_name, read.is_read1) for read in inb]
+        # plain string order of names (as Picard sorts them), read 1 first
+        self.assertEqual(reads, [(name, is_read1) for name in ('r1', 'r10', 'r11', 'r2', 'r3')
+                                 for is_read1 in (True, False)])
+
+    def test_merge_native_queryname_natural_order_input(self):
+        samtools = tools.samtools.SamtoolsTool()
+        # samtools sort -n order, which is not what the merge expects
+        in_bams = [self.write_unaligned_bam(['r1', 'r2', 'r10']), self.write_unaligned_bam(['r3'])]
+        out_bam = util.file.mkstempfname('.bam')
+        os.unlink(out_bam)
+        with self.assertRaises(ValueError):
+            samtools.merge_native(in_bams, out_bam, sort_order='queryname')
+        self.assertFalse(os.path.exists(out_bam))
+
+    def test_merge_native_coordinate(self):
+        samtools = tools.samtools.SamtoolsTool()
+        in_bam = os.path.join(util.file.get_test_input_path(), 'TestPerSample', 'in.bam')
+        out_bam = util.file.mkstempfname('.bam')
+        n = samtools.merge_native([in_bam, in_bam], out_bam)
+        with pysam.AlignmentFile(out_bam, 'rb') as inb:
+            header = inb.header.to_dict()
+            positions = [(read.reference_id if read.reference_id >= 0 else 1000, read.reference_start) for read in inb]
+        self.assertEqual(header['HD']['SO'], 'coordinate')
+        self.assertEqual(len(header['RG']), 1)
+        self.assertEqual(len(positions), n)
+        self.assertEqual(positions, sorted(positions))
+
     def test_bam2fa(self):
         samtools = tools.samtools.SamtoolsTool()
         sam = os.path.join(util.file.get_test_input_path(self), 'simple.sam')
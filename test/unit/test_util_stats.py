@@ -0,0 +1,85 @@
+# Unit tests for util.stats.py
+
+import itertools
+import random
+import unittest
+from math import exp, lgamma
+
+from mock import patch
+
+import util.stats
+
+
+def fisher_exact_by_enumeration(table):
+    ''' Reference 2 x n Fisher exact test: add up the probabilities of all
+        tables with the same margins that are no more likely than this one.
+    '''
+    def log_choose(n, k):
+        return lgamma(n + 1) - lgamma(k + 1) - lgamma(n - k + 1)
+
+    rowSum = sum(table[0])
+    colSums = [a + b for a, b in zip(*table)]
+    logChooseN = log_choose(sum(colSums), rowSum)
+
+    def prob(firstRow):
+        return exp(sum(log_choose(c, a) for c, a in zip(colSums, firstRow)) - logChooseN)
+
+    p0 = prob(table[0])
+    return sum(prob(firstRow) for firstRow in itertools.product(*[range(c + 1) for c in colSums])
+               if sum(firstRow) == rowSum and prob(firstRow) <= p0 + 1e-9)
+
+
+class TestFisherExact(unittest.TestCase):
+
+    def test_2x2(self):
+        # same as scipy.stats.fisher_exact
+        self.assertAlmostEqual(util.stats.fisher_exact([[1, 9], [11, 3]]), 0.002759456185220083)
+        self.assertAlmostEqual(util.stats.fisher_exact([[8, 2], [1, 5]]), 0.03496503496503495)
+        self.assertAlmostEqual(util.stats.fisher_exact([[5, 5], [5, 5]]), 1.0)
+
+    def test_degenerate_tables(self):
+        self.assertEqual(util.stats.fisher_exact([]), 1.0)
+        self.assertEqual(util.stats.fisher_exact([[3, 4, 5]]), 1.0)
+        self.assertEqual(util.stats.fisher_exact([[3, 4, 5], [0, 0, 0]]), 1.0)
+        self.assertEqual(util.stats.fisher_exact([[3, 0], [4, 0]]), 1.0)
+        self.assertAlmostEqual(util.stats.fisher_exact([[2.0, 7.0], [8.0, 2.0]]),
+                               util.stats.fisher_exact([[2, 7], [8, 2]]))
+        self.assertAlmostEqual(util.stats.fisher_exact([[1, 9], [11, 3], [0, 0]]),
+                               util.stats.fisher_exact(list(zip([1, 9], [11, 3]))))
+
+    def test_errors(self):
+        self.assertRaises(ValueError, util.stats.fisher_exact, [[1, 2], [3]])
+        self.assertRaises(ValueError, util.stats.fisher_exact, [[1, 2.5], [3, 4]])
+        self.assertRaises(ValueError, util.stats.fisher_exact, [[1, -2], [3, 4]])
+        self.assertRaises(NotImplementedError, util.stats.fisher_exact, [[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+
+    def test_random_tables(self):
+        rng = random.Random(50)
+        for _ in range(300):
+            n = rng.randint(2, 4)
+            table = [[rng.randint(0, 12) for _ in range(n)] for _ in range(2)]
+            if any(a + b == 0 for a, b in zip(*table)) or 0 in map(sum, table):
+                continue
+            expected = fisher_exact_by_enumeration(table)
+            actual = util.stats.fisher_exact(table)
+            self.assertAlmostEqual(actual / expected, 1.0, places=9, msg=str(table))
+
+    def test_high_depth(self):
+        # well beyond what enumerating every table could do
+        pval = util.stats.fisher_exact([[40, 45, 50, 55], [900, 1200, 1000, 900]])
+        self.assertAlmostEqual(pval, 0.11212751994706804, places=9)
+        self.assertAlmostEqual(util.stats.fisher_exact([[900, 1200, 1000, 900], [40, 45, 50, 55]]), pval)
+
+    def test_many_columns(self):
+        # the observed table is unusual in only one column, so neither bound settles most of the network
+        pval = util.stats.fisher_exact([[1, 16, 18, 14, 17, 12], [80, 84, 76, 82, 78, 81]])
+        self.assertAlmostEqual(pval, 0.0018611650196482643, places=12)
+
+    def test_cached(self):
+        pval = util.stats.fisher_exact([[3, 5, 8], [13, 21, 34]])
+        cached = dict(util.stats._fisherExactCache)
+        # the same table after reordering rows and columns
+        with patch('util.stats._fisher_exact_2xn') as fisher_exact_2xn:
+            self.assertEqual(util.stats.fisher_exact([[21, 34, 13], [5, 8, 3]]), pval)
+        fisher_exact_2xn.assert_not_called()
+        self.assertEqual(util.stats._fisherExactCache, cached)
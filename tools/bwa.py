@@ -58,7 +58,8 @@ class Bwa(tools.Tool):
         return output
 
     def align_mem_bam(self, inBam, refDb, outBam, options=None,
-                      min_score_to_filter=None, threads=None, JVMmemory=None, invert_filter=False, should_index=True):
+                      min_score_to_filter=None, threads=None, JVMmemory=None, invert_filter=False, should_index=True,
+                      workers=None):
         options = options or []
 
         samtools = tools.samtools.SamtoolsTool()
@@ -78,56 +79,110 @@ class Bwa(tools.Tool):
                                   threads=threads, invert_filter=invert_filter)
 
         else:
-            # Multiple RGs, align one at a time and merge
-            align_bams = []
+            # Multiple RGs: split them out in one pass, align them concurrently, and merge
+            self.align_mem_rgs_parallel(inBam, refDb, outBam, rgs, options=options,
+                                        min_score_to_filter=min_score_to_filter, threads=threads,
+                                        workers=workers, invert_filter=invert_filter, should_index=should_index)
+
+    @staticmethod
+    def _schedule_read_groups(rg_sizes, threads, workers):
+        ''' Given a dict of RG ID -> read count, return a list of (RG ID, thread count)
+            in the order the read groups should be submitted (largest first). The thread
+            budget is split in proportion to read group size, assuming that up to
+            `workers` read groups are aligned at once. These are requested thread counts;
+            _run_read_groups only grants what is left of the budget when each one starts.
+        '''
+        total = sum(rg_sizes.values())
+        concurrency = max(1, min(workers, threads, len(rg_sizes)))
+        # leave at least one thread for each of the other read groups in flight
+        most = threads - (concurrency - 1)
+        schedule = []
+        for rg, size in sorted(rg_sizes.items(), key=lambda x: (-x[1], x[0])):
+            # this read group's share of the budget when running alongside
+            # (concurrency - 1) read groups of average size
+            share = float(size) * len(rg_sizes) / (total * concurrency)
+            schedule.append((rg, max(1, min(most, int(round(threads * share))))))
+        return schedule
+
+    @staticmethod
+    def _run_read_groups(schedule, threads, workers, align_fn):
+        ''' Call align_fn(rg, rg_threads) for each (RG ID, requested threads) in schedule,
+            with up to `workers` calls in flight at once. Threads are granted from what
+            remains of the `threads` budget as each call starts (keeping one thread back
+            for every other call that could start alongside it), so the threads in use at
+            any one time never add up to more than `threads`. Yields the results of
+            align_fn in the order the calls complete.
+        '''
+        pending = list(schedule)
+        workers = max(1, min(workers, threads, len(pending)))
+        budget = threads
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                while pending and len(running) < workers:
+                    rg, rg_threads = pending.pop(0)
+                    reserve = min(workers - len(running) - 1, len(pending))
+                    rg_threads = max(1, min(rg_threads, budget - reserve))
+                    budget -= rg_threads
+                    running[executor.submit(align_fn, rg, rg_threads)] = rg_threads
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    budget += running.pop(future)
+                    yield future.result()
+
+    def align_mem_rgs_parallel(self, inBam, refDb, outBam, rgs, options=None, min_score_to_filter=None,
+                               threads=None, workers=None, invert_filter=False, should_index=True):
+        ''' Align each read group of a multi-read-group BAM separately (so that bwa
+            can be given the correct @RG line) with up to `workers` read groups in
+            flight at once, then merge the per-read-group alignments in-process.
+            Each concurrent bwa process loads its own copy of the index, so `workers`
+            defaults to 1 to keep just one copy of the index in memory; callers
+            aligning against small reference databases can raise it.
+        '''
+        samtools = tools.samtools.SamtoolsTool()
+        threads = util.misc.sanitize_thread_count(threads)
+        workers = 1 if workers is None else max(1, workers)
+
+        with util.file.tmp_dir(suffix='_bwa_rgs') as tmp_dir:
+            # extract all read groups in a single pass over the input
+            rg_inBams = dict((rg, os.path.join(tmp_dir, '{}.in.bam'.format(i))) for i, rg in enumerate(rgs))
+            rg_sizes = samtools.split_by_read_group(inBam, rg_inBams, threads=threads)
+            for rg, size in rg_sizes.items():
+                if size == 0:
+                    log.warning("No reads present for RG %s in file: %s", rg, inBam)
+            rg_sizes = dict((rg, size) for rg, size in rg_sizes.items() if size > 0)
+
+            def align_rg(rg, rg_threads):
+                log.debug("aligning RG %s (%d reads) with %d threads", rg, rg_sizes[rg], rg_threads)
+                return self.align_mem_one_rg(
+                    rg_inBams[rg],
+                    refDb,
+                    rg_inBams[rg][:-len('.in.bam')] + '.aligned.bam',
+                    rgid=rg,
+                    options=list(options or []),
+                    min_score_to_filter=min_score_to_filter,
+                    threads=rg_threads,
+                    invert_filter=invert_filter,
+                    should_index=False
+                )
 
-            threads_for_chunk = int(round(min(max(threads / len(rgs),1),threads),0))+1
-            # worker count limited to 1 for now to reduce in-memory index size resulting from
-            # running multiple copies of bwa in parallel
-            workers = 1 #len(rgs) if len(rgs)<threads else threads
-            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-                futures = []# executor.submit(util.file.count_occurrences_in_tsv, filePath, include_noise=includeNoise) for rg in rgs]
-
-                for rg in rgs:
-                    tmp_bam = util.file.mkstempfname('.{}.bam'.format(rg))
-                    futures.append(executor.submit(
-                        self.align_mem_one_rg,
-                        inBam,
-                        refDb,
-                        tmp_bam,
-                        rgid=rg,
-                        options=options,
-                        min_score_to_filter=min_score_to_filter,
-                        threads=threads_for_chunk, 
-                        invert_filter=invert_filter
-                    ))
-
-                for future in concurrent.futures.as_completed(futures):
-                    if future.result():
-                        rg, aln_bam = future.result()
-                        if os.path.getsize(aln_bam) > 0:
-                            align_bams.append(aln_bam)
-                        else:
-                            log.warning("No alignment output for RG %s in file %s against %s", rg, inBam, refDb)
+            align_bams = []
+            schedule = self._schedule_read_groups(rg_sizes, threads, workers)
+            for result in self._run_read_groups(schedule, threads, workers, align_rg):
+                if result:
+                    rg, aln_bam = result
+                    if os.path.getsize(aln_bam) > 0:
+                        align_bams.append(aln_bam)
+                    else:
+                        log.warning("No alignment output for RG %s in file %s against %s", rg, inBam, refDb)
 
             if len(align_bams) == 0:
                 util.file.touch(outBam)
             else:
-                # Merge BAMs, sort, and index
-                picardOptions = ['SORT_ORDER=coordinate', 'USE_THREADING=true']
-                if should_index:
-                    picardOptions.append('CREATE_INDEX=true')
-                tools.picard.MergeSamFilesTool().execute(
-                    align_bams,
-                    outBam,
-                    picardOptions=picardOptions,
-                    JVMmemory=JVMmemory
-                )
-                # no longer required since MergeSamFiles creates the index
-                #if outBam.endswith(".bam") or outBam.endswith(".cram"):
-                #    samtools.index(outBam)
-                for bam in align_bams:
-                    os.unlink(bam)
+                # Merge the (coordinate-sorted) BAMs and index
+                samtools.merge_native(sorted(align_bams), outBam, sort_order='coordinate', threads=threads)
+                if should_index and (outBam.endswith(".bam") or outBam.endswith(".cram")):
+                    samtools.index(outBam)
 
     def align_mem_one_rg(self, inBam, refDb, outBam, rgid=None, options=None,
                          min_score_to_filter=None, threads=None, JVMmemory=None, invert_filter=False, should_index=True):
@@ -119,12 +119,9 @@ class NovoalignTool(tools.Tool):
                     align_bams.append(tmp_bam)
 
             # Merge BAMs, sort, and index
-            tools.picard.MergeSamFilesTool().execute(
-                align_bams,
-                outBam,
-                picardOptions=['SORT_ORDER=coordinate', 'USE_THREADING=true', 'CREATE_INDEX=true'],
-                JVMmemory=JVMmemory
-            )
+            samtools = tools.samtools.SamtoolsTool()
+            samtools.merge_native(align_bams, outBam, sort_order='coordinate')
+            samtools.index(outBam)
             for bam in align_bams:
                 os.unlink(bam)
 
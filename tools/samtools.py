@@ -23,6 +23,9 @@ import os.path
 import subprocess
 import tempfile
 import contextlib
+import heapq
+import itertools
+import sys
 from collections import OrderedDict
 from decimal import *
 
@@ -38,6 +41,70 @@ TOOL_VERSION = '1.9'
 log = logging.getLogger(__name__)
 
 
+def _merge_header_records(records_by_file):
+    ''' Union @RG or @PG records across files. A record identical to one
+        already seen is merged into it; a record whose ID collides with a
+        different record gets a new ID (ID.1, ID.2, ...). PP links between
+        @PG records follow the renaming. Returns the merged list of records
+        and, per file, a dict of old ID -> new ID for the renamed records.
+    '''
+    merged = []
+    by_id = {}
+    id_maps = []
+    for records in records_by_file:
+        id_map = {}
+        for rec in records:
+            rec = dict(rec)
+            if rec.get('PP') in id_map:
+                rec['PP'] = id_map[rec['PP']]
+            old_id = rec['ID']
+            n = 0
+            while rec['ID'] in by_id and by_id[rec['ID']] != rec:
+                n += 1
+                rec['ID'] = '{}.{}'.format(old_id, n)
+            if rec['ID'] not in by_id:
+                by_id[rec['ID']] = rec
+                merged.append(rec)
+            if rec['ID'] != old_id:
+                id_map[old_id] = rec['ID']
+        id_maps.append(id_map)
+    return merged, id_maps
+
+
+def _merge_headers(headers, sort_order):
+    ''' Reconcile BAM header dicts for merging. Returns the merged header and,
+        per input, a tuple of (RG ID map, PG ID map) for renamed records.
+    '''
+    dicts = [h.get('SQ', []) for h in headers if h.get('SQ')]
+    if any(sq != dicts[0] for sq in dicts[1:]):
+        raise ValueError("Cannot merge BAM files with different sequence dictionaries")
+    rgs, rg_maps = _merge_header_records([h.get('RG', []) for h in headers])
+    pgs, pg_maps = _merge_header_records([h.get('PG', []) for h in headers])
+    comments = []
+    for h in headers:
+        comments.extend(co for co in h.get('CO', []) if co not in comments)
+
+    hd = dict(headers[0].get('HD', {})) if headers else {}
+    hd.setdefault('VN', '1.5')
+    hd['SO'] = sort_order
+    hd.pop('GO', None)
+    merged = {'HD': hd}
+    for key, value in (('SQ', dicts[0] if dicts else []), ('RG', rgs), ('PG', pgs), ('CO', comments)):
+        if value:
+            merged[key] = value
+    return merged, list(zip(rg_maps, pg_maps))
+
+
+def _coordinate_key(read):
+    # unmapped reads without a position sort last, as in samtools
+    tid = read.reference_id if read.reference_id >= 0 else sys.maxsize
+    return (tid, read.reference_start, read.is_reverse)
+
+
+def _queryname_key(read):
+    return (read.query_name, not read.is_read1)
+
+
 class SamtoolsTool(tools.Tool):
 
     def __init__(self, install_methods=None):
@@ -223,6 +290,120 @@ class SamtoolsTool(tools.Tool):
                     outf.write(read)
 
 
+    def split_by_read_group(self, inBam, rg_to_outBam, threads=None):
+        ''' Write the reads of each read group in inBam to its own BAM file, in a
+            single pass over the input (rather than one `samtools view -r` per
+            read group). rg_to_outBam maps RG ID -> output BAM path; the header
+            of each output is reduced to that one read group. Reads from read
+            groups not in rg_to_outBam, or with no RG tag, are dropped.
+            Returns a dict of RG ID -> number of reads written.
+        '''
+        threads = util.misc.sanitize_thread_count(threads)
+        with pysam.AlignmentFile(inBam, 'rb', check_sq=False, threads=threads) as inb:
+            header = inb.header.to_dict()
+            outs = {}
+            try:
+                for rg, outBam in rg_to_outBam.items():
+                    rg_header = dict(header)
+                    rg_header['RG'] = [x for x in header.get('RG', []) if x['ID'] == rg]
+                    outs[rg] = pysam.AlignmentFile(outBam, 'wb', header=rg_header)
+                counts = dict((rg, 0) for rg in rg_to_outBam)
+                for read in inb:
+                    if read.has_tag('RG'):
+                        rg = read.get_tag('RG')
+                        if rg in outs:
+                            outs[rg].write(read)
+                            counts[rg] += 1
+            finally:
+                for outb in outs.values():
+                    outb.close()
+        return counts
+
+    def merge_native(self, inBams, outBam, sort_order='coordinate', threads=None):
+        ''' Merge inBams into outBam in-process, as a lightweight alternative
+            to Picard MergeSamFiles.
+
+            Headers are reconciled like Picard does: sequence dictionaries must
+            agree, @RG and @PG records are unioned, and records whose IDs
+            collide with a different record are renamed (ID.1, ID.2, ...) with
+            the RG/PG tags of their reads rewritten to match.
+
+            sort_order is one of:
+              unsorted: concatenate the inputs in the order given.
+              coordinate: k-way merge; inputs not already coordinate sorted
+                are sorted first.
+              queryname: k-way merge by read name, with read 1 before read 2.
+                Names are compared as plain strings, which is the order Picard
+                (htsjdk) and fastq_to_ubam write. This is not the natural order
+                of samtools sort -n (r2 before r10), so inputs must already be in
+                plain string order; an input found out of order raises ValueError.
+            Returns the number of reads written.
+        '''
+        if sort_order not in ('unsorted', 'coordinate', 'queryname'):
+            raise ValueError("invalid sort order: %s" % sort_order)
+        threads = util.misc.sanitize_thread_count(threads)
+
+        with util.file.tmp_dir('_merge_native') as t_dir:
+            inbs = []
+            try:
+                for i, inBam in enumerate(inBams):
+                    inb = pysam.AlignmentFile(inBam, 'rb', check_sq=False)
+                    so = inb.header.to_dict().get('HD', {}).get('SO')
+                    if sort_order != 'unsorted' and so != sort_order:
+                        if sort_order == 'queryname':
+                            inb.close()
+                            raise ValueError("%s is not sorted in queryname order" % inBam)
+                        inb.close()
+                        sortedBam = os.path.join(t_dir, '{}.sorted.bam'.format(i))
+                        pysam.sort('-@', str(threads), '-o', sortedBam, inBam, catch_stdout=False)
+                        inb = pysam.AlignmentFile(sortedBam, 'rb', check_sq=False)
+                    inbs.append(inb)
+
+                header, tag_maps = _merge_headers([inb.header.to_dict() for inb in inbs], sort_order)
+
+                def reads(i, inb):
+                    rg_map, pg_map = tag_maps[i]
+                    for read in inb:
+                        if rg_map and read.has_tag('RG') and read.get_tag('RG') in rg_map:
+                            read.set_tag('RG', rg_map[read.get_tag('RG')])
+                        if pg_map and read.has_tag('PG') and read.get_tag('PG') in pg_map:
+                            read.set_tag('PG', pg_map[read.get_tag('PG')])
+                        yield read
+
+                def keyed_reads(i, inb, key):
+                    # (key, file index, ordinal) is unique, so reads are never compared
+                    last = None
+                    for n, read in enumerate(reads(i, inb)):
+                        k = key(read)
+                        if sort_order == 'queryname':
+                            if last is not None and k < last:
+                                raise ValueError("%s is not sorted in queryname order (plain string order of read "
+                                                 "names, as Picard sorts them): %s follows %s" % (inBams[i], k[0], last[0]))
+                            last = k
+                        yield (k, i, n, read)
+
+                if sort_order == 'coordinate':
+                    merged = (x[3] for x in heapq.merge(*[keyed_reads(i, inb, _coordinate_key) for i, inb in enumerate(inbs)]))
+                elif sort_order == 'queryname':
+                    merged = (x[3] for x in heapq.merge(*[keyed_reads(i, inb, _queryname_key) for i, inb in enumerate(inbs)]))
+                else:
+                    merged = itertools.chain.from_iterable(reads(i, inb) for i, inb in enumerate(inbs))
+
+                n_reads = 0
+                mode = 'wh' if outBam.endswith('.sam') else 'wb'
+                try:
+                    with pysam.AlignmentFile(outBam, mode, header=header, threads=threads) as outb:
+                        for read in merged:
+                            outb.write(read)
+                            n_reads += 1
+                except ValueError:
+                    os.unlink(outBam)
+                    raise
+            finally:
+                for inb in inbs:
+                    inb.close()
+        return n_reads
+
     def downsample(self, inBam, outBam, probability):
 
         if not probability:
@@ -495,13 +495,8 @@ def fastaMaker(seqs, linewidth=60):
     for idVal, seq in seqs:
         yield ">{}\n".format(idVal)
 
-        while len(seq) > linewidth:
-            line = seq[:linewidth]
-            seq = seq[linewidth:]
-            yield "{}\n".format(line)
-
-        if seq:
-            yield seq + "\n"
+        for i in range(0, len(seq), linewidth):
+            yield seq[i:i + linewidth] + "\n"
 
 
 def makeFastaFile(seqs, outFasta):
@@ -1,7 +1,9 @@
 '''A few pure-python statistical tools to avoid the need to install scipy. '''
 from __future__ import division  # Division of integers with / should never round!
 from math import exp, log, sqrt, gamma, lgamma, erf
-import itertools
+import bisect
+import collections
+import heapq
 
 __author__ = "dpark@broadinstitute.org, irwin@broadinstitute.org"
 
@@ -88,9 +90,9 @@ def fisher_exact(contingencyTable):
         contingencyTable is a sequence of 2 length-n sequences of integers.
         Return the two-tailed p-value against the null hypothesis that the row
             and column criteria are independent, using Fisher's exact test.
-        For n larger than 2, this is very slow, O(S^(n-1)), where S is the
-            smaller of the two row sums. Better to use chi2_contingency unless
-            one of the row sums is small.
+        For n larger than 2, this can still be slow, up to O(S^(n-1)) where S
+            is the smaller of the two row sums, although usually far less than
+            that. Better to use chi2_contingency unless one of the row sums is small.
         Handles m x n contingencyTable with m > 2 if it can be reduced to the
             2 x n case by transposing or by removing rows that are all 0s. Also
             handles degenerate cases of 0 or 1 row by returning 1.0.
@@ -119,36 +121,128 @@ def fisher_exact(contingencyTable):
     if m != 2:
         raise NotImplementedError('More than 2 non-zero rows and columns.')
 
-    # Put row with smaller sum first. Makes the loop iterations simpler.
+    # Put row with smaller sum first. Makes the network below smaller.
     table.sort(key=sum)
-    # Put column with largest sum last. Makes loop quick rejection faster.
+    # Put column with largest sum last.
     table = list(zip(*table))  # Transpose
     table.sort(key=sum)
     table = list(zip(*table))  # Transpose back
 
-    # There are many optimizations possible for the following code, but it would
-    #     still be O(S^(n-1)) so it would still be too slow for anything
-    #     sizeable, and it's usable as it for small things.
+    colSums = tuple(int(sum(row[col] for row in table)) for col in range(n))
+    key = (tuple(int(x) for x in table[0]), colSums)
+    # The same tables come up over and over, so remember the most recent results
+    if key not in _fisherExactCache:
+        if len(_fisherExactCache) >= 2**16:
+            _fisherExactCache.clear()
+        _fisherExactCache[key] = _fisher_exact_2xn(*key)
+    return _fisherExactCache[key]
+
+
+_fisherExactCache = {}
+
+
+def _fisher_exact_2xn(firstRow, colSums):
+    """ Two-tailed Fisher exact p-value of the 2 x n table with first row
+        firstRow and column sums colSums: the total probability of all of
+        the tables with the same margins that are no more likely than this one.
+        Instead of enumerating all O(S^(n-1)) tables, this walks the network
+        of partial tables (Mehta & Patel, 1983), whose nodes (j, k) are all of
+        the ways of filling columns 0..j-1 that leave k counts to place in the
+        first row. How many completions of a node count towards the p-value
+        depends only on how likely the path into the node (the "past") was:
+          - none of them do if even the least likely completion is too likely,
+            and all of them do if even the most likely one is unlikely enough,
+            in which case their total probability is a single binomial
+            coefficient (Vandermonde's identity);
+          - otherwise, the answer is the same for a whole range of pasts, which
+            is remembered per node, so that each node is expanded only once
+            for each distinct answer instead of once for every path into it.
+        The most likely completion of each node comes from greedily placing
+        one count at a time where it adds the most probability (log binomial
+        coefficients are concave), and the least likely one from a recursion
+        over the columns.
+    """
+    n = len(colSums)
+    rowSum = sum(firstRow)
+    # restSums[j]: sum of colSums[j:]
+    restSums = [sum(colSums[j:]) for j in range(n)] + [0]
+    # logChooses[j][a]: log(colSums[j] choose a),
+    # logChooseRests[j][k]: log(restSums[j] choose k), the total of all completions of node (j, k)
+    logChooses = [[_log_choose(cs, a) for a in range(min(rowSum, cs) + 1)] for cs in colSums]
+    logChooseRests = [[_log_choose(rs, k) for k in range(min(rowSum, rs) + 1)] for rs in restSums]
+    # (1e-9 handles floating point round off)
+    maxProb = exp(sum(logChooses[j][a] for j, a in enumerate(firstRow)) - logChooseRests[0][rowSum]) + 1e-9
+    logMaxProb = log(maxProb) + logChooseRests[0][rowSum]
+
+    # maxRest[j][k], minRest[j][k]: log of the largest and smallest products
+    #   of binomial coefficients for placing k more counts in columns j..n-1
+    maxRest = []
+    for j in range(n - 1):
+        best = [0.0]
+        gains = [(-_log_choose(colSums[i], 1), i, 0) for i in range(j, n) if colSums[i] > 0]
+        heapq.heapify(gains)
+        while len(best) <= min(rowSum, restSums[j]):
+            gain, i, a = heapq.heappop(gains)
+            best.append(best[-1] - gain)
+            if a + 1 < colSums[i]:
+                heapq.heappush(gains, (_log_choose(colSums[i], a + 1) - _log_choose(colSums[i], a + 2), i, a + 1))
+        maxRest.append(best)
+    maxRest.append(logChooses[n - 1])
+    minRest = [logChooses[n - 1]]
+    for j in range(n - 2, -1, -1):
+        after = minRest[0]
+        minRest.insert(0, [min(logChooses[j][a] + after[k - a]
+                               for a in range(max(0, k - len(after) + 1), min(k, len(logChooses[j]) - 1) + 1))
+                           for k in range(min(rowSum, restSums[j]) + 1)])
+
+    # counted[j][k]: sorted (low, high, fraction) results of network(j, k, room)
+    counted = [collections.defaultdict(list) for j in range(n)]
+
+    def network(j, k, room):
+        # Return the fraction of the total probability of the completions of
+        #   node (j, k) that comes from those whose log product of binomial
+        #   coefficients is at most room, and the range [low, high) of room
+        #   that gives the same fraction.
+        if maxRest[j][k] <= room:
+            # every completion is at most as likely as the observed table
+            return 1.0, maxRest[j][k], float('inf')
+        if minRest[j][k] > room:
+            # none of them is
+            return 0.0, float('-inf'), minRest[j][k]
+        memo = counted[j][k]
+        i = bisect.bisect_right(memo, (room, float('inf'))) - 1
+        if i >= 0 and memo[i][0] <= room < memo[i][1]:
+            return memo[i][2], memo[i][0], memo[i][1]
+        fraction, low, high = 0.0, float('-inf'), float('inf')
+        for a in range(max(0, k - restSums[j + 1]), min(colSums[j], k) + 1):
+            logChoose = logChooses[j][a]
+            # (the first two cases are network(j + 1, k - a, ...), inlined as they are by far the most common)
+            if maxRest[j + 1][k - a] <= room - logChoose:
+                childFraction, childLow, childHigh = 1.0, maxRest[j + 1][k - a], float('inf')
+            elif minRest[j + 1][k - a] > room - logChoose:
+                childFraction, childLow, childHigh = 0.0, float('-inf'), minRest[j + 1][k - a]
+            else:
+                childFraction, childLow, childHigh = network(j + 1, k - a, room - logChoose)
+            if childFraction:
+                fraction += childFraction * exp(logChoose + logChooseRests[j + 1][k - a] - logChooseRests[j][k])
+            if childLow + logChoose > low:
+                low = childLow + logChoose
+            if childHigh + logChoose < high:
+                high = childHigh + logChoose
+        bisect.insort(memo, (low, high, fraction))
+        return fraction, low, high
 
-    rowSums = [sum(row) for row in table]
-    colSums = [sum(row[col] for row in table) for col in range(n)]
+    return network(0, rowSum, logMaxProb)[0]
 
-    logChooseNrowSum = log_choose(sum(rowSums), rowSums[0])
 
-    def prob_of_table(firstRow):
-        return exp(sum(log_choose(cs, a) for cs, a in zip(colSums, firstRow)) - logChooseNrowSum)
+_logFactorials = [0.0]
 
-    p0 = prob_of_table(table[0])
-    result = 0
-    for firstRowM1 in itertools.product(*[range(min(rowSums[0], colSums[i]) + 1) for i in range(n - 1)]):
-        lastElmt = rowSums[0] - sum(firstRowM1)
-        if lastElmt < 0 or lastElmt > colSums[-1]:
-            continue
-        prob = prob_of_table(firstRowM1 + (lastElmt,))
-        if prob <= p0 + 1e-9:  # (1e-9 handles floating point round off)
-            result += prob
 
-    return result
+def _log_choose(n, k):
+    # log(n choose k) for integers, from a table of log factorials that is extended as needed
+    if n >= len(_logFactorials):
+        _logFactorials.extend(lgamma(x + 1) for x in range(len(_logFactorials), n + 1))
+    return _logFactorials[n] - _logFactorials[k] - _logFactorials[n - k]
 
 
 def log_choose(n, k):